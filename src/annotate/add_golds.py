@@ -1,9 +1,21 @@
 import json
+import argparse
+import sys
+sys.path.append('.')
+from src.dataset_store import DatasetStore
+
+parser = argparse.ArgumentParser(description="Add the gold regions of the regional URL lists")
+parser.add_argument("--store", help="Dataset store to read the annotations from and add the golds to, instead of JSON files", default='')
+args = parser.parse_args()
 
 json_path = './data/gz_bilingual_graph_Llama-3.3-70B-Instruct.json'
 
-with open(json_path, 'r', encoding='utf8') as f:
-    data = json.load(f)
+if args.store:
+    store = DatasetStore(args.store)
+    data = store.read_records(['url_it', 'region'])
+else:
+    with open(json_path, 'r', encoding='utf8') as f:
+        data = json.load(f)
 
 json_path_urls = './data/extracted_urls_regions_inverse.json'
 
@@ -21,5 +33,8 @@ for i in range(len(data)):
 
     data[i]['region'] = data[i]['region_gold'] if data[i]['region_gold'] != 'UNK' else data[i]['region']
 
-with open(json_path.replace('.json', '_golds.json'), 'w', encoding='utf8') as f:
-    json.dump(data, f, ensure_ascii = False, indent = 4)
\ No newline at end of file
+if args.store:
+    store.add_columns('golds', [{k: el[k] for k in ('id', 'region_gold', 'region_silver', 'region')} for el in data])
+else:
+    with open(json_path.replace('.json', '_golds.json'), 'w', encoding='utf8') as f:
+        json.dump(data, f, ensure_ascii = False, indent = 4)
\ No newline at end of file
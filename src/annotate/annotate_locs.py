@@ -1,5 +1,5 @@
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import AutoTokenizer
 import sys
 sys.path.append('.')
 from model.llm_annotator.italia9b import ItaliaForCausalLM
@@ -7,14 +7,43 @@ import pandas as pd
 import json
 import ast
 import re
-from src.utils import prompt_layout_dict
+from src.utils import prompt_layout_dict, load_changed_urls, load_json
+from src.dataset_store import DatasetStore
+from src.dedup import load_clusters, split_duplicates, copy_to_duplicates
+from src.annotate.prefix_cache import split_prompt, cacheable_prefix, TEXT_SENTINEL
+from src.annotate.constrained import LocationDictConstraint, load_location_values, CONSTRAINT_VERSION
+from src.annotate.result_cache import ResultCache
+from src.annotate.backends import LazyBackend, add_backend_args, quantization_from_args
+from src.annotate.gazetteer import Gazetteer
+from src.runner import add_runner_args, runner_from_args
 from tqdm.auto import tqdm
 import argparse
+import os
 
 def main(args):
     json_path = './data/gz_bilingual_graph.json'
-    df = pd.read_json(json_path)
-    text_list = df.to_dict(orient='records')
+    input_columns = ['url_it', 'presentation_en']
+    if args.gazetteer:
+        input_columns += ['presentation_it', 'title_it', 'title_en']
+    if args.store:
+        # only read the columns the prompts need
+        store = DatasetStore(args.store)
+        text_list = store.read_records(input_columns)
+    else:
+        df = pd.read_json(json_path)
+        text_list = df.to_dict(orient='records')
+    if args.changes:
+        # only annotate the recipes added or modified by the last delta crawl
+        changed_urls = load_changed_urls(args.changes)
+        removed_urls = load_changed_urls(args.changes, keys=('removed',))
+        text_list = [el for el in text_list if el['url_it'] in changed_urls]
+        print(f'Annotating {len(text_list)} changed recipes.')
+    all_text_list = text_list
+    if args.duplicates:
+        # annotate one recipe per near-duplicate cluster and copy its annotation to the others
+        member2rep = load_clusters(args.duplicates)
+        text_list, duplicates = split_duplicates(text_list, member2rep, fields=[el for el in input_columns if el != 'url_it'])
+        print(f'Skipping {len(duplicates)} near-duplicate recipes.')
 
     # model_name = 'meta-llama/Llama-3.1-8B-Instruct'
     model_name = 'meta-llama/Llama-3.3-70B-Instruct'
@@ -29,29 +58,7 @@ def main(args):
     tokenizer.padding_side = 'left'
     eos_token_id_text = tokenizer.decode(tokenizer.eos_token_id)
 
-    if args.load_in_4bit:
-        quantization_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_compute_dtype=torch.float16,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4"
-        )
-    elif args.load_in_8bit:
-        quantization_config = BitsAndBytesConfig(
-            load_in_8bit=True,
-        )
-    else:
-        quantization_config = None
-
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        torch_dtype=torch.float16,
-        device_map="auto",
-        attn_implementation="sdpa",
-        trust_remote_code=True,
-        quantization_config=quantization_config,
-    )
-    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    quantization = quantization_from_args(args)[1]
 
     prompt_layout_dict = {
     'it': """Dimmi di che paese/regione/città è questa <ricetta> culinaria. Rispondi unicamente nel seguente formato: {example_1}. Usa 'UNK' se uno dei livelli non è specificato, per esempio: {example_2}.\n\nConsidera l'esempio seguente:\n\nTesto: {example_text}\n\n#Response: {example_answer}{eos_token_id_text} \n\nOra rispondi unicamente con un solo (1) dizionario (seguito da `{eos_token_id_text}`) per il testo seguente:\n\nTesto:\n\n<{text_sample}>\n\n# Response: """,
@@ -70,51 +77,148 @@ def main(args):
         {"country": "country_name", "region": "region_name", "province": "UNK", "city": "UNK"}'''
         }
 
-    batch_size = 4
-    dict_output_list = []
+    max_new_tokens = 100
+    annotation_keys = set()
     prompt_lang = 'en'
     example_list = json.load(open(f'./misc/examples_{prompt_lang}.json', 'r'))
     example = example_list[0]
     prompt_layout = prompt_layout_dict[prompt_lang]
-    for i in tqdm(range(0, len(text_list), batch_size)):
-        text_batch = text_list[i:i+batch_size]
-        prompt_batch = []
-        for text_sample in text_batch:
-            text_sample = text_sample['presentation_en']#.split('\n')[0]
-            prompt = prompt_layout.format(example_1 = example_dict[prompt_lang],
-                                            example_2 = example_dict_unk[prompt_lang],
-                                            example_text = example['example'],
-                                            example_answer = example['answer'],
-                                            text_sample = text_sample,
-                                            eos_token_id_text=eos_token_id_text,
-                                            )
-            prompt_batch.append(prompt)
-            tokenized_texts = tokenizer(prompt_batch, return_tensors="pt", padding = True, truncation = True).to("cuda")
+    prompt_fields = dict(example_1 = example_dict[prompt_lang],
+                         example_2 = example_dict_unk[prompt_lang],
+                         example_text = example['example'],
+                         example_answer = example['answer'],
+                         eos_token_id_text=eos_token_id_text,
+                         )
+    if args.constrained and args.backend == 'openai':
+        raise ValueError('Constrained decoding needs the model in-process, use --backend hf.')
+    if args.constrained:
+        # only the four-key dict with gazetteer values can be generated, so it always parses
+        # and generation stops right after its closing brace
+        constraint = LocationDictConstraint(tokenizer, load_location_values())
+        max_new_tokens = constraint.max_length
+        print(f'Constrained decoding, at most {max_new_tokens} new tokens.')
+    gazetteer = Gazetteer.from_file() if args.gazetteer else None
+    if args.cache:
+        # skip the texts already annotated with the same model, prompt and decoding settings
+        prompt_template = prompt_layout.format(text_sample = TEXT_SENTINEL, **prompt_fields) + f'\nconstrained={CONSTRAINT_VERSION if args.constrained else 0}'
+        cache = ResultCache(args.cache, model_name, quantization, prompt_template)
+    generate_kwargs = dict(eos_token_id=tokenizer.eos_token_id)
+    if args.prefix_cache:
+        # the instructions before the text are the same for every prompt: prefill them once,
+        # up to the line break before the `<` that opens the text
+        prefix = cacheable_prefix(split_prompt(prompt_layout, **prompt_fields)[0])
+    else:
+        prefix = ''
+        generate_kwargs['cache_implementation'] = "static"
+    logits_processor_fn = None
+    if args.constrained:
+        logits_processor_fn = lambda: [constraint.logits_processor(tokenizer.eos_token_id)]
+    backend = LazyBackend(args, model_name, tokenizer,
+                          max_batch_tokens = args.max_batch_tokens,
+                          max_batch_size = args.max_batch_size,
+                          prefix = prefix,
+                          logits_processor_fn = logits_processor_fn,
+                          **generate_kwargs)
+
+    def annotate(text_list):
+        """Annotates the records of `text_list` in place: with the gazetteer, from the cache, or with the LLM."""
+        llm_list = text_list
+        if gazetteer is not None:
+            # first pass: recipes that name a single comune or region are annotated without the LLM
+            llm_list = []
+            num_regions = 0
+            for record in tqdm(text_list, desc='Gazetteer'):
+                dict_country = gazetteer.resolve(record)
+                if dict_country is None:
+                    llm_list.append(record)
+                    continue
+                record.update(dict_country)
+                annotation_keys.update(dict_country)
+                num_regions += dict_country['city'] == 'UNK'
+            num_gazetteer = len(text_list) - len(llm_list)
+            print(f'Gazetteer: {num_gazetteer} recipes resolved ({num_gazetteer - num_regions} to a city, {num_regions} to a region only).')
+        text_samples = [el['presentation_en'] for el in llm_list]#.split('\n')[0]
+
+        todo_list, todo_samples = llm_list, text_samples
+        if args.cache:
+            cached = cache.get_many(text_samples)
+            todo_list, todo_samples = [], []
+            for record, text_sample in zip(llm_list, text_samples):
+                if text_sample in cached:
+                    record.update(cached[text_sample])
+                    annotation_keys.update(cached[text_sample])
+                else:
+                    todo_list.append(record)
+                    todo_samples.append(text_sample)
+            print(f'{len(llm_list) - len(todo_list)} annotations found in {args.cache}.')
+
+        def on_results(results):
+            batch_results = []
+            for i, dict_string in results:
+                dict_output = todo_list[i]
+                match = re.search(r'\{.*?\}', dict_string, re.DOTALL)
+                dict_string = match.group(0).strip()
+                dict_string = re.sub(r'\s+', ' ', dict_string)
+                print(dict_string, flush=True)
+                dict_country = ast.literal_eval(dict_string)
+                if isinstance(dict_country, dict):
+                    dict_output.update(dict_country)
+                    annotation_keys.update(dict_country)
+                    batch_results.append((todo_samples[i], dict_country))
+                else:
+                    raise TypeError('Evaluated string did not become dict.')
+            if args.cache:
+                # committed batch by batch, so a crash only loses the batch in progress
+                cache.put_many(batch_results)
+
+        if todo_samples:
+            prompt_list = [prompt_layout.format(text_sample = el, **prompt_fields) for el in todo_samples]
+            backend.generate(prompt_list, max_new_tokens, on_results)
+        print(f'Annotated {len(text_list)} recipes: {len(text_list) - len(llm_list)} with the gazetteer, '
+              f'{len(llm_list) - len(todo_list)} from the cache, {len(todo_list)} with the LLM.')
+        return text_list
+
+    if args.work_dir:
+        # this worker annotates the chunks it gets; the one finishing the last chunk writes the output
+        runner = runner_from_args(args, len(text_list), keys=[el['url_it'] for el in text_list])
+        if not runner.run(lambda positions: [{k: v for k, v in el.items() if k in annotation_keys}
+                                             for el in annotate([text_list[i] for i in positions])]):
+            return
+        for record, annotation in zip(text_list, runner.merge()):
+            record.update(annotation)
+            annotation_keys.update(annotation)
+    else:
+        annotate(text_list)
 
-        output = model.generate(**tokenized_texts,
-                                cache_implementation="static",
-                                max_new_tokens = 100,
-                                eos_token_id=tokenizer.eos_token_id)
-        for b in range(output.shape[0]):
-            dict_output = text_batch[b]
-            dict_string = tokenizer.decode(output[b][tokenized_texts['input_ids'].shape[-1]:], skip_special_tokens=True)
-            match = re.search(r'\{.*?\}', dict_string, re.DOTALL)
-            dict_string = match.group(0).strip()
-            dict_string = re.sub(r'\s+', ' ', dict_string)
-            print(dict_string, flush=True)
-            dict_country = ast.literal_eval(dict_string)
-            if isinstance(dict_country, dict):
-                dict_output.update(dict_country)
-            else:
-                raise TypeError('Evaluated string did not become dict.')
-            dict_output_list.append(dict_output)
+    # the records were annotated in place, so the outputs are in the original order
+    dict_output_list = text_list
+    if args.duplicates:
+        copy_to_duplicates(dict_output_list, duplicates, member2rep, annotation_keys)
+        dict_output_list = all_text_list
 
-    with open(json_path.replace('.json', f"_{model_name.split('/')[-1]}.json"), 'w', encoding='utf8') as f:
+    if args.store:
+        # write back only the annotation columns; with --changes the other rows' annotations are kept
+        store.add_columns(model_name.split('/')[-1], [{k: v for k, v in el.items() if k not in input_columns} for el in dict_output_list])
+        return
+    save_path = json_path.replace('.json', f"_{model_name.split('/')[-1]}.json")
+    if args.changes and os.path.exists(save_path):
+        previous = [el for el in load_json(save_path) if el['url_it'] not in changed_urls | removed_urls]
+        dict_output_list = previous + dict_output_list
+    with open(save_path, 'w', encoding='utf8') as f:
         json.dump(dict_output_list, f, ensure_ascii = False, indent = 4)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Annotate the gz dataset with an LLM")
-    parser.add_argument("--load_in_4bit", help="Whether to load the model in 4-bit quantization.", default=0)
-    parser.add_argument("--load_in_8bit", help="Whether to load the model in 8-bit quantization.", default=0)
+    add_backend_args(parser)
+    parser.add_argument("--prefix_cache", type=int, help="Whether to compute the KV cache of the instructions shared by all prompts once.", default=1)
+    parser.add_argument("--constrained", type=int, help="Whether to constrain the output to the location dict, with values from the gazetteers in misc/.", default=0)
+    parser.add_argument("--max_batch_tokens", type=int, help="Max padded tokens per batch, prompts plus new tokens.", default=8192)
+    parser.add_argument("--max_batch_size", type=int, help="Max prompts per batch.", default=16)
+    parser.add_argument("--gazetteer", type=int, help="Experimental: whether to first annotate the recipes that name a single comune/region of misc/italy_locs.json without the LLM. Off by default: it resolves 0/589 titles of misc/gold_regions.json and 0/93 dishes of misc/world_cuisines_italy.json, since origins are mostly given by adjectives (\"cucina piemontese\", \"alla bolognese\"), which it does not match, and it has not been checked against LLM labels on the corpus; measure it with `python src/annotate/gazetteer.py` first.", default=0)
+    parser.add_argument("--cache", help="SQLite file of finished annotations, to skip the texts already annotated; '' to disable.", default='./data/annotation_cache.sqlite')
+    parser.add_argument("--store", help="Dataset store to read the recipes from and add the annotations to, instead of JSON files.", default='')
+    parser.add_argument("--duplicates", help="Cluster file from `dedup.py`, to only annotate one recipe per near-duplicate cluster.", default='')
+    parser.add_argument("--changes", help="Change manifest from `scrape.py --delta`, to only annotate added/modified recipes.", default='')
+    add_runner_args(parser)
     args = parser.parse_args()
     main(args)
\ No newline at end of file
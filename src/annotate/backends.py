@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+from typing import Callable, List, Tuple, Union
+import aiohttp
+import torch
+from tqdm.auto import tqdm
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig, LogitsProcessorList, StoppingCriteriaList
+import sys
+sys.path.append('.')
+from src.annotate.batching import token_budget_batches, padding_efficiency
+from src.annotate.prefix_cache import PrefixCachedGenerator
+
+# called with the (prompt index, generated text) pairs of each finished batch or request
+ResultsCallback = Callable[[List[Tuple[int, str]]], None]
+
+class HFBackend:
+    """Generates in-process with a loaded HF model, in batches of similar length under a token budget.
+
+    With `prefix`, which every prompt must start with, its KV cache is computed once (`PrefixCachedGenerator`),
+    unless the prompts are not tokenized as the prefix tokens followed by the rest.
+    `logits_processor_fn` makes the logits processors of each `generate` call, e.g. for constrained decoding,
+    and `stopping_criteria_fn` the stopping criteria of each batch, from the indices of its prompts.
+    """
+    def __init__(self,
+                 model,
+                 tokenizer,
+                 max_batch_tokens: int = 8192,
+                 max_batch_size: int = 16,
+                 prefix: str = '',
+                 logits_processor_fn: Callable = None,
+                 stopping_criteria_fn: Callable[[List[int]], List] = None,
+                 **generate_kwargs,
+                 ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.generator = PrefixCachedGenerator(model, tokenizer, prefix) if prefix else None
+        self.logits_processor_fn = logits_processor_fn
+        self.stopping_criteria_fn = stopping_criteria_fn
+        self.generate_kwargs = generate_kwargs
+
+    def encode(self, prompts: List[str]) -> List[List[int]]:
+        if not prompts:
+            return []
+        if self.generator is not None:
+            ids_list = self.generator.encode(prompts)
+            if None not in ids_list:
+                return ids_list
+            # the tokenizer merges the end of the prefix with the text, so the cache would change the inputs
+            print('The prompts are not tokenized as the prefix tokens followed by the rest, generating without the prefix cache.', flush=True)
+            self.generator = None
+        # tokenize each prompt once, then pad each batch of similar lengths to its own longest prompt
+        return self.tokenizer(prompts, truncation = True).input_ids
+
+    def generate(self, prompts: List[str], max_new_tokens: Union[int, List[int]], on_results: ResultsCallback = None) -> List[str]:
+        """`max_new_tokens` can be given per prompt, in which case prompts are batched by length plus
+        budget, and each batch generates up to the largest budget in it."""
+        ids_list = self.encode(prompts)
+        prefix_len = self.generator.prefix_ids.shape[-1] if self.generator is not None else 0
+        lengths = [len(el) for el in ids_list]
+        if isinstance(max_new_tokens, int):
+            budgets = [max_new_tokens] * len(prompts)
+            batches = token_budget_batches(lengths, self.max_batch_tokens, self.max_batch_size, extra_tokens=prefix_len + max_new_tokens)
+        else:
+            budgets = max_new_tokens
+            batches = token_budget_batches([a + b for a, b in zip(lengths, budgets)], self.max_batch_tokens, self.max_batch_size, extra_tokens=prefix_len)
+        print(f'{len(prompts)} prompts in {len(batches)} batches, padding efficiency {padding_efficiency(lengths, batches):.1%}')
+        outputs = [None] * len(prompts)
+        for batch in tqdm(batches):
+            generate_kwargs = dict(self.generate_kwargs, max_new_tokens = max([budgets[i] for i in batch]))
+            if self.logits_processor_fn is not None:
+                generate_kwargs['logits_processor'] = LogitsProcessorList(self.logits_processor_fn())
+            if self.stopping_criteria_fn is not None:
+                generate_kwargs['stopping_criteria'] = StoppingCriteriaList(self.stopping_criteria_fn(batch))
+            if self.generator is not None:
+                output = self.generator.generate([ids_list[i] for i in batch], **generate_kwargs)
+            else:
+                tokenized_texts = self.tokenizer.pad({'input_ids': [ids_list[i] for i in batch]},
+                                                     padding = True,
+                                                     return_tensors = "pt").to(self.model.device)
+                with torch.no_grad():
+                    output = self.model.generate(**tokenized_texts, **generate_kwargs)
+                output = output[:, tokenized_texts['input_ids'].shape[-1]:]
+            results = [(i, self.tokenizer.decode(output[b], skip_special_tokens=True)) for b, i in enumerate(batch)]
+            for i, text in results:
+                outputs[i] = text
+            if on_results is not None:
+                on_results(results)
+        return outputs
+
+class OpenAIBackend:
+    """Async client of an OpenAI-compatible completions server (vLLM, TGI, llama.cpp, `mock_server.py`).
+
+    Up to `max_concurrency` requests are in flight at once, so that a server doing continuous batching
+    stays saturated, and several jobs can share the model it has loaded. Prompts are sent as raw text,
+    so chat templates are applied by the caller, as with `HFBackend`.
+    """
+    def __init__(self,
+                 url: str,
+                 model_name: str,
+                 max_concurrency: int = 64,
+                 timeout: float = 600,
+                 max_retries: int = 3,
+                 retry_wait: float = 1.0,
+                 **request_kwargs,
+                 ):
+        self.url = url.rstrip('/') + '/v1/completions'
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        # greedy, like the in-process generation
+        self.request_kwargs = {'temperature': 0, **request_kwargs}
+
+    async def complete(self, session, semaphore, prompt: str, max_new_tokens: int) -> str:
+        payload = dict(self.request_kwargs, model = self.model_name, prompt = prompt, max_tokens = max_new_tokens)
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with session.post(self.url, json = payload) as response:
+                        response.raise_for_status()
+                        return (await response.json())['choices'][0]['text']
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    print(f'Request failed ({e}), retrying...', flush=True)
+                    await asyncio.sleep(self.retry_wait * 2 ** attempt)
+
+    async def generate_async(self, prompts: List[str], max_new_tokens: Union[int, List[int]], on_results: ResultsCallback = None) -> List[str]:
+        budgets = [max_new_tokens] * len(prompts) if isinstance(max_new_tokens, int) else max_new_tokens
+
+        async def complete_indexed(session, semaphore, i):
+            return i, await self.complete(session, semaphore, prompts[i], budgets[i])
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        outputs = [None] * len(prompts)
+        async with aiohttp.ClientSession(timeout = aiohttp.ClientTimeout(total = self.timeout)) as session:
+            tasks = [asyncio.ensure_future(complete_indexed(session, semaphore, i)) for i in range(len(prompts))]
+            try:
+                for task in tqdm(asyncio.as_completed(tasks), total = len(tasks)):
+                    i, text = await task
+                    outputs[i] = text
+                    if on_results is not None:
+                        on_results([(i, text)])
+            finally:
+                for task in tasks:
+                    task.cancel()
+        return outputs
+
+    def generate(self, prompts: List[str], max_new_tokens: Union[int, List[int]], on_results: ResultsCallback = None) -> List[str]:
+        return asyncio.run(self.generate_async(prompts, max_new_tokens, on_results))
+
+def add_backend_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--load_in_4bit", help="Whether to load the model in 4-bit quantization.", default=0)
+    parser.add_argument("--load_in_8bit", help="Whether to load the model in 8-bit quantization.", default=0)
+    parser.add_argument("--backend", choices=['hf', 'openai'], help="Generate with the model loaded in-process, or with an OpenAI-compatible server.", default='hf')
+    parser.add_argument("--server_url", help="URL of the OpenAI-compatible server, with --backend openai.", default='http://localhost:8000')
+    parser.add_argument("--max_concurrency", type=int, help="Max requests in flight to the server, with --backend openai.", default=64)
+
+def quantization_from_args(args) -> Tuple[BitsAndBytesConfig, str]:
+    """The BitsAndBytes config of `--load_in_4bit`/`--load_in_8bit`, and its name for the result cache keys."""
+    if args.backend == 'openai':
+        # the model is loaded however the server was started
+        return None, 'server'
+    if args.load_in_4bit:
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4"
+        )
+        return quantization_config, '4bit'
+    if args.load_in_8bit:
+        return BitsAndBytesConfig(load_in_8bit=True), '8bit'
+    return None, 'fp16'
+
+class LazyBackend:
+    """The backend of `add_backend_args`, built on the first `generate`, so that with every text cached
+    the model is not even loaded. `hf_kwargs` go to `HFBackend`."""
+    def __init__(self, args, model_name: str, tokenizer, **hf_kwargs):
+        self.args = args
+        self.model_name = model_name
+        self.tokenizer = tokenizer
+        self.hf_kwargs = hf_kwargs
+        self.backend = None
+
+    def build(self):
+        if self.args.backend == 'openai':
+            # the server keeps the model loaded and batches the requests of all the jobs sharing it
+            return OpenAIBackend(self.args.server_url, self.model_name, max_concurrency = self.args.max_concurrency)
+        model = AutoModelForCausalLM.from_pretrained(
+            self.model_name,
+            torch_dtype=torch.float16,
+            device_map="auto",
+            attn_implementation="sdpa",
+            trust_remote_code=True,
+            quantization_config=quantization_from_args(self.args)[0],
+        )
+        model.generation_config.pad_token_id = self.tokenizer.pad_token_id
+        return HFBackend(model, self.tokenizer, **self.hf_kwargs)
+
+    def generate(self, prompts: List[str], max_new_tokens: Union[int, List[int]], on_results: ResultsCallback = None) -> List[str]:
+        if self.backend is None:
+            self.backend = self.build()
+        return self.backend.generate(prompts, max_new_tokens, on_results)
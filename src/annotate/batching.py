@@ -0,0 +1,35 @@
+from typing import List
+
+def token_budget_batches(lengths: List[int],
+                         max_tokens: int,
+                         max_batch_size: int = 64,
+                         extra_tokens: int = 0,
+                         ) -> List[List[int]]:
+    """Packs the indices of sequences with `lengths` into batches of similar length.
+
+    Sequences are sorted longest first (so an out-of-memory batch shows up at the start) and a batch
+    grows while `batch size * (longest length + extra_tokens)`, i.e. its padded size including e.g. the
+    tokens to generate, stays within `max_tokens`. A sequence longer than the budget gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    batch = []
+    longest = 0
+    for i in order:
+        # sorted longest first: the first sequence of a batch sets its padded length
+        padded = max(longest, lengths[i]) + extra_tokens
+        if batch and (len(batch) >= max_batch_size or (len(batch) + 1) * padded > max_tokens):
+            batches.append(batch)
+            batch = []
+            longest = 0
+        batch.append(i)
+        longest = max(longest, lengths[i])
+    if batch:
+        batches.append(batch)
+    return batches
+
+def padding_efficiency(lengths: List[int], batches: List[List[int]]) -> float:
+    """Fraction of the padded batch tokens that are real tokens."""
+    real = sum([lengths[i] for batch in batches for i in batch])
+    padded = sum([len(batch) * max([lengths[i] for i in batch]) for batch in batches])
+    return real / padded if padded else 1.0
@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import time
+import torch
+import sys
+sys.path.append('.')
+from src.utils import prompt_layout_dict, load_json
+from src.annotate.prefix_cache import split_prompt, cacheable_prefix
+from src.annotate.backends import HFBackend, OpenAIBackend
+from src.annotate.mock_server import MockCompletionServer, start_server
+from src.annotate.bench_utils import make_tokenizer, make_llama
+
+async def run_openai(args, prompts, response):
+    server = MockCompletionServer(response, max_batch_size=args.server_batch_size, step_time=args.step_time, fail_every=args.fail_every)
+    runner = await start_server(server, port=args.port)
+    timings = {}
+    try:
+        for max_concurrency in [1, args.max_concurrency]:
+            backend = OpenAIBackend(f'http://127.0.0.1:{args.port}', 'mock', max_concurrency=max_concurrency, max_retries=5, retry_wait=0.01)
+            done = []
+            start = time.perf_counter()
+            outputs = await backend.generate_async(prompts, args.max_new_tokens, on_results=done.extend)
+            timings[max_concurrency] = time.perf_counter() - start
+            if outputs != [response] * len(prompts) or sorted([i for i, _ in done]) != list(range(len(prompts))):
+                print(f"Unexpected outputs with max_concurrency={max_concurrency}", flush=True)
+                sys.exit(1)
+    finally:
+        await runner.cleanup()
+    return timings, server.max_in_flight
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the inference backends of annotate_locs: HF in-process on a tiny random LM, and the async client against the mock server")
+    parser.add_argument("--num_texts", type=int, help="Number of texts to annotate", default=64)
+    parser.add_argument("--max_new_tokens", type=int, help="Tokens to generate per text", default=20)
+    parser.add_argument("--max_concurrency", type=int, help="Requests in flight with the async client", default=32)
+    parser.add_argument("--server_batch_size", type=int, help="Requests the mock server decodes together", default=32)
+    parser.add_argument("--step_time", type=float, help="Seconds per decoding step of the mock server", default=0.005)
+    parser.add_argument("--fail_every", type=int, help="Make every n-th request to the mock server fail, 0 for never", default=10)
+    parser.add_argument("--port", type=int, help="Port of the mock server", default=8765)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    examples = load_json('./misc/examples_en.json')
+    texts = [(el['example'] + ' ') * (1 + i % 3) for i, el in enumerate(examples * args.num_texts)][:args.num_texts]
+    fields = dict(example_1='{"country": "UNK"}',
+                  example_2='{"country": "UNK"}',
+                  example_text=examples[0]['example'],
+                  example_answer=examples[0]['answer'],
+                  eos_token_id_text='</s>',
+                  )
+    prompts = [prompt_layout_dict['en'].format(text_sample=el, **fields) for el in texts]
+    # the prefix is cached up to its last line break, as in annotate_locs
+    prefix = cacheable_prefix(split_prompt(prompt_layout_dict['en'], **fields)[0])
+    tokenizer = make_tokenizer(prompts)
+    tokenizer.padding_side = 'left'
+    model = make_llama(tokenizer)
+
+    outputs = {}
+    for name, backend_prefix in [('without prefix cache', ''), ('with prefix cache', prefix)]:
+        backend = HFBackend(model, tokenizer, max_batch_tokens=4096, prefix=backend_prefix, do_sample=False,
+                            pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id)
+        start = time.perf_counter()
+        outputs[name] = backend.generate(prompts, args.max_new_tokens)
+        print(f"HF backend {name}: {time.perf_counter() - start:.2f} s, prefix cache used: {backend.generator is not None}")
+    num_equal = sum([a == b for a, b in zip(*outputs.values())])
+    print(f"HF backend: {num_equal}/{len(prompts)} outputs equal with and without prefix cache")
+
+    response = '{"country": "Italy", "region": "Lazio", "province": "Roma", "city": "Roma"}'
+    timings, max_in_flight = asyncio.run(run_openai(args, prompts, response))
+    print(f"OpenAI backend: all outputs match, up to {max_in_flight} requests decoded together by the mock server")
+    for max_concurrency, elapsed in timings.items():
+        print(f"OpenAI backend, {max_concurrency} requests in flight: {elapsed:.2f} s")
+
+if __name__ == "__main__":
+    main()
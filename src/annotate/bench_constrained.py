@@ -0,0 +1,110 @@
+import argparse
+import ast
+import json
+import random
+import re
+import time
+import torch
+from transformers import LogitsProcessorList
+import sys
+sys.path.append('.')
+from src.utils import prompt_layout_dict, load_json
+from src.annotate.bench_utils import make_tokenizer, make_llama
+from src.annotate.prefix_cache import PrefixCachedGenerator, split_prompt, cacheable_prefix
+from src.annotate.constrained import LocationDictConstraint, load_location_values, LOC_KEYS, UNK, EMPTY
+
+def parse(dict_string):
+    # what annotate_locs does with an output
+    match = re.search(r'\{.*?\}', dict_string, re.DOTALL)
+    if match is None:
+        return None
+    try:
+        dict_country = ast.literal_eval(re.sub(r'\s+', ' ', match.group(0).strip()))
+    except (ValueError, SyntaxError):
+        return None
+    return dict_country if isinstance(dict_country, dict) else None
+
+def random_values(values, rng):
+    # an allowed location, naming each level with probability 0.8
+    output, node = [], values
+    for key in LOC_KEYS:
+        names = [el for el in node if el != UNK]
+        value = rng.choice(names) if names and rng.random() < 0.8 else UNK
+        output.append(value)
+        node = node.get(value, EMPTY)
+    return output
+
+def is_allowed(output_dict, values):
+    node = values
+    for key in LOC_KEYS:
+        if output_dict[key] != UNK and output_dict[key] not in node:
+            return False
+        node = node.get(output_dict[key], EMPTY)
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that constrained decoding in annotate_locs only gives valid location dicts on a tiny random LM, and times it")
+    parser.add_argument("--num_texts", type=int, help="Number of texts to annotate", default=32)
+    parser.add_argument("--batch_size", type=int, help="Texts per batch", default=8)
+    parser.add_argument("--max_new_tokens", type=int, help="Tokens to generate per text without constraint", default=100)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    examples = load_json('./misc/examples_en.json')
+    values = load_location_values()
+    texts = [(el['example'] + ' ') * (1 + i % 3) for i, el in enumerate(examples * args.num_texts)][:args.num_texts]
+    prefix, suffix = split_prompt(prompt_layout_dict['en'],
+                                  example_1='{"country": "Italy", "region": "UNK", "province": "UNK", "city": "UNK"}',
+                                  example_2='{"country": "UNK", "region": "UNK", "province": "UNK", "city": "UNK"}',
+                                  example_text=examples[0]['example'],
+                                  example_answer=examples[0]['answer'],
+                                  eos_token_id_text='</s>',
+                                  )
+    rng = random.Random(0)
+    locations = [dict(zip(LOC_KEYS, random_values(values, rng))) for _ in range(2000)]
+    tokenizer = make_tokenizer([prefix, suffix] + texts + [json.dumps(el, ensure_ascii=False) for el in locations])
+    model = make_llama(tokenizer)
+
+    generator = PrefixCachedGenerator(model, tokenizer, cacheable_prefix(prefix))
+    ids_list = generator.encode([prefix + el + suffix for el in texts])
+    start = time.perf_counter()
+    constraint = LocationDictConstraint(tokenizer, values)
+    print(f"Built the tries in {time.perf_counter() - start:.2f} s, at most {constraint.max_length} new tokens")
+
+    # the tries hold the tokens of the whole dict, so that the model can write it the way it learned to
+    num_canonical = 0
+    for location in locations[:500]:
+        segments = [constraint.segment(-1, None)] + [constraint.segment(i, location[key]) for i, key in enumerate(LOC_KEYS)]
+        num_canonical += sum(constraint.encode(segments), []) == constraint.encode([''.join(segments)])[0]
+    print(f"{num_canonical}/500 location dicts tokenized the same by segments as whole")
+    if num_canonical != 500:
+        sys.exit(1)
+
+    results = {}
+    for constrained in [False, True]:
+        start = time.perf_counter()
+        outputs = []
+        for i in range(0, len(ids_list), args.batch_size):
+            generate_kwargs = dict(max_new_tokens=args.max_new_tokens, do_sample=False, pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id)
+            if constrained:
+                generate_kwargs['max_new_tokens'] = constraint.max_length
+                generate_kwargs['logits_processor'] = LogitsProcessorList([constraint.logits_processor(tokenizer.eos_token_id)])
+            outputs += list(generator.generate(ids_list[i:i + args.batch_size], **generate_kwargs))
+        elapsed = time.perf_counter() - start
+        dicts = [parse(tokenizer.decode(el, skip_special_tokens=True)) for el in outputs]
+        num_tokens = sum([int((el != 0).sum()) for el in outputs])
+        results[constrained] = dicts
+        print(f"{'Constrained' if constrained else 'Unconstrained'}: {elapsed:.2f} s, {num_tokens / len(outputs):.1f} new tokens per text, "
+              f"{sum([el is None for el in dicts])}/{len(dicts)} parse failures")
+
+    for output_dict in results[True]:
+        if output_dict is None or tuple(output_dict) != LOC_KEYS:
+            print(f"Constrained output is not a location dict: {output_dict}", flush=True)
+            sys.exit(1)
+        if not is_allowed(output_dict, values):
+            print(f"Constrained output has a value not in the gazetteers, or not in the one before: {output_dict}", flush=True)
+            sys.exit(1)
+    print(f"All constrained outputs are valid, e.g. {json.dumps(results[True][0], ensure_ascii=False)}")
+
+if __name__ == "__main__":
+    main()
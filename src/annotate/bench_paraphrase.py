@@ -0,0 +1,69 @@
+import argparse
+import time
+import torch
+import sys
+sys.path.append('.')
+from src.utils import load_json
+from src.annotate.backends import HFBackend
+from src.annotate.bench_utils import make_tokenizer, make_llama
+from src.annotate.step_lists import count_steps, step_budget, parse_step_list, StepCountStoppingCriteria
+
+def check_stopping(tokenizer, num_steps: int = 3) -> bool:
+    # feeds a list with one item too many token by token: it should stop right after the last expected item
+    items = [f'{i + 1}. Cut the onion and fry it for {i + 2} minutes' for i in range(num_steps + 1)]
+    target = '\n'.join(items)
+    ids = tokenizer(target, add_special_tokens=False, return_tensors='pt').input_ids
+    criteria = StepCountStoppingCriteria(tokenizer, [num_steps])
+    prompt = torch.tensor([[tokenizer.bos_token_id]])
+    for n in range(1, ids.shape[-1] + 1):
+        if criteria(torch.cat([prompt, ids[:, :n]], dim=-1), None)[0]:
+            text = tokenizer.decode(ids[0, :n])
+            return text.rstrip('\n') == '\n'.join(items[:num_steps]) and parse_step_list(text) == [el[3:] for el in items[:num_steps]]
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Times paraphrase_steps with one prompt per batch and a fixed max_new_tokens against per-recipe budgets in batches, on a tiny random LM")
+    parser.add_argument("--num_texts", type=int, help="Number of recipes", default=32)
+    parser.add_argument("--max_new_tokens", type=int, help="Fixed tokens to generate per recipe, as before", default=300)
+    parser.add_argument("--max_batch_tokens", type=int, help="Max padded tokens per batch", default=16384)
+    parser.add_argument("--max_batch_size", type=int, help="Max prompts per batch", default=16)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    sentences = [el['example'] for el in load_json('./misc/examples_en.json')]
+    texts = []
+    for i in range(args.num_texts):
+        # 1 to 6 steps of a sentence or two each, like the scraped ones
+        num_steps = 1 + i % 6
+        texts.append(' '.join([f'<{n + 1}> ' + ' '.join(sentences[(i + n) % len(sentences)].split()[:20 + 15 * ((i + n) % 2)]) for n in range(num_steps)]))
+    prompts = [f'Make a numbered list of the steps.\n\n{el}\n\n' for el in texts]
+    tokenizer = make_tokenizer(prompts + ['\n'.join([f'{n}. step' for n in range(1, 20)])])
+    tokenizer.padding_side = 'left'
+
+    if not check_stopping(tokenizer):
+        print('The stopping criteria did not stop right after the expected items', flush=True)
+        sys.exit(1)
+    print('Stopping criteria: stops right after the expected number of items, which parse back to a list')
+
+    model = make_llama(tokenizer)
+
+    expected_steps = [count_steps(el) for el in texts]
+    num_input_tokens = [len(el) for el in tokenizer(texts, add_special_tokens=False).input_ids]
+    budgets = [step_budget(n, s, args.max_new_tokens) for n, s in zip(num_input_tokens, expected_steps)]
+    print(f'{sum(budgets)} new tokens budgeted instead of {args.max_new_tokens * len(budgets)}')
+
+    runs = [
+        ('one prompt per batch, fixed max_new_tokens', HFBackend(model, tokenizer, max_batch_size=1, do_sample=False,
+                                                                pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id), args.max_new_tokens),
+        ('batched by budget', HFBackend(model, tokenizer, max_batch_tokens=args.max_batch_tokens, max_batch_size=args.max_batch_size, do_sample=False,
+                                        pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id,
+                                        stopping_criteria_fn=lambda batch: [StepCountStoppingCriteria(tokenizer, [expected_steps[i] for i in batch])]), budgets),
+    ]
+    for name, backend, max_new_tokens in runs:
+        start = time.perf_counter()
+        backend.generate(prompts, max_new_tokens)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {elapsed:.2f} s, {len(prompts) / elapsed:.1f} recipes/s')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import time
+import torch
+import sys
+sys.path.append('.')
+from src.utils import prompt_layout_dict, load_json
+from src.annotate.bench_utils import make_tokenizer, make_llama
+from src.annotate.prefix_cache import PrefixCachedGenerator, split_prompt, cacheable_prefix
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that the prompt prefix cache of annotate_locs gives the same outputs on a tiny random LM, and times it")
+    parser.add_argument("--num_texts", type=int, help="Number of texts to annotate", default=32)
+    parser.add_argument("--batch_size", type=int, help="Texts per batch", default=8)
+    parser.add_argument("--max_new_tokens", type=int, help="Tokens to generate per text", default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    examples = load_json('./misc/examples_en.json')
+    texts = [(el['example'] + ' ') * (1 + i % 3) for i, el in enumerate(examples * args.num_texts)][:args.num_texts]
+    prefix, suffix = split_prompt(prompt_layout_dict['en'],
+                                  example_1='{"country": "UNK"}',
+                                  example_2='{"country": "UNK"}',
+                                  example_text=examples[0]['example'],
+                                  example_answer=examples[0]['answer'],
+                                  eos_token_id_text='</s>',
+                                  )
+    prompts = [prefix + el + suffix for el in texts]
+    # the pre-tokenizer of Llama 3 merges the `<` ending the prompt prefix with the text
+    tokenizer = make_tokenizer(prompts)
+    model = make_llama(tokenizer)
+
+    num_split = sum([el is not None for el in PrefixCachedGenerator(model, tokenizer, prefix).encode(prompts)])
+    generator = PrefixCachedGenerator(model, tokenizer, cacheable_prefix(prefix))
+    ids_list = generator.encode(prompts)
+    print(f"Prompts tokenized as prefix tokens + the rest: {num_split}/{len(prompts)} with the whole prefix, "
+          f"{sum([el is not None for el in ids_list])}/{len(prompts)} up to its last line break")
+    if None in ids_list:
+        sys.exit(1)
+    # the same tokens as the whole prompts
+    if [tokenizer(el).input_ids for el in prompts] != [generator.prefix_ids[0].tolist() + el for el in ids_list]:
+        print("Prompt tokens differ with the prefix cache", flush=True)
+        sys.exit(1)
+    generate_kwargs = dict(max_new_tokens=args.max_new_tokens, do_sample=False, pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id)
+    timings = {}
+    outputs = {}
+    for use_cache in [False, True]:
+        start = time.perf_counter()
+        outputs[use_cache] = [generator.generate(ids_list[i:i + args.batch_size], use_cache=use_cache, **generate_kwargs)
+                              for i in range(0, len(ids_list), args.batch_size)]
+        timings[use_cache] = time.perf_counter() - start
+    for a, b in zip(outputs[False], outputs[True]):
+        if not torch.equal(a, b):
+            print("Outputs differ with the prefix cache", flush=True)
+            sys.exit(1)
+    prefix_len = generator.prefix_ids.shape[-1]
+    text_len = sum([len(el) for el in ids_list]) / len(ids_list)
+    print(f"Outputs match. Prefix: {prefix_len} tokens, texts: {text_len:.0f} tokens on average")
+    print(f"Without cache: {timings[False]:.2f} s, with cache: {timings[True]:.2f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import shutil
+import tempfile
+import time
+import torch
+from transformers import M2M100Config, M2M100ForConditionalGeneration, T5Config, T5ForConditionalGeneration
+import sys
+sys.path.append('.')
+from src.utils import load_json
+from src.annotate.translate import Translator, split_sentences, nllb_code2lang
+from src.annotate.bench_utils import make_tokenizer
+
+def translate_per_sample(translator: Translator, data):
+    # what run_nllb did before: one generate call per sample, on its own sentences
+    translations = []
+    for sample in data:
+        ids_batch = translator.tokenizer(split_sentences(sample), truncation=True).input_ids
+        with torch.no_grad():
+            translations.append(' '.join(translator.run_nllb(ids_batch)))
+    return translations
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the pooled sentence batches and translation memory of translate.py against one generate call per sample, on a tiny random NLLB-like model")
+    parser.add_argument("--num_texts", type=int, help="Number of samples", default=64)
+    parser.add_argument("--batch_size", type=int, help="Max sentences per batch", default=64)
+    parser.add_argument("--max_batch_tokens", type=int, help="Max padded source tokens per batch", default=4096)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    sentences = [el.strip() for example in load_json('./misc/examples_en.json') for el in example['example'].split('.') if el.strip()]
+    # samples share boilerplate sentences, as the presentations of a recipe site do
+    boilerplate = ['Buon appetito', 'Scopri la ricetta', 'Ecco come prepararla a casa']
+    data = []
+    for i in range(args.num_texts):
+        body = [f'{sentences[(i * 3 + n) % len(sentences)]} {i}' for n in range(2 + i % 5)]
+        data.append('. '.join(body + boilerplate[:1 + i % len(boilerplate)]) + '.')
+    tokenizer = make_tokenizer(data, special_tokens=list(nllb_code2lang.values()))
+    config = M2M100Config(vocab_size=len(tokenizer), d_model=64, encoder_layers=2, decoder_layers=2, encoder_attention_heads=4,
+                          decoder_attention_heads=4, encoder_ffn_dim=128, decoder_ffn_dim=128, max_position_embeddings=1024,
+                          pad_token_id=tokenizer.pad_token_id, bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+                          decoder_start_token_id=tokenizer.eos_token_id)
+    model = M2M100ForConditionalGeneration(config).eval()
+    model.name_or_path = 'tiny-nllb'
+
+    num_sentences = sum([len(split_sentences(el)) for el in data])
+    translator = Translator(model, tokenizer, args.batch_size, 'it', 'en', max_batch_tokens=args.max_batch_tokens)
+    start = time.perf_counter()
+    translate_per_sample(translator, data)
+    elapsed = time.perf_counter() - start
+    print(f'One generate call per sample: {elapsed:.2f} s, {num_sentences / elapsed:.1f} sentences/s')
+
+    start = time.perf_counter()
+    translator.translate(data)
+    elapsed = time.perf_counter() - start
+    print(f'Pooled sentence batches with translation memory: {elapsed:.2f} s, {num_sentences / elapsed:.1f} sentences/s')
+
+    # a random model never stops before max_length, which depends on the batch, so outputs cannot be compared:
+    # the scheduling and reassembly are checked with a model echoing its input instead
+    echo = Translator(model, tokenizer, args.batch_size, 'it', 'en', max_batch_tokens=args.max_batch_tokens)
+    echo.run_model = lambda ids_batch: tokenizer.batch_decode(ids_batch, skip_special_tokens=True)
+    echoed = echo.translate(data)
+    # the translations of the sentences of a sample are joined with single spaces
+    num_equal = sum([a.split() == ' '.join(split_sentences(b)).split() for a, b in zip(echoed, data)])
+    print(f'{num_equal}/{len(data)} samples reassembled in order by the echoing model')
+
+    # preempted after `preempt_after` batches, then restarted on the same stream_dir
+    stream_dir = tempfile.mkdtemp()
+    preempt_after = 2
+    try:
+        interrupted = Translator(model, tokenizer, 8, 'it', 'en', max_batch_tokens=args.max_batch_tokens, stream_dir=stream_dir)
+        num_batches = []
+
+        def preempted(ids_batch):
+            if len(num_batches) == preempt_after:
+                raise KeyboardInterrupt
+            num_batches.append(len(ids_batch))
+            return tokenizer.batch_decode(ids_batch, skip_special_tokens=True)
+        interrupted.run_model = preempted
+        try:
+            interrupted.translate(data)
+        except KeyboardInterrupt:
+            pass
+        resumed = Translator(model, tokenizer, 8, 'it', 'en', max_batch_tokens=args.max_batch_tokens, stream_dir=stream_dir)
+        num_resumed = []
+        resumed.run_model = lambda ids_batch: num_resumed.append(len(ids_batch)) or tokenizer.batch_decode(ids_batch, skip_special_tokens=True)
+        resumed_output = resumed.translate(data)
+        resumed.close()
+    finally:
+        shutil.rmtree(stream_dir)
+    print(f'Resumed after {preempt_after} batches: {sum(num_batches)} sentences recovered from the stream, {sum(num_resumed)} left to translate, '
+          f'output equal to the uninterrupted one: {resumed_output == echoed}')
+
+    # MADLAD: target language token before the source, decoded to text like NLLB
+    madlad_tokenizer = make_tokenizer(data, special_tokens=['<2en>'])
+    madlad_config = T5Config(vocab_size=len(madlad_tokenizer), d_model=64, d_kv=16, d_ff=128, num_layers=2, num_heads=4,
+                             pad_token_id=madlad_tokenizer.pad_token_id, eos_token_id=madlad_tokenizer.eos_token_id,
+                             decoder_start_token_id=madlad_tokenizer.pad_token_id)
+    madlad_model = T5ForConditionalGeneration(madlad_config).eval()
+    madlad_model.name_or_path = 'tiny-madlad'
+    for num_beams in [1, 5]:
+        madlad = Translator(madlad_model, madlad_tokenizer, args.batch_size, 'it', 'en', max_batch_tokens=args.max_batch_tokens, num_beams=num_beams)
+        start = time.perf_counter()
+        madlad_output = madlad.translate(data[:8])
+        elapsed = time.perf_counter() - start
+        print(f'MADLAD-like model, num_beams={num_beams}: {len(madlad_output)} texts decoded in {elapsed:.2f} s, all strings: {all([isinstance(el, str) for el in madlad_output])}')
+
+if __name__ == "__main__":
+    main()
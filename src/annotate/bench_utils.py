@@ -0,0 +1,25 @@
+from typing import List
+from tokenizers import Tokenizer, Regex, models, pre_tokenizers, decoders, trainers
+from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+
+# the pre-tokenizer split of Llama 3
+LLAMA3_PATTERN = r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"
+
+def make_tokenizer(texts: List[str], special_tokens: List[str] = [], vocab_size: int = 4000) -> PreTrainedTokenizerFast:
+    """A small byte-level BPE like Llama 3's, trained on `texts`, so that no tokenizer has to be downloaded
+    and the benchmarks still see its token boundaries (e.g. `<` merged with the word after it)."""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([pre_tokenizers.Split(Regex(LLAMA3_PATTERN), behavior='isolated'),
+                                                       pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False)])
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=['<pad>', '<s>', '</s>'] + special_tokens,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(texts, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token='<pad>', bos_token='<s>', eos_token='</s>')
+
+def make_llama(tokenizer) -> LlamaForCausalLM:
+    """A tiny random Llama with the vocabulary and special tokens of `tokenizer`."""
+    config = LlamaConfig(vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, pad_token_id=tokenizer.pad_token_id,
+                         bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id)
+    return LlamaForCausalLM(config).eval()
@@ -4,18 +4,43 @@ import json
 from typing import List
 from collections import defaultdict
 from tqdm.auto import tqdm
+import argparse
+import sys
+sys.path.append('.')
+from src.dataset_store import DatasetStore
+from src.runner import add_runner_args, runner_from_args
 
-def main():
+def main(args):
     model_name = "Davlan/bert-base-multilingual-cased-ner-hrl"
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     model = AutoModelForTokenClassification.from_pretrained(model_name)
 
     json_path = './data/gz_graph.json'
 
-    with open(json_path, 'r', encoding='utf8') as f:
-        data = json.load(f)
+    if args.store:
+        store = DatasetStore(args.store)
+        data = store.read_records(['presentation'])
+    else:
+        with open(json_path, 'r', encoding='utf8') as f:
+            data = json.load(f)
 
-    batch_size = 8
+    if args.work_dir:
+        # this worker tags the chunks it gets; the one finishing the last chunk writes the output
+        runner = runner_from_args(args, len(data))
+        if not runner.run(lambda positions: annotate([data[i] for i in positions], model, tokenizer)):
+            return
+        data = runner.merge()
+    else:
+        annotate(data, model, tokenizer)
+
+    if args.store:
+        store.add_columns('ner', [{k: v for k, v in el.items() if k != 'presentation'} for el in data])
+    else:
+        with open(json_path.replace('.json', '_ner.json'), 'w', encoding='utf8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+
+def annotate(data: List[dict], model, tokenizer, batch_size: int = 8) -> List[dict]:
+    """Adds the entities of each record's presentation to it, in place."""
     for i in tqdm(range(0, len(data), batch_size)):
         batch = [el['presentation'] for el in data[i:i+batch_size]]
         inputs = tokenizer(batch, return_tensors='pt', truncation=True, padding="max_length", is_split_into_words=False)
@@ -37,9 +62,7 @@ def main():
 
         for k, ent_dict in enumerate(ent_dict_list):
             data[i + k].update(ent_dict)
-
-    with open(json_path.replace('.json', '_ner.json'), 'w', encoding='utf8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    return data
 
 def extract_ents(input_ids: torch.Tensor, labels: torch.Tensor, tokenizer, id2label: dict):
     ents_dict = defaultdict(list)
@@ -75,4 +98,8 @@ def extract_ents(input_ids: torch.Tensor, labels: torch.Tensor, tokenizer, id2la
     return ents_dict
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Tag the recipe presentations with a BERT NER model")
+    parser.add_argument("--store", help="Dataset store to read the presentations from and add the entities to, instead of JSON files", default='')
+    add_runner_args(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,158 @@
+import json
+import re
+from typing import Dict, List
+import torch
+from transformers import LogitsProcessor
+
+LOC_KEYS = ('country', 'region', 'province', 'city')
+# part of the cache key of constrained annotations, bumped when the allowed outputs change
+CONSTRAINT_VERSION = 2
+UNK = 'UNK'
+# marks the end of a token sequence in a trie
+END = -1
+# the children of a leaf or `UNK` value, shared so that their trie is built once
+EMPTY = {}
+
+def load_location_values(misc_dir: str = './misc') -> Dict:
+    """Tree of the allowed values of `LOC_KEYS`, from the gazetteer files in `misc_dir`:
+    country -> region -> province -> city -> {}.
+
+    Regions are spelled as in `coords_dict.json`, which `make_graph.py` looks them up in; the
+    labels of `region2label.json` (`Emilia_Romagna`) are only added if no such spelling exists.
+    A province is named after its chief town, taken to be its most populous comune as in
+    `gazetteer.py`, or by its code (`RM`), and holds the comuni of that province. An `UNK`
+    province holds all the comuni of its region, while below an `UNK` region or country
+    there is nothing but `UNK`.
+    """
+    with open(f'{misc_dir}/italy_locs.json', 'r', encoding='utf8') as f:
+        locs = json.load(f)
+    with open(f'{misc_dir}/coords_dict.json', 'r', encoding='utf8') as f:
+        coords_dict = json.load(f)
+    with open(f'{misc_dir}/region2label.json', 'r', encoding='utf8') as f:
+        region2label = json.load(f)
+    regions = set([el['regione'] for el in locs]) | (set(coords_dict) - {'Italy', UNK})
+    normalized = set([re.sub(r'\W|_', '', el).lower() for el in regions])
+    regions |= set([el for el in region2label if re.sub(r'\W|_', '', el).lower() not in normalized and el != UNK])
+    chief_towns = {}
+    for loc in sorted(locs, key=lambda el: el['num_residenti']):
+        chief_towns[loc['provincia']] = loc['comune']
+    region_tree = {region: {} for region in regions}
+    for loc in locs:
+        provinces = region_tree[loc['regione']]
+        # the code and the chief town of a province share the same comuni
+        cities = provinces.setdefault(loc['provincia'], {})
+        provinces[chief_towns[loc['provincia']]] = cities
+        cities[loc['comune']] = EMPTY
+        provinces.setdefault(UNK, {})[loc['comune']] = EMPTY
+    return {'Italy': region_tree} if 'Italy' in coords_dict else {}
+
+def make_trie(sequences: List[List[int]], values: List[str]) -> Dict:
+    """Trie of token sequences, whose `END` nodes hold the value each sequence stands for."""
+    trie = {}
+    for sequence, value in zip(sequences, values):
+        node = trie
+        for token_id in sequence:
+            node = node.setdefault(token_id, {})
+        node[END] = value
+    return trie
+
+def trie_depth(node: Dict) -> int:
+    return max([0 if k == END else 1 + trie_depth(v) for k, v in node.items()])
+
+class LocationDictConstraint:
+    """Token tries of the only outputs allowed for a location dict:
+
+        {"country": "<value>", "region": "<value>", "province": "<value>", "city": "<value>"}
+
+    where each value is `UNK` or a child of the values before it in the tree of `load_location_values`,
+    so that e.g. the province has to be in the region. The output is cut into segments right before
+    the space that precedes each value (`{"country":`, ` "Italy", "region":`, ..., ` "Roma"}`): byte-level
+    BPE pre-tokenizers (GPT-2, Llama 3) never join a space to what comes before it, so the tokens of the
+    segments are those of the whole output, and the opening quote is tokenized with the value it opens.
+    The trie of a segment depends on the values chosen so far and is built once per tree node.
+    """
+    def __init__(self, tokenizer, values: Dict, keys = LOC_KEYS):
+        self.tokenizer = tokenizer
+        self.keys = keys
+        self.values = values
+        self.opening = make_trie(self.encode([self.segment(-1, None)]), [None])
+        self.tries = {}
+        # the longest allowed output, plus its eos token
+        self.max_length = trie_depth(self.opening) + self.max_depth(0, values) + 1
+        # allowed token ids of each trie node, shared by the processors of all batches
+        self.allowed_cache = {}
+
+    def encode(self, texts: List[str]) -> List[List[int]]:
+        return self.tokenizer(texts, add_special_tokens=False).input_ids
+
+    def segment(self, stage: int, value: str) -> str:
+        """The text of `value` for `keys[stage]` and what follows it up to the next value, stage -1 being the opening."""
+        if stage < 0:
+            return '{' + f'"{self.keys[0]}":'
+        if stage + 1 < len(self.keys):
+            return f' "{value}", "{self.keys[stage + 1]}":'
+        return f' "{value}"' + '}'
+
+    def trie(self, stage: int, node: Dict) -> Dict:
+        """Trie of the value of `keys[stage]` and what follows it up to the next value, among `UNK` and
+        the children `node` of the values chosen so far."""
+        if (stage, id(node)) not in self.tries:
+            # `UNK` is always allowed, and the only value below an `UNK` one
+            values = [UNK] + sorted([el for el in node if el != UNK])
+            # keeps `node` alive, so that its id is not reused by another node
+            self.tries[(stage, id(node))] = (make_trie(self.encode([self.segment(stage, el) for el in values]), values), node)
+        return self.tries[(stage, id(node))][0]
+
+    def max_depth(self, stage: int, node: Dict) -> int:
+        if stage == len(self.keys):
+            return 0
+        # children shared by several values (a province's code and chief town) are walked once
+        children = {id(el): el for el in [node.get(el, EMPTY) for el in [UNK] + list(node)]}
+        return trie_depth(self.trie(stage, node)) + max([self.max_depth(stage + 1, el) for el in children.values()])
+
+    def logits_processor(self, eos_token_id: int) -> 'LocationDictLogitsProcessor':
+        """A processor for one `generate` call: it keeps the position of each row in the tries."""
+        return LocationDictLogitsProcessor(self, eos_token_id)
+
+class LocationDictLogitsProcessor(LogitsProcessor):
+    """Masks the scores of the tokens that would leave the tries of a `LocationDictConstraint`,
+    and only allows eos once the closing brace has been generated."""
+    def __init__(self, constraint: LocationDictConstraint, eos_token_id: int):
+        self.constraint = constraint
+        self.num_stages = len(constraint.keys) + 1
+        self.eos_token_id = eos_token_id
+        self.states = None
+        self.allowed_cache = constraint.allowed_cache
+
+    def advance(self, state, token_id: int):
+        # stage 0 is the opening, stage i > 0 the value of keys[i - 1]; `tree` holds the children of the last value
+        stage, node, tree = state
+        if stage == self.num_stages:
+            # done: only eos, then padding, follows
+            return state
+        node = node[token_id]
+        if END in node:
+            if stage > 0:
+                tree = tree.get(node[END], EMPTY)
+            stage += 1
+            node = self.constraint.trie(stage - 1, tree) if stage < self.num_stages else None
+        return stage, node, tree
+
+    def allowed(self, state, device) -> torch.Tensor:
+        stage, node, tree = state
+        if stage == self.num_stages:
+            return torch.tensor([self.eos_token_id], device=device)
+        if id(node) not in self.allowed_cache:
+            self.allowed_cache[id(node)] = torch.tensor([el for el in node if el != END], device=device)
+        return self.allowed_cache[id(node)]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.states is None:
+            # first step: nothing generated yet
+            self.states = [(0, self.constraint.opening, self.constraint.values)] * input_ids.shape[0]
+        else:
+            self.states = [self.advance(state, token_id) for state, token_id in zip(self.states, input_ids[:, -1].tolist())]
+        mask = torch.full_like(scores, float('-inf'))
+        for i, state in enumerate(self.states):
+            mask[i, self.allowed(state, scores.device)] = 0
+        return scores + mask
@@ -0,0 +1,200 @@
+import argparse
+import ast
+import json
+import os
+import re
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+UNK = 'UNK'
+
+# English and short names of the regions in italy_locs.json
+REGION_VARIANTS = {
+    'Sicily': 'Sicilia',
+    'Sardinia': 'Sardegna',
+    'Tuscany': 'Toscana',
+    'Lombardy': 'Lombardia',
+    'Piedmont': 'Piemonte',
+    'Apulia': 'Puglia',
+    'Emilia Romagna': 'Emilia-Romagna',
+    'Emilia': 'Emilia-Romagna',
+    'Romagna': 'Emilia-Romagna',
+    'Friuli Venezia Giulia': 'Friuli-Venezia Giulia',
+    'Friuli': 'Friuli-Venezia Giulia',
+    'Trentino Alto Adige': 'Trentino-Alto Adige',
+    'Trentino': 'Trentino-Alto Adige',
+    'Alto Adige': 'Trentino-Alto Adige',
+    'South Tyrol': 'Trentino-Alto Adige',
+    "Val d'Aosta": "Valle d'Aosta",
+    'Aosta Valley': "Valle d'Aosta",
+}
+# English names of comuni
+CITY_VARIANTS = {
+    'Rome': 'Roma',
+    'Naples': 'Napoli',
+    'Florence': 'Firenze',
+    'Venice': 'Venezia',
+    'Milan': 'Milano',
+    'Turin': 'Torino',
+    'Genoa': 'Genova',
+    'Padua': 'Padova',
+    'Mantua': 'Mantova',
+    'Syracuse': 'Siracusa',
+    'Leghorn': 'Livorno',
+}
+
+# a place right after these is where a dish is from ("a Napoli", "tipico della Campania" needs the keyword)
+STRONG_CUES = {'a', 'ad', 'in', 'nel', 'nell', 'nella', 'nelle', 'nei', 'negli', 'da', 'dal', 'dall', 'dalla', 'dalle', 'from'}
+# after these it is often part of a product name ("aceto balsamico di Modena"), unless an origin keyword comes just before,
+# titles included ("prosciutto di parma")
+WEAK_CUES = {'di', 'd', 'del', 'dell', 'della', 'delle', 'dello', 'dei', 'degli', 'of'}
+# a cued capitalized word that is none of the places of the gazetteer is a place elsewhere ("in Paris"), except these
+COUNTRY_NAMES = {'Italia', 'Italy'}
+ORIGIN_KEYWORDS = re.compile(r'^(tipic|origin|tradizion|regional|specialit|cucina|nat[oaie]$|typical|tradition|native|hail|special|cuisine|born)')
+
+class Gazetteer:
+    """Finds the comuni and regions of `italy_locs.json` where a text says a dish is from.
+
+    A name counts only right after a cue word (see `STRONG_CUES`/`WEAK_CUES`), and in the case it
+    is written with, except in `lowercase` texts (titles made from URLs), where only regions and
+    comuni with at least `min_lowercase_residents` residents are matched, to skip "torta di mele".
+    A capitalized word before "da" makes it a name ("Leonardo da Vinci") rather than a place.
+    """
+    def __init__(self, locs: List[Dict], min_lowercase_residents: int = 15000):
+        self.cities = defaultdict(list)
+        for loc in locs:
+            self.cities[loc['comune']].append(loc)
+        for variant, name in CITY_VARIANTS.items():
+            self.cities[variant] = self.cities[name]
+        self.regions = {el['regione']: el['regione'] for el in locs}
+        self.regions.update(REGION_VARIANTS)
+        # provinces are named after their chief town, taken to be their most populous comune
+        self.province_names = {}
+        for loc in sorted(locs, key=lambda el: el['num_residenti']):
+            self.province_names[loc['provincia']] = loc['comune']
+        self.lowercase_names = {el.lower(): el for el in self.regions}
+        self.lowercase_names.update({name.lower(): name for name, entries in self.cities.items()
+                                     if max([el['num_residenti'] for el in entries]) >= min_lowercase_residents})
+        self.max_words = max([len(re.findall(r'\w+', el)) for el in list(self.cities) + list(self.regions)])
+
+    @classmethod
+    def from_file(cls, path: str = './misc/italy_locs.json', **kwargs) -> 'Gazetteer':
+        with open(path, 'r', encoding='utf8') as f:
+            return cls(json.load(f), **kwargs)
+
+    def is_cued(self, words: List[str], i: int, lowercase: bool) -> bool:
+        """Whether the name starting at word `i` follows a cue word."""
+        if i == 0:
+            return False
+        cue = words[i - 1].lower()
+        if cue in STRONG_CUES:
+            # "Leonardo da Vinci", but not "Da Napoli" at the start of a text
+            return not (words[i - 1] == 'da' and not lowercase and i > 1 and words[i - 2][:1].isupper())
+        if cue in WEAK_CUES:
+            return any([ORIGIN_KEYWORDS.match(el.lower()) for el in words[max(0, i - 5):i - 1]])
+        return False
+
+    def mentions(self, text: str, lowercase: bool = False) -> List[Tuple[str, str]]:
+        """The cued ('region' | 'city', name) mentions of `text`, longest names first, and the cued
+        capitalized words that are no such name as ('unknown', word)."""
+        text = text.replace('’', "'")
+        spans = [el.span() for el in re.finditer(r'\w+', text)]
+        words = [text[start:end] for start, end in spans]
+        found = []
+        i = 0
+        while i < len(spans):
+            for n in range(min(self.max_words, len(spans) - i), 0, -1):
+                name = text[spans[i][0]:spans[i + n - 1][1]]
+                if lowercase:
+                    name = self.lowercase_names.get(name)
+                if name in self.regions or name in self.cities:
+                    if self.is_cued(words, i, lowercase):
+                        found.append(('region' if name in self.regions else 'city', name))
+                    i += n - 1
+                    break
+            else:
+                if (not lowercase and words[i][:1].isupper() and words[i] not in COUNTRY_NAMES
+                        and self.is_cued(words, i, lowercase)):
+                    found.append(('unknown', words[i]))
+            i += 1
+        return found
+
+    def resolve(self, record: Dict, fields = ('presentation_it', 'presentation_en'), title_fields = ('title_it', 'title_en')) -> Dict:
+        """The location dict of `record` if its mentions agree on a single region, and at most a
+        single comune in it, and it names no other place, otherwise None: the recipe is left to the LLM."""
+        found = []
+        for field in fields + title_fields:
+            if record.get(field):
+                found += self.mentions(record[field], lowercase = field in title_fields)
+        if any([kind == 'unknown' for kind, name in found]):
+            return None
+        regions = set([self.regions[name] for kind, name in found if kind == 'region'])
+        cities = {}
+        for kind, name in found:
+            if kind == 'city':
+                # a comune outside of the mentioned region is a different place with the same name
+                cities[self.cities[name][0]['comune']] = [el for el in self.cities[name] if not regions or el['regione'] in regions]
+        # several places, or a city that is in none of the mentioned regions
+        if len(regions) > 1 or len(cities) > 1 or any([not el for el in cities.values()]):
+            return None
+        if cities:
+            entries = list(cities.values())[0]
+            if len(entries) > 1:
+                return None
+            city = entries[0]
+            return {'country': 'Italy', 'region': city['regione'], 'province': self.province_names[city['provincia']], 'city': city['comune']}
+        if regions:
+            return {'country': 'Italy', 'region': regions.pop(), 'province': UNK, 'city': UNK}
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Report how many recipes the gazetteer resolves without the LLM, and how often it agrees with existing annotations")
+    parser.add_argument("--input", help="JSON list of recipes, '' to skip", default='./data/gz_bilingual_graph.json')
+    parser.add_argument("--reference", help="JSON list of recipes annotated by annotate_locs.py, '' to skip", default='./data/gz_bilingual_graph_Llama-3.3-70B-Instruct.json')
+    parser.add_argument("--gold", help="JSON of url_it -> gold region, '' to skip", default='./misc/gold_regions.json')
+    parser.add_argument("--dishes", help="JSON list of dishes with their description and areas, as misc/world_cuisines_italy.json, '' to skip", default='./misc/world_cuisines_italy.json')
+    args = parser.parse_args()
+
+    gazetteer = Gazetteer.from_file()
+    if args.dishes:
+        with open(args.dishes, 'r', encoding='utf8') as f:
+            dishes = json.load(f)
+        num_resolved, num_agree = 0, 0
+        for dish in dishes:
+            dict_country = gazetteer.resolve({'presentation_en': dish['Text Description'], 'title_en': dish['Name']})
+            if dict_country is None:
+                continue
+            areas = dish['Area'] if isinstance(dish['Area'], list) else ast.literal_eval(dish['Area'])
+            regions = [gazetteer.regions.get(el) or gazetteer.cities[el][0]['regione'] for el in areas if el in gazetteer.regions or gazetteer.cities.get(el)]
+            num_resolved += 1
+            num_agree += dict_country['region'] in regions
+        print(f'{num_resolved}/{len(dishes)} dishes of {args.dishes} resolved, region agrees with their areas for {num_agree}/{num_resolved}')
+    if not args.input:
+        return
+
+    with open(args.input, 'r', encoding='utf8') as f:
+        data = json.load(f)
+    resolved = {el['url_it']: gazetteer.resolve(el) for el in data}
+    resolved = {k: v for k, v in resolved.items() if v is not None}
+    num_cities = sum([v['city'] != UNK for v in resolved.values()])
+    print(f'{len(resolved)}/{len(data)} recipes resolved: {num_cities} to a city, {len(resolved) - num_cities} to a region only')
+
+    if args.gold:
+        with open(args.gold, 'r', encoding='utf8') as f:
+            gold = json.load(f)
+        pairs = [(v['region'], gold[k]) for k, v in resolved.items() if k in gold]
+        agree = sum([a == b for a, b in pairs])
+        print(f'Region agrees with {args.gold} for {agree}/{len(pairs)} resolved recipes')
+        for k, v in resolved.items():
+            if k in gold and v['region'] != gold[k]:
+                print(f'  {k}: {v["region"]} instead of {gold[k]}')
+
+    if args.reference and os.path.exists(args.reference):
+        with open(args.reference, 'r', encoding='utf8') as f:
+            reference = {el['url_it']: el for el in json.load(f)}
+        pairs = [(v['region'], reference[k].get('region')) for k, v in resolved.items() if k in reference]
+        agree = sum([a == b for a, b in pairs])
+        print(f'Region agrees with {args.reference} for {agree}/{len(pairs)} resolved recipes')
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
 import json
+import argparse
 from typing import List, Dict
+import sys
+sys.path.append('.')
+from src.dataset_store import DatasetStore
 
 def make_targets(data: List[Dict]):
     url_dict = {k: i for i, k in enumerate([el['url_it'] for el in data])}
@@ -46,11 +50,14 @@ def get_coords(data: List[Dict], coords_dict: Dict):
                                         }
     return data
 
-def main():
+def main(args):
     json_path_dataset = './data/gz_dataset.json'
 
-    with open(json_path_dataset, 'r', encoding='utf8') as f:
-        data = json.load(f)
+    if args.store:
+        data = DatasetStore(args.store).read_records()
+    else:
+        with open(json_path_dataset, 'r', encoding='utf8') as f:
+            data = json.load(f)
 
     json_path_coords = './misc/coords_dict.json'
 
@@ -62,9 +69,17 @@ def main():
     data_titles = get_titles(data_targets)
     data_titles = get_coords(data_targets, coords_dict)
     
-    with open(json_path_dataset.replace('.json', '_graph.json'), 'w', encoding='utf8') as f:
-        json.dump(data_titles, f, ensure_ascii = False, indent = 4)
+    if args.graph_store:
+        # node ids are re-assigned here, so the graph is a new store rather than new columns
+        DatasetStore(args.graph_store).write(data_titles)
+    else:
+        with open(json_path_dataset.replace('.json', '_graph.json'), 'w', encoding='utf8') as f:
+            json.dump(data_titles, f, ensure_ascii = False, indent = 4)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Build the recipe graph from the gz dataset")
+    parser.add_argument("--store", help="Dataset store to read instead of gz_dataset.json", default='')
+    parser.add_argument("--graph_store", help="Dataset store to write the graph to instead of gz_dataset_graph.json", default='')
+    args = parser.parse_args()
+    main(args)
 
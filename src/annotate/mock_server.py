@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import time
+from aiohttp import web
+
+class MockCompletionServer:
+    """Stand-in for an OpenAI-compatible completions server doing continuous batching.
+
+    Up to `max_batch_size` requests are decoded together: each gets one token every `step_time`
+    seconds, however many others are running, and a request beyond that waits for a free slot.
+    The completion is `response` cut to `max_tokens` whitespace tokens, whatever the prompt.
+    """
+    def __init__(self, response: str, max_batch_size: int = 64, step_time: float = 0.01, fail_every: int = 0):
+        self.response = response
+        self.slots = asyncio.Semaphore(max_batch_size)
+        self.step_time = step_time
+        self.fail_every = fail_every
+        self.num_requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def completions(self, request):
+        payload = await request.json()
+        self.num_requests += 1
+        if self.fail_every and self.num_requests % self.fail_every == 0:
+            # for checking the retries of the client
+            return web.json_response({'error': 'mock failure'}, status = 503)
+        tokens = self.response.split(' ')[:payload.get('max_tokens', 16)]
+        async with self.slots:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(len(tokens) * self.step_time)
+            self.in_flight -= 1
+        return web.json_response({
+            'id': f'cmpl-{self.num_requests}',
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'model': payload.get('model'),
+            'choices': [{'index': 0, 'text': ' '.join(tokens), 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': len(payload['prompt'].split()), 'completion_tokens': len(tokens)},
+        })
+
+    async def stats(self, request):
+        return web.json_response({'num_requests': self.num_requests, 'max_in_flight': self.max_in_flight})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/completions', self.completions)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+async def start_server(server: MockCompletionServer, host: str = '127.0.0.1', port: int = 8000) -> web.AppRunner:
+    """Serves `server` on the running event loop; `await runner.cleanup()` stops it."""
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible completions server, to run the annotation scripts with --backend openai without a GPU")
+    parser.add_argument("--host", help="Host to listen on", default='127.0.0.1')
+    parser.add_argument("--port", type=int, help="Port to listen on", default=8000)
+    parser.add_argument("--response", help="Completion returned for every prompt",
+                        default='{"country": "Italy", "region": "UNK", "province": "UNK", "city": "UNK"}')
+    parser.add_argument("--max_batch_size", type=int, help="Requests decoded together", default=64)
+    parser.add_argument("--step_time", type=float, help="Seconds per decoding step", default=0.01)
+    args = parser.parse_args()
+
+    server = MockCompletionServer(args.response, args.max_batch_size, args.step_time)
+    web.run_app(server.make_app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import torch
+from transformers import AutoTokenizer
+import sys
+sys.path.append('.')
+from model.llm_annotator.italia9b import ItaliaForCausalLM
+import pandas as pd
+import json
+from src.utils import prompt_layout_dict
+from src.annotate.result_cache import ResultCache
+from src.annotate.backends import LazyBackend, add_backend_args, quantization_from_args
+from src.annotate.step_lists import count_steps, step_budget, parse_step_list, StepCountStoppingCriteria
+from src.runner import add_runner_args, runner_from_args
+import argparse
+torch.set_float32_matmul_precision('high')
+
+def main(args):
+    json_path = './data/gz_dataset.json'
+    df = pd.read_json(json_path)
+    text_list = df.to_dict(orient='records')
+
+    model_name = 'meta-llama/Llama-3.1-8B-Instruct'
+    # model_name = 'meta-llama/Llama-3.3-70B-Instruct'
+    # model_name = 'iGeniusAI/Italia-9B-Instruct-v0.1'
+    # model_name = 'sapienzanlp/Minerva-7B-instruct-v1.0'
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_name,
+        trust_remote_code=True,
+    )
+    tokenizer.pad_token_id = tokenizer.eos_token_id
+    tokenizer.padding_side = 'left'
+    eos_token_id_text = tokenizer.decode(tokenizer.eos_token_id)
+
+    quantization = quantization_from_args(args)[1]
+
+    prompt_layout_dict = {
+    'it': """Di seguito è riportata una ricetta con un numero per ogni passaggio. Crea un elenco di singoli passaggi per ognuno dei numeri.""",
+    'en': """Below is a recipe with step numbers. Make a list of single self-contained steps for each of those numbers. The maximum number of steps you produce needs to match the last step number in the recipe. Write it as a numbered list, one step per line ("1. ..."). Only output the list without adding any comments.\n\n{text_sample}""",
+    }
+
+    prompt_lang = 'en'
+    prompt_layout = prompt_layout_dict[prompt_lang]
+    sys_prompt = 'You are an AI specialized in extracting information from texts.'
+    result_key = f'steps_{prompt_lang}_paraphrased'
+    # set per batch, from the step numbers of its samples
+    expected_steps = []
+    if args.cache:
+        # skip the texts already paraphrased with the same model, prompt and generation settings:
+        # outputs cut short by a smaller budget must not be reused
+        prompt_template = sys_prompt + '\n' + prompt_layout + f'\nmax_new_tokens={args.max_new_tokens}\nstop_on_steps={args.stop_on_steps}'
+        cache = ResultCache(args.cache, model_name, quantization, prompt_template)
+    # the dynamic cache only takes the memory of each batch's own budget
+    stopping_criteria_fn = (lambda batch: [StepCountStoppingCriteria(tokenizer, [expected_steps[i] for i in batch])]) if args.stop_on_steps else None
+    backend = LazyBackend(args, model_name, tokenizer,
+                          max_batch_tokens = args.max_batch_tokens,
+                          max_batch_size = args.max_batch_size,
+                          stopping_criteria_fn = stopping_criteria_fn,
+                          eos_token_id=tokenizer.eos_token_id)
+
+    def paraphrase(text_list):
+        """Updates the records of `text_list` in place with the LLM outputs, or the cached ones."""
+        text_samples = [' '.join(el[f'steps_{prompt_lang}']) for el in text_list]
+        todo_list, todo_samples = text_list, text_samples
+        if args.cache:
+            cached = cache.get_many(text_samples)
+            todo_list, todo_samples = [], []
+            for record, text_sample in zip(text_list, text_samples):
+                if text_sample in cached:
+                    record[result_key] = cached[text_sample]
+                else:
+                    todo_list.append(record)
+                    todo_samples.append(text_sample)
+            print(f'{len(text_list) - len(todo_list)} results found in {args.cache}.')
+
+        def on_results(results):
+            batch_results = []
+            for i, list_string in results:
+                steps = parse_step_list(list_string)
+                if len(steps) != expected_steps[i]:
+                    print(f'{len(steps)} steps for {expected_steps[i]} step numbers: {todo_list[i].get("url_it")}', flush=True)
+                todo_list[i][result_key] = steps
+                batch_results.append((todo_samples[i], steps))
+            if args.cache:
+                # committed batch by batch, so a crash only loses the batch in progress
+                cache.put_many(batch_results)
+
+        if todo_samples:
+            prompt_list = []
+            for text_sample in todo_samples:
+                prompt = prompt_layout.format(text_sample = text_sample, eos_token_id_text=eos_token_id_text,)
+                prompt = [
+                    {"role": "system", "content": sys_prompt},
+                    {"role": "user", "content": prompt},
+                ]
+                prompt_list.append(tokenizer.apply_chat_template(prompt, tokenize=False, add_generation_prompt=True))
+            # a budget per sample instead of max_new_tokens for all, so short recipes are batched together
+            expected_steps[:] = [count_steps(el) for el in todo_samples]
+            num_input_tokens = [len(el) for el in tokenizer(todo_samples, add_special_tokens=False).input_ids]
+            budgets = [step_budget(n, s, args.max_new_tokens) for n, s in zip(num_input_tokens, expected_steps)]
+            print(f'{sum(budgets)} new tokens budgeted, {args.max_new_tokens * len(budgets)} at most.')
+            backend.generate(prompt_list, budgets, on_results)
+        return text_list
+
+    if args.work_dir:
+        # this worker paraphrases the chunks it gets; the one finishing the last chunk writes the output
+        runner = runner_from_args(args, len(text_list))
+        if not runner.run(lambda positions: [el[result_key] for el in paraphrase([text_list[i] for i in positions])]):
+            return
+        for record, steps in zip(text_list, runner.merge()):
+            record[result_key] = steps
+    else:
+        paraphrase(text_list)
+
+    # the records were updated in place, so the outputs are in the original order
+    dict_output_list = text_list
+
+    with open(json_path.replace('.json', f"_{model_name.split('/')[-1]}.json"), 'w', encoding='utf8') as f:
+        json.dump(dict_output_list, f, ensure_ascii = False, indent = 4)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Annotate the gz dataset with an LLM")
+    add_backend_args(parser)
+    parser.add_argument("--max_new_tokens", type=int, help="Max tokens to generate per recipe; each gets a budget from its length and step count, up to this.", default=1000)
+    parser.add_argument("--max_batch_tokens", type=int, help="Max padded tokens per batch, prompts plus new tokens.", default=16384)
+    parser.add_argument("--max_batch_size", type=int, help="Max prompts per batch.", default=16)
+    parser.add_argument("--stop_on_steps", type=int, help="Whether to stop each sequence once it has as many numbered steps as the recipe has step numbers.", default=1)
+    parser.add_argument("--cache", help="SQLite file of finished outputs, to skip the texts already done; '' to disable.", default='./data/annotation_cache.sqlite')
+    add_runner_args(parser)
+    args = parser.parse_args()
+    main(args)
\ No newline at end of file
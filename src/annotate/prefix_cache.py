@@ -0,0 +1,83 @@
+import copy
+import re
+from typing import List, Tuple
+import torch
+
+# stands in for the text sample when splitting a formatted prompt into its fixed prefix and the rest
+TEXT_SENTINEL = '\x00TEXT_SAMPLE\x00'
+
+def split_prompt(prompt_layout: str, text_key: str = 'text_sample', **fields) -> Tuple[str, str]:
+    """Formats `prompt_layout` and splits it around `{text_key}`: `(prefix, suffix)`.
+
+    The prompt of a text is then `prefix + text + suffix`, and `prefix` is the same for all of them.
+    """
+    prompt = prompt_layout.format(**{text_key: TEXT_SENTINEL}, **fields)
+    prefix, suffix = prompt.split(TEXT_SENTINEL)
+    return prefix, suffix
+
+def cacheable_prefix(prefix: str) -> str:
+    """`prefix` up to its last line break followed by a visible character, '' if it has none.
+
+    A tokenizer can merge the end of the prefix with the first word of the text (Llama 3 makes one
+    pretoken of `<Spaghetti`), so only the part before a token boundary can be cached; byte-level BPE
+    tokenizers like Llama 3's always start a new token there. `PrefixCachedGenerator.encode` checks it.
+    """
+    matches = list(re.finditer(r'\n(?=\S)', prefix))
+    return prefix[:matches[-1].end()] if matches else ''
+
+class PrefixCachedGenerator:
+    """Generates from prompts that all start with `prefix`, whose KV cache is computed once.
+
+    Each batch is laid out as `[prefix][padding][text + suffix]`: the prefix tokens are the same in
+    every row, so the cached prefix is repeated over the batch and `generate` only prefills the rest.
+    With `use_cache=False` the same inputs are prefilled in full, which gives the same outputs.
+    """
+    def __init__(self, model, tokenizer, prefix: str):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix = prefix
+        self.prefix_ids = tokenizer(prefix, return_tensors='pt').input_ids
+        self.prefix_cache = None
+
+    def encode(self, prompts: List[str]) -> List[List[int]]:
+        """Token ids of `prompts` after the prefix tokens, or None for a prompt whose tokens do not start
+        with them, i.e. whose prompt with the cached prefix would not be the same tokens."""
+        if not prompts:
+            return []
+        prefix_ids = self.prefix_ids[0].tolist()
+        ids_list = []
+        for prompt, ids in zip(prompts, self.tokenizer(prompts, truncation=True).input_ids):
+            if not prompt.startswith(self.prefix):
+                raise ValueError('Prompt does not start with the cached prefix.')
+            ids_list.append(ids[len(prefix_ids):] if ids[:len(prefix_ids)] == prefix_ids else None)
+        return ids_list
+
+    def build_inputs(self, ids_list: List[List[int]]):
+        longest = max([len(el) for el in ids_list])
+        prefix_len = self.prefix_ids.shape[-1]
+        input_ids = torch.full((len(ids_list), prefix_len + longest), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        input_ids[:, :prefix_len] = self.prefix_ids[0]
+        attention_mask[:, :prefix_len] = 1
+        for i, ids in enumerate(ids_list):
+            if ids:
+                input_ids[i, -len(ids):] = torch.tensor(ids, dtype=torch.long)
+                attention_mask[i, -len(ids):] = 1
+        return input_ids.to(self.model.device), attention_mask.to(self.model.device)
+
+    @torch.no_grad()
+    def get_prefix_cache(self):
+        if self.prefix_cache is None:
+            self.prefix_cache = self.model(input_ids=self.prefix_ids.to(self.model.device), use_cache=True).past_key_values
+        return self.prefix_cache
+
+    @torch.no_grad()
+    def generate(self, ids_list: List[List[int]], use_cache: bool = True, **generate_kwargs):
+        """Returns the generated token ids (without the prompt) of each of `ids_list`."""
+        input_ids, attention_mask = self.build_inputs(ids_list)
+        if use_cache:
+            cache = copy.deepcopy(self.get_prefix_cache())
+            cache.batch_repeat_interleave(len(ids_list))
+            generate_kwargs['past_key_values'] = cache
+        output = self.model.generate(input_ids=input_ids, attention_mask=attention_mask, **generate_kwargs)
+        return output[:, input_ids.shape[-1]:]
@@ -0,0 +1,50 @@
+import hashlib
+import json
+import sqlite3
+from typing import Dict, List, Tuple
+
+def sha1(text: str) -> str:
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+class ResultCache:
+    """SQLite store of LLM outputs keyed by (model, quantization, prompt template hash, text hash).
+
+    `prompt_template` should hold everything but the text that decides the output (instructions,
+    examples, generation settings), so that changing any of it starts a new set of results.
+    Each `put_many` is one transaction, so a crash loses at most the batch being generated.
+    """
+    def __init__(self, path: str, model_name: str, quantization: str, prompt_template: str):
+        self.model_name = model_name
+        self.quantization = quantization
+        self.prompt_hash = sha1(prompt_template)
+        # several workers of a sharded run may write at once: wait for the lock rather than fail
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS results (
+            model TEXT, quantization TEXT, prompt_hash TEXT, text_hash TEXT, result TEXT,
+            PRIMARY KEY (model, quantization, prompt_hash, text_hash))""")
+        self.conn.commit()
+
+    def get_many(self, texts: List[str], chunk_size: int = 500) -> Dict[str, object]:
+        """The cached results of `texts`, by text; texts without a result are left out."""
+        hash2text = {sha1(el): el for el in texts}
+        hashes = list(hash2text)
+        results = {}
+        for i in range(0, len(hashes), chunk_size):
+            chunk = hashes[i:i + chunk_size]
+            rows = self.conn.execute(
+                f"""SELECT text_hash, result FROM results WHERE model = ? AND quantization = ? AND prompt_hash = ?
+                AND text_hash IN ({','.join('?' * len(chunk))})""",
+                [self.model_name, self.quantization, self.prompt_hash] + chunk)
+            results.update({hash2text[text_hash]: json.loads(result) for text_hash, result in rows})
+        return results
+
+    def put_many(self, items: List[Tuple[str, object]]):
+        """Stores the (text, result) pairs, results being JSON-serializable."""
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                  [(self.model_name, self.quantization, self.prompt_hash, sha1(text), json.dumps(result, ensure_ascii=False))
+                                   for text, result in items])
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,68 @@
+import ast
+import re
+from typing import List
+import torch
+from transformers import StoppingCriteria
+
+# step numbers are kept in the scraped steps as `<n>` (see `parse_page` in src/scrape/scrape.py)
+STEP_MARKER = re.compile(r'<(\d+)>')
+LIST_ITEM = re.compile(r'^\s*(\d+)[.)]\s*(.*\S)', re.MULTILINE)
+# a numbered item whose line has ended
+COMPLETE_ITEM = re.compile(r'^\s*\d+[.)]\s*\S.*\n', re.MULTILINE)
+
+def count_steps(text: str) -> int:
+    """The last step number of `text`, i.e. how many items its paraphrase should have."""
+    return max([int(el) for el in STEP_MARKER.findall(text)] or [0])
+
+def step_budget(num_input_tokens: int,
+                num_steps: int,
+                max_new_tokens: int = 1000,
+                ratio: float = 1.5,
+                tokens_per_step: int = 8,
+                margin: int = 32,
+                ) -> int:
+    """Tokens to generate for the paraphrase of `num_steps` steps written in `num_input_tokens` tokens.
+
+    A paraphrase is about as long as its input, plus the numbering of each item, so this leaves some
+    room on top; `StepCountStoppingCriteria` usually stops the sequence well before the budget.
+    """
+    return min(max_new_tokens, int(ratio * num_input_tokens) + tokens_per_step * num_steps + margin)
+
+def parse_step_list(text: str) -> List[str]:
+    """The items of a generated numbered list ("1. ...", one per line), or of a Python list literal."""
+    items = [el[1] for el in LIST_ITEM.findall(text)]
+    if items:
+        return items
+    match = re.search(r'\[.*\]', text, re.DOTALL)
+    if match:
+        try:
+            items = ast.literal_eval(match.group(0))
+        except (ValueError, SyntaxError):
+            items = None
+        if isinstance(items, list):
+            return [str(el) for el in items]
+    return [el.strip('-*• ').strip() for el in text.splitlines() if el.strip('-*• ').strip()]
+
+class StepCountStoppingCriteria(StoppingCriteria):
+    """Stops each sequence of a batch once it has written `expected[b]` complete numbered items.
+
+    The generated text is only decoded again when a row's last token holds a newline, which is the
+    only token that can complete an item.
+    """
+    def __init__(self, tokenizer, expected: List[int]):
+        self.tokenizer = tokenizer
+        self.expected = expected
+        self.prompt_len = None
+        self.done = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.prompt_len is None:
+            # first call, one token in
+            self.prompt_len = input_ids.shape[-1] - 1
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for b in range(input_ids.shape[0]):
+            if self.done[b] or not self.expected[b] or '\n' not in self.tokenizer.decode(input_ids[b, -1:]):
+                continue
+            text = self.tokenizer.decode(input_ids[b, self.prompt_len:], skip_special_tokens=True)
+            self.done[b] = len(COMPLETE_ITEM.findall(text)) >= self.expected[b]
+        return self.done.clone()
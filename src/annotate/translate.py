@@ -1,9 +1,18 @@
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, BitsAndBytesConfig
-from typing import List
+from typing import Dict, List
 from tqdm.auto import tqdm
 import json
+import os
+import re
+import time
 import argparse
 import torch
+import sys
+sys.path.append('.')
+from src.dataset_store import DatasetStore
+from src.runner import add_runner_args, runner_from_args, get_rank_world
+from src.shards import ShardWriter, iter_shards
+from src.annotate.batching import token_budget_batches, padding_efficiency
 
 nllb_lang2code = { # training languages in checkthat
     "eng_Latn": 'en',
@@ -28,78 +37,141 @@ nf4_config = BitsAndBytesConfig(
     bnb_4bit_quant_type="nf4",
 )
 
+def split_sentences(sample: str) -> List[str]:
+    return [el.strip() + '.' for el in sample.split('.') if el.strip()]
+
+def load_memory(stream_dir: str, settings: Dict) -> Dict[str, str]:
+    """The sentence translations streamed to `stream_dir` by earlier runs with the same `settings`."""
+    memory = {}
+    if not os.path.isdir(stream_dir):
+        return memory
+    prefixes = set([match.group(1) for match in [re.match(r'^(memory\d+)-\d+\.jsonl', el) for el in os.listdir(stream_dir)] if match])
+    for prefix in sorted(prefixes):
+        for record in iter_shards(stream_dir, prefix):
+            if all([record.get(k) == v for k, v in settings.items()]):
+                memory[record['src']] = record['tgt']
+    return memory
+
 class Translator:
-    def __init__(self, model, tokenizer, batch_size, src_lang, tgt_lang):
+    """The sentences of all the samples given to `translate` are pooled, deduplicated against a translation
+    memory kept across calls, and translated in batches of similar length of up to `batch_size` sentences
+    and `max_batch_tokens` padded source tokens.
+
+    With `stream_dir`, every batch of translations is appended to the memory shards there as soon as it
+    is done, and a new Translator starts from the memory of the earlier runs with the same model, target
+    language and `num_beams`, so an interrupted job only redoes the batch it was in.
+    """
+    def __init__(self, model, tokenizer, batch_size, src_lang, tgt_lang, max_batch_tokens = 4096, num_beams = 5, stream_dir = ''):
         self.model = model
         self.tokenizer = tokenizer
         self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
+        self.num_beams = num_beams
+        self.source_prefix = ''
         if 'nllb' in self.model.name_or_path:
             self.run_model = self.run_nllb
             self.tokenizer.src_lang = nllb_code2lang[src_lang]
             self.tokenizer.tgt_lang = nllb_code2lang[tgt_lang]
         if 'madlad' in self.model.name_or_path:
             self.run_model = self.run_madlad
+            # MADLAD is told the target language by a token before the source text
+            self.source_prefix = f'<2{tgt_lang}> '
+        self.settings = {'model': self.model.name_or_path, 'tgt_lang': tgt_lang, 'num_beams': num_beams}
+        # source sentence -> translation
+        self.memory = load_memory(stream_dir, self.settings) if stream_dir else {}
+        self.writer = None
+        if stream_dir:
+            print(f'{len(self.memory)} sentence translations found in {stream_dir}.')
+            # one set of shards per worker of a sharded run
+            self.writer = ShardWriter(stream_dir, prefix=f'memory{get_rank_world()[0]}', flush_every=batch_size)
 
-    def run_madlad(self, batch: List):
-        input_ids = self.tokenizer(batch,
-                                return_tensors="pt",
-                                padding='longest',
-                                truncation=True).input_ids.to(self.model.device)
-        max_length = input_ids.shape[-1] * 2
-        outputs = self.model.generate(input_ids=input_ids,
-                                      max_length=max_length,
-                                      num_beams=5)
-        return outputs
-
-    def run_nllb(self, batch: List[str]):
-        translated_batch = []
-        for sample in batch:
-            sample_list = [el.strip() + '.' for el in sample.split('.') if el.strip()]
-            input_ids = self.tokenizer(sample_list,
-                                    return_tensors="pt",
+    def generate(self, ids_batch: List[List[int]], **generate_kwargs) -> List[str]:
+        """Translates a batch of tokenized sentences, greedily with `num_beams` 1."""
+        inputs = self.tokenizer.pad({'input_ids': ids_batch},
                                     padding='longest',
-                                    truncation=True).input_ids.to(self.model.device)
-            
-            if input_ids.shape[1] > 1024:
-                raise Exception(f"Input length > 1024 tokens")
-            
-            max_length = input_ids.shape[1] * 2
+                                    return_tensors="pt").to(self.model.device)
+
+        if inputs['input_ids'].shape[1] > 1024:
+            raise Exception(f"Input length > 1024 tokens")
+
+        max_length = inputs['input_ids'].shape[1] * 2
+        if self.num_beams > 1:
+            generate_kwargs['early_stopping'] = True
+        with torch.no_grad():
             outputs = self.model.generate(
-                input_ids=input_ids,
+                **inputs,
                 max_length=max_length,
-                num_beams=5,
-                forced_bos_token_id=self.tokenizer.convert_tokens_to_ids(nllb_code2lang[self.tgt_lang]),
+                num_beams=self.num_beams,
+                do_sample=False,
                 num_return_sequences=1,
-                early_stopping=True
+                **generate_kwargs
             )
-            decoded_sentences = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
-            joined_translation = ' '.join(decoded_sentences)
-            translated_batch.append(joined_translation)
-        return translated_batch
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    def run_madlad(self, ids_batch: List[List[int]]) -> List[str]:
+        return self.generate(ids_batch)
+
+    def run_nllb(self, ids_batch: List[List[int]]) -> List[str]:
+        return self.generate(ids_batch, forced_bos_token_id=self.tokenizer.convert_tokens_to_ids(nllb_code2lang[self.tgt_lang]))
+
+    def translate_sentences(self, sentences: List[str]) -> List[str]:
+        """Translates the sentences not in the translation memory yet, longest first, then looks them all up."""
+        todo = list(dict.fromkeys([el for el in sentences if el not in self.memory]))
+        print(f'{len(sentences)} sentences, {len(todo)} to translate after the translation memory.')
+        if todo:
+            ids_list = self.tokenizer([self.source_prefix + el for el in todo], truncation=True).input_ids
+            lengths = [len(el) for el in ids_list]
+            batches = token_budget_batches(lengths, self.max_batch_tokens, self.batch_size)
+            print(f'{len(batches)} batches, padding efficiency {padding_efficiency(lengths, batches):.1%}')
+            for k, batch in enumerate(tqdm(batches)):
+                start = time.perf_counter()
+                translated_batch = self.run_model([ids_list[i] for i in batch])
+                elapsed = time.perf_counter() - start
+                num_tokens = sum([lengths[i] for i in batch])
+                tqdm.write(f'Batch {k + 1}/{len(batches)}: {len(batch)} sentences, {num_tokens} source tokens in {elapsed:.2f} s '
+                           f'({len(batch) / elapsed:.1f} sentences/s, {num_tokens / elapsed:.0f} tokens/s)')
+                for i, translation in zip(batch, translated_batch):
+                    self.memory[todo[i]] = translation
+                    if self.writer is not None:
+                        self.writer.write(dict(self.settings, src = todo[i], tgt = translation))
+                if self.writer is not None:
+                    self.writer.flush()
+        return [self.memory[el] for el in sentences]
 
     def translate(self, data):
-        translations = []
-        for i in tqdm(range(0, len(data), self.batch_size)):
-            batch = data[i:i+self.batch_size]
-            translated_batch = self.run_model(batch)
-            translations.extend(translated_batch)
-        return translations
+        # one pool of sentences for all the samples, joined back per sample afterwards
+        sentence_lists = [split_sentences(el) for el in data]
+        translated = iter(self.translate_sentences([el for sentence_list in sentence_lists for el in sentence_list]))
+        return [' '.join([next(translated) for _ in sentence_list]) for sentence_list in sentence_lists]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
 
 def main():
     parser = argparse.ArgumentParser(description="Translate sentences with local models.")
     parser.add_argument("--input", help="The input file to process.", default='./data/gz_graph.json')
     parser.add_argument("--model_name", help="The model path to use for translation.", default="facebook/nllb-200-3.3B")
-    parser.add_argument("--batch_size", help="How many sentences to translate at a time.", default=8, type=int)
+    parser.add_argument("--batch_size", help="How many sentences to translate at a time.", default=64, type=int)
+    parser.add_argument("--max_batch_tokens", help="Max padded source tokens per batch of sentences.", default=4096, type=int)
+    parser.add_argument("--num_beams", help="Beams of the beam search, 1 for greedy decoding.", default=5, type=int)
+    parser.add_argument("--stream_dir", help="Directory to stream the sentence translations to batch by batch, and to resume from; '' to disable.", default='./data/translation_memory')
     parser.add_argument("--src_lang", help="Source language.", default="it")
     parser.add_argument("--tgt_lang", help="Target language.", default="en")
     parser.add_argument("--nsamples", help="Number of samples to include, 0 for all.", default=0, type=int)
     parser.add_argument("--quantize", help="Whether to quantize the model when loading.", default=0, type=int)
+    parser.add_argument("--store", help="Dataset store to read the presentations from and add the translations to, instead of --input.", default='')
+    add_runner_args(parser)
     args = parser.parse_args()
-    
-    with open(args.input, 'r', encoding='utf8') as f:
-        data = json.load(f)
+
+    if args.store:
+        store = DatasetStore(args.store)
+        data = store.read_records(['url_it', 'presentation'])
+    else:
+        with open(args.input, 'r', encoding='utf8') as f:
+            data = json.load(f)
 
     if args.nsamples:
         data = data[:args.nsamples]
@@ -114,14 +186,31 @@ def main():
                                         quantization_config=nf4_config if args.quantize else None
                                         )
     print(f'Translating {args.src_lang} to {args.tgt_lang}...')
-    translator = Translator(model, tokenizer, args.batch_size, args.src_lang, args.tgt_lang)
+    translator = Translator(model, tokenizer, args.batch_size, args.src_lang, args.tgt_lang,
+                            max_batch_tokens=args.max_batch_tokens,
+                            num_beams=args.num_beams,
+                            stream_dir=args.stream_dir)
+    # repeated sentences, e.g. of near-duplicate recipes, are translated once through the translation memory
     input = [el['presentation'] for el in data]
-    translated_data = translator.translate(input)
+    if args.work_dir:
+        # this worker translates the chunks it gets; the one finishing the last chunk writes the output
+        runner = runner_from_args(args, len(input), keys=[el['url_it'] for el in data])
+        merging = runner.run(lambda positions: translator.translate([input[i] for i in positions]))
+        translator.close()
+        if not merging:
+            return
+        translated_data = runner.merge()
+    else:
+        translated_data = translator.translate(input)
+        translator.close()
     for i in range(len(data)):
         data[i]['pres_eng'] = translated_data[i]
 
-    with open(args.input.replace('.json', '_eng.json'), 'w', encoding='utf8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    if args.store:
+        store.add_columns('translate', [{'id': el['id'], 'pres_eng': el['pres_eng']} for el in data])
+    else:
+        with open(args.input.replace('.json', '_eng.json'), 'w', encoding='utf8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
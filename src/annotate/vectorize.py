@@ -1,12 +1,20 @@
+import numpy as np
 import torch
 from transformers import AutoModel, AutoTokenizer
 import os
 import sys
 sys.path.append('.')
 from src.utils import GZDataset, compile_single_jsons, load_json
+from src.embedding_store import EmbeddingWriter
 from model.config import proj_config
-from torch.utils.data import DataLoader
+from src.runner import add_runner_args, runner_from_args
+from torch.utils.data import DataLoader, Subset
 from tqdm.auto import tqdm
+import argparse
+
+parser = argparse.ArgumentParser(description="Embed the fields of the gz dataset with a BERT model")
+add_runner_args(parser)
+args = parser.parse_args()
 
 dirname = './data'
 
@@ -30,16 +38,9 @@ device = 'cuda' if torch.cuda.is_available() else 'cpu'
 model = AutoModel.from_pretrained(model_name).to(device)
 
 batch_size = 8
-loader = DataLoader(dataset, batch_size=batch_size)
-
-titl_rep_list = []
-pres_rep_list = []
-ingr_rep_list = []
-step_rep_list = []
-regn_rep_list = []
-ctry_rep_list = []
+fields = ['titl', 'pres', 'ingr', 'step', 'ctry', 'regn']
 
-for i, batch in enumerate(tqdm(loader)):
+def embed_batch(batch):
     titl_rep = model(**{k: v.to(device) for k, v in batch['titl'].items()}).last_hidden_state.mean(dim = 1) * proj_config['lambda_titl']
     pres_rep = model(**{k: v.to(device) for k, v in batch['pres'].items()}).last_hidden_state.mean(dim = 1) * proj_config['lambda_pres']
     ingr_rep = model(**{k: v.to(device) for k, v in batch['ingr'].items()}).last_hidden_state.mean(dim = 1) * proj_config['lambda_ingr']
@@ -58,32 +59,46 @@ for i, batch in enumerate(tqdm(loader)):
     # food_rep_list.append(food_vectors_batch)
     # regn_rep_list.append(regn_vectors_batch)
 
-    titl_rep_list.append(titl_rep.detach())
-    pres_rep_list.append(pres_rep.detach())
-    ingr_rep_list.append(ingr_rep.detach())
-    step_rep_list.append(step_rep.detach())
-    regn_rep_list.append(ctry_rep.detach())
-    ctry_rep_list.append(regn_rep.detach())
+    return dict(zip(fields, [titl_rep, pres_rep, ingr_rep, step_rep, ctry_rep, regn_rep]))
 
-# food_vectors = torch.concat(food_rep_list, dim = 0)
-# regn_vectors = torch.concat(regn_rep_list, dim = 0)
+def embed_rows(positions):
+    # float16 rows of the records at `positions`, for a chunk of a sharded run
+    rows = [{} for _ in positions]
+    loader = DataLoader(Subset(dataset, positions), batch_size=batch_size)
+    with torch.no_grad():
+        for i, batch in enumerate(tqdm(loader)):
+            for field, reps in embed_batch(batch).items():
+                for j, rep in enumerate(reps.float().cpu().numpy().astype('float16')):
+                    rows[i * batch_size + j][field] = rep
+    return rows
 
-titl_vectors = torch.concat(titl_rep_list, dim = 0)
-pres_vectors = torch.concat(pres_rep_list, dim = 0)
-ingr_vectors = torch.concat(ingr_rep_list, dim = 0)
-step_vectors = torch.concat(step_rep_list, dim = 0)
-regn_vectors = torch.concat(regn_rep_list, dim = 0)
-ctry_vectors = torch.concat(ctry_rep_list, dim = 0)
+if args.work_dir:
+    # this worker embeds the chunks it gets; the one finishing the last chunk writes the store
+    runner = runner_from_args(args, len(dataset))
+    if not runner.run(embed_rows):
+        sys.exit(0)
+    rows = runner.merge()
 
-# dataset.update_reps(food_vectors, 'food_vectors')
-# dataset.update_reps(regn_vectors, 'regn_vectors')
+# one memory-mapped float16 matrix per field, read back with `EmbeddingStore`
+save_name = f'gz_{model_names_simple}_emb'
+writer = EmbeddingWriter(os.path.join(dirname, save_name),
+                         fields=fields,
+                         num_rows=len(dataset),
+                         dim=model.config.hidden_size,
+                         ids=[el.get('id', i) for i, el in enumerate(data)],
+                         dtype='float16',
+                         model_name=model_name,
+                         pooling='mean',
+                         )
 
-dataset.update_reps(titl_vectors, 'titl_vectors')
-dataset.update_reps(pres_vectors, 'pres_vectors')
-dataset.update_reps(ingr_vectors, 'ingr_vectors')
-dataset.update_reps(step_vectors, 'step_vectors')
-dataset.update_reps(regn_vectors, 'regn_vectors')
-dataset.update_reps(ctry_vectors, 'ctry_vectors')
+if args.work_dir:
+    for field in fields:
+        writer.write(field, 0, np.stack([el[field] for el in rows]))
+else:
+    loader = DataLoader(dataset, batch_size=batch_size)
+    with torch.no_grad():
+        for i, batch in enumerate(tqdm(loader)):
+            for field, reps in embed_batch(batch).items():
+                writer.write(field, i * batch_size, reps)
 
-save_name = f'gz_{model_name}.pt'
-torch.save(dataset, os.path.join(dirname, save_name))
+writer.close()
@@ -0,0 +1,126 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.append('.')
+from src.runner import ShardedRunner
+
+def work(args):
+    # one worker: squares its items, dies on purpose if asked to, and writes the merged output
+    runner = ShardedRunner(args.work_dir, args.num_items, chunk_size=args.chunk_size)
+    kill_rank = int(os.environ.get('BENCH_KILL_RANK', -1))
+    kill_merge = int(os.environ.get('BENCH_KILL_MERGE', 0))
+
+    def process_fn(positions):
+        if runner.rank == kill_rank:
+            os.kill(os.getpid(), signal.SIGKILL)
+        time.sleep(args.item_time * len(positions))
+        with open(os.path.join(args.work_dir, 'processed.log'), 'a', encoding='utf8') as f:
+            f.write(f'{positions[0]}\n')
+        return [el * el for el in positions]
+    if not runner.run(process_fn):
+        return
+    if kill_merge:
+        os.kill(os.getpid(), signal.SIGKILL)
+    with open(os.path.join(args.work_dir, f'merged-{runner.rank}.json'), 'w', encoding='utf8') as f:
+        json.dump(runner.merge(), f)
+
+def take_over(work_dir, num_items, chunk_size, rank, barrier, queue):
+    runner = ShardedRunner(work_dir, num_items, chunk_size=chunk_size, rank=rank, world_size=rank + 1)
+    barrier.wait()
+    queue.put(runner.claim('chunk-00000'))
+
+def launch(args, work_dir, num_workers, first_rank=0, **env):
+    # like `python src/runner.py --num_workers N`, with ranks starting at `first_rank` so that a rerun cannot
+    # retake the claims of a dead worker as its own
+    command = [sys.executable, __file__, '--worker', '1', '--work_dir', work_dir, '--num_items', str(args.num_items),
+               '--chunk_size', str(args.chunk_size), '--item_time', str(args.item_time)]
+    world_size = first_rank + num_workers
+    processes = [subprocess.Popen(command, env=dict(os.environ, RANK=str(rank), WORLD_SIZE=str(world_size), **env))
+                 for rank in range(first_rank, world_size)]
+    return [el.wait() for el in processes]
+
+def report(args, name, work_dir, return_codes):
+    merged = [el for el in os.listdir(work_dir) if el.startswith('merged-')]
+    with open(os.path.join(work_dir, 'processed.log'), 'r', encoding='utf8') as f:
+        num_processed = len(f.read().split())
+    correct = False
+    if len(merged) == 1:
+        with open(os.path.join(work_dir, merged[0]), 'r', encoding='utf8') as f:
+            correct = json.load(f) == [el * el for el in range(args.num_items)]
+    num_chunks = -(-args.num_items // args.chunk_size)
+    print(f'{name}: return codes {return_codes}, {num_processed} chunks processed for {num_chunks}, '
+          f'{len(merged)} merged outputs, in order: {correct}', flush=True)
+    return correct
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the sharded runner with several local CPU workers, checks the merged output and the resume after a killed worker")
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=3)
+    parser.add_argument("--num_items", type=int, help="Number of items", default=500)
+    parser.add_argument("--chunk_size", type=int, help="Items per chunk", default=20)
+    parser.add_argument("--item_time", type=float, help="Seconds of work per item", default=0.002)
+    parser.add_argument("--worker", type=int, help="Run as one of the workers", default=0)
+    parser.add_argument("--work_dir", help="Shared directory of the workers", default='')
+    args = parser.parse_args()
+
+    if args.worker:
+        work(args)
+        return
+
+    results = []
+    root = tempfile.mkdtemp()
+    try:
+        work_dir = os.path.join(root, 'plain')
+        start = time.perf_counter()
+        return_codes = launch(args, work_dir, 1)
+        print(f'1 worker: {time.perf_counter() - start:.2f} s', flush=True)
+        shutil.rmtree(work_dir)
+        start = time.perf_counter()
+        return_codes = launch(args, work_dir, args.num_workers)
+        print(f'{args.num_workers} workers: {time.perf_counter() - start:.2f} s', flush=True)
+        results.append(report(args, f'{args.num_workers} workers', work_dir, return_codes))
+
+        # the last rank dies on its first chunk, holding its claim; the others may take it over once it is dead
+        work_dir = os.path.join(root, 'killed_worker')
+        return_codes = launch(args, work_dir, args.num_workers, BENCH_KILL_RANK=str(args.num_workers - 1))
+        report(args, f'{args.num_workers} workers, rank {args.num_workers - 1} killed', work_dir, return_codes)
+        return_codes = launch(args, work_dir, 1, first_rank=args.num_workers)
+        results.append(report(args, 'Rerun with one worker of a new rank', work_dir, return_codes))
+
+        # the merging worker dies before writing the output, holding the merge claim
+        work_dir = os.path.join(root, 'killed_merge')
+        return_codes = launch(args, work_dir, args.num_workers, BENCH_KILL_MERGE='1')
+        report(args, f'{args.num_workers} workers, merging worker killed', work_dir, return_codes)
+        return_codes = launch(args, work_dir, 1, first_rank=args.num_workers)
+        results.append(report(args, 'Rerun with one worker of a new rank', work_dir, return_codes))
+
+        # several workers find the same dead claim at once: only one of them may take it over
+        work_dir = os.path.join(root, 'takeover')
+        ShardedRunner(work_dir, args.num_items, chunk_size=args.chunk_size, rank=0, world_size=1)
+        dead = subprocess.Popen([sys.executable, '-c', ''])
+        dead.wait()
+        with open(os.path.join(work_dir, 'chunk-00000.claim'), 'w', encoding='utf8') as f:
+            json.dump({'rank': 0, 'host': os.uname().nodename, 'pid': dead.pid}, f)
+        barrier, queue = multiprocessing.Barrier(args.num_workers), multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=take_over, args=(work_dir, args.num_items, args.chunk_size, rank, barrier, queue))
+                     for rank in range(1, args.num_workers + 1)]
+        for process in processes:
+            process.start()
+        num_taken = sum([queue.get() for _ in processes])
+        for process in processes:
+            process.join()
+        print(f'{args.num_workers} workers taking over the same dead claim at once: {num_taken} took it', flush=True)
+        results.append(num_taken == 1)
+    finally:
+        shutil.rmtree(root)
+    if not all(results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
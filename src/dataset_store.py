@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import sys
+sys.path.append('.')
+from src.shards import dump_json_stream
+
+MANIFEST = 'manifest.json'
+
+def is_nested(value) -> bool:
+    return isinstance(value, dict) or (isinstance(value, list) and any(isinstance(el, (dict, list)) for el in value))
+
+def records_to_table(records: List[Dict], key: str = 'id') -> Tuple[pa.Table, List[str]]:
+    """Builds an Arrow table from `records`, sorted by `key`.
+
+    Columns with dicts, or mixed types that Arrow cannot infer (e.g. `region_gold` being a list or 'UNK'),
+    are stored as JSON strings and returned as `json_columns`, so records round-trip unchanged.
+    """
+    records = sorted(records, key=lambda x: x[key])
+    columns = {}
+    for record in records:
+        for k in record:
+            columns.setdefault(k, None)
+    arrays, json_columns = {}, []
+    for column in columns:
+        values = [el.get(column) for el in records]
+        array = None
+        if not any(is_nested(el) for el in values):
+            try:
+                array = pa.array(values)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, OverflowError):
+                array = None
+        if array is None:
+            array = pa.array([None if el is None else json.dumps(el, ensure_ascii=False) for el in values], pa.string())
+            json_columns.append(column)
+        arrays[column] = array
+    return pa.table(arrays), json_columns
+
+def table_to_records(table: pa.Table, json_columns: List[str]) -> List[Dict]:
+    records = table.to_pylist()
+    json_columns = [el for el in json_columns if el in table.column_names]
+    for record in records:
+        for column in json_columns:
+            if record[column] is not None:
+                record[column] = json.loads(record[column])
+    return records
+
+class DatasetStore:
+    """Columnar dataset stored as a directory of Parquet files, one per column group, joined on `key`.
+
+    The first group (`base`) holds the whole dataset; each stage adds its own group with only the
+    columns it produces, e.g. `add_columns('golds', [{'id': 0, 'region_gold': ...}, ...])`.
+    When several groups have the same column, the one added last wins. Files are sorted by `key`
+    and written in row groups of `row_group_size`, so `read(id_range=...)` skips row groups by their statistics.
+    """
+    def __init__(self, path: str, key: str = 'id', row_group_size: int = 2048):
+        self.path = path
+        self.key = key
+        self.row_group_size = row_group_size
+        self.manifest = {'key': key, 'groups': []}
+        if os.path.exists(os.path.join(self.path, MANIFEST)):
+            with open(os.path.join(self.path, MANIFEST), 'r', encoding='utf8') as f:
+                self.manifest = json.load(f)
+            self.key = self.manifest['key']
+
+    @property
+    def exists(self) -> bool:
+        return bool(self.manifest['groups'])
+
+    def columns(self) -> List[str]:
+        return list(self.owners())
+
+    def groups(self, group_names: List[str] = None) -> List[Dict]:
+        if group_names is None:
+            return self.manifest['groups']
+        return [el for el in self.manifest['groups'] if el['name'] in group_names]
+
+    def owners(self, group_names: List[str] = None) -> Dict[str, Dict]:
+        # the last group with a column provides it
+        owner = {}
+        for group in self.groups(group_names):
+            for column in group['columns']:
+                owner[column] = group
+        return owner
+
+    def group(self, name: str) -> Dict:
+        return next((el for el in self.manifest['groups'] if el['name'] == name), None)
+
+    def write(self, records: List[Dict]):
+        """Replaces the store with `records`; records without `key` get their position as key."""
+        if records and self.key not in records[0]:
+            records = [{self.key: i, **el} for i, el in enumerate(records)]
+        self.manifest['groups'] = []
+        self._write_group('base', records)
+
+    def add_columns(self, name: str, records: List[Dict], update: bool = True):
+        """Stores the columns of `records` (which must have `key`) as group `name`.
+
+        With `update`, rows of an existing group `name` that are not in `records` are kept,
+        so a stage can write back only the rows it re-processed.
+        """
+        if not self.exists:
+            raise FileNotFoundError(f'{self.path} has no base data, write it first')
+        previous = self.group(name)
+        if previous is not None and update:
+            new_keys = set([el[self.key] for el in records])
+            kept = [el for el in self.read_records(group_names=[name]) if el[self.key] not in new_keys]
+            records = kept + records
+        self._write_group(name, records)
+
+    def _write_group(self, name: str, records: List[Dict]):
+        os.makedirs(self.path, exist_ok=True)
+        table, json_columns = records_to_table(records, self.key)
+        filename = f'{name}.parquet'
+        tmp_path = os.path.join(self.path, f'{filename}.{os.getpid()}.tmp')
+        pq.write_table(table, tmp_path, row_group_size=self.row_group_size, compression='zstd')
+        os.replace(tmp_path, os.path.join(self.path, filename))
+        groups = [el for el in self.manifest['groups'] if el['name'] != name]
+        groups.append({
+            'name': name,
+            'file': filename,
+            'columns': [el for el in table.column_names if el != self.key],
+            'json_columns': json_columns,
+            'num_rows': table.num_rows,
+        })
+        self.manifest['groups'] = groups
+        tmp_path = os.path.join(self.path, f'{MANIFEST}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    def read(self, columns: List[str] = None, id_range: Tuple[int, int] = None, group_names: List[str] = None) -> pa.Table:
+        """Reads `columns` (all if None) of the rows with `id_range[0] <= key < id_range[1]`.
+
+        Only the Parquet files holding the requested columns are opened, and only those columns are read.
+        """
+        groups = self.groups(group_names)
+        owner = {k: v['name'] for k, v in self.owners(group_names).items()}
+        if columns is None:
+            columns = list(owner)
+        missing = [el for el in columns if el != self.key and el not in owner]
+        if missing:
+            raise KeyError(f'Columns not in {self.path}: {missing}')
+        filters = None
+        if id_range is not None:
+            filters = [(self.key, '>=', id_range[0]), (self.key, '<', id_range[1])]
+        table = None
+        # the base group always provides the rows, even when only `key` is requested
+        for group in groups[:1] + [el for el in groups[1:] if el['name'] in owner.values()]:
+            group_columns = [el for el in columns if owner.get(el) == group['name']]
+            if table is not None and not group_columns:
+                continue
+            group_table = pq.read_table(os.path.join(self.path, group['file']), columns=[self.key] + group_columns, filters=filters)
+            if table is None:
+                table = group_table
+                continue
+            # left join on `key` (Arrow's join does not take list columns): null for rows the group lacks
+            index = pc.index_in(table[self.key], value_set=group_table[self.key])
+            for column in group_columns:
+                table = table.append_column(column, group_table[column].take(index))
+        table = table.sort_by(self.key)
+        return table.select([self.key] + [el for el in columns if el != self.key])
+
+    def read_records(self, columns: List[str] = None, id_range: Tuple[int, int] = None, group_names: List[str] = None) -> List[Dict]:
+        json_columns = [k for k, v in self.owners(group_names).items() if k in v['json_columns']]
+        return table_to_records(self.read(columns, id_range, group_names), json_columns)
+
+    def iter_records(self, columns: List[str] = None, batch_size: int = 10000) -> Iterator[Dict]:
+        """Yields the records in batches of `batch_size` ids, never holding the whole table in memory."""
+        num_rows = self.manifest['groups'][0]['num_rows']
+        base = pq.read_table(os.path.join(self.path, self.manifest['groups'][0]['file']), columns=[self.key])
+        keys = sorted(base[self.key].to_pylist())
+        for i in range(0, num_rows, batch_size):
+            id_range = (keys[i], keys[min(i + batch_size, num_rows) - 1] + 1)
+            yield from self.read_records(columns, id_range)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a JSON dataset to a columnar dataset store and back")
+    parser.add_argument("--json", help="JSON list of records", default='./data/gz_bilingual_graph.json')
+    parser.add_argument("--store", help="Dataset store directory", default='./data/gz_bilingual_graph.parquet')
+    parser.add_argument("--to_json", type=int, help="Whether to export the store to --json instead of importing it", default=0)
+    args = parser.parse_args()
+
+    store = DatasetStore(args.store)
+    if args.to_json:
+        dump_json_stream(store.iter_records(), args.json, indent=4)
+        print(f'Exported {store.manifest["groups"][0]["num_rows"]} records to {args.json}')
+    else:
+        with open(args.json, 'r', encoding='utf8') as f:
+            data = json.load(f)
+        store.write(data)
+        print(f'Stored {len(data)} records with columns {store.columns()} in {args.store}')
+
+if __name__ == "__main__":
+    main()
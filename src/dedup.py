@@ -0,0 +1,157 @@
+import argparse
+import json
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, List
+import numpy as np
+from tqdm.auto import tqdm
+
+# (a * x + b) % PRIME over 32-bit shingle hashes; a < 2**31 keeps the products within uint64
+PRIME = np.uint64(4294967311)
+MAX_HASH = np.uint64(2**32 - 1)
+
+DEDUP_FIELDS = ('steps_it', 'ingredients_it', 'presentation_it')
+
+def record_text(record: Dict, fields = DEDUP_FIELDS) -> str:
+    texts = []
+    for field in fields:
+        value = record.get(field)
+        if isinstance(value, list):
+            texts += [str(el) for el in value]
+        elif value:
+            texts.append(str(value))
+    return ' '.join(texts)
+
+def shingles(text: str, k: int = 3) -> set:
+    """Lowercased word `k`-grams of `text`."""
+    tokens = re.findall(r'\w+', text.lower())
+    if len(tokens) < k:
+        return set([' '.join(tokens)]) if tokens else set()
+    return set([' '.join(tokens[i:i + k]) for i in range(len(tokens) - k + 1)])
+
+class MinHasher:
+    def __init__(self, num_perm: int = 128, seed: int = 42):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(1, 2**31, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, 2**32, size=(num_perm, 1), dtype=np.uint64)
+
+    def signature(self, shingle_set: set) -> np.ndarray:
+        hashes = np.array([zlib.crc32(el.encode('utf8')) for el in shingle_set], dtype=np.uint64)
+        if not len(hashes):
+            return None
+        return ((self.a * hashes[np.newaxis, :] + self.b) % PRIME & MAX_HASH).min(axis=1).astype(np.uint32)
+
+class UnionFind:
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            # the smallest index is the root, so each cluster is represented by its first record
+            self.parent[max(root_i, root_j)] = min(root_i, root_j)
+
+def find_clusters(texts: List[str],
+                  threshold: float = 0.8,
+                  num_perm: int = 128,
+                  bands: int = 16,
+                  k: int = 3,
+                  seed: int = 42,
+                  ) -> List[List[int]]:
+    """Groups the indices of near-duplicate `texts` with MinHash signatures and LSH banding.
+
+    Texts sharing a band bucket are candidates, kept only if their estimated Jaccard similarity
+    is at least `threshold`; candidates are unioned, so a cluster may chain similar pairs.
+    Returns the clusters with more than one text, each sorted, the first index being the representative.
+    """
+    if num_perm % bands:
+        raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+    rows = num_perm // bands
+    hasher = MinHasher(num_perm, seed)
+    signatures = [hasher.signature(shingles(el, k)) for el in tqdm(texts, desc='MinHash')]
+
+    union_find = UnionFind(len(texts))
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for i, signature in enumerate(signatures):
+            if signature is not None:
+                buckets[signature[band * rows:(band + 1) * rows].tobytes()].append(i)
+        for bucket in buckets.values():
+            first = bucket[0]
+            for i in bucket[1:]:
+                if union_find.find(i) == union_find.find(first):
+                    continue
+                if np.mean(signatures[first] == signatures[i]) >= threshold:
+                    union_find.union(first, i)
+
+    clusters = defaultdict(list)
+    for i in range(len(texts)):
+        clusters[union_find.find(i)].append(i)
+    return [el for el in clusters.values() if len(el) > 1]
+
+def load_clusters(path: str) -> Dict[str, str]:
+    """Maps each duplicate URL of a `dedup.py` cluster file to the URL of its representative."""
+    with open(path, 'r', encoding='utf8') as f:
+        clusters = json.load(f)
+    return {member: rep for rep, members in clusters.items() for member in members}
+
+def split_duplicates(records: List[Dict], member2rep: Dict[str, str], fields: List[str], key: str = 'url_it'):
+    """Splits `records` into those to process and the duplicates whose representative is among them.
+
+    Clusters are near-duplicates over the whole recipe, so a record only counts as a duplicate if it has the
+    same `fields` as its representative, i.e. the fields the results are computed from, and copying them is exact.
+    """
+    key2record = {el[key]: el for el in records}
+    todo, duplicates = [], []
+    for record in records:
+        rep_record = key2record.get(member2rep.get(record[key]))
+        if rep_record is not None and all([record.get(k) == rep_record.get(k) for k in fields]):
+            duplicates.append(record)
+        else:
+            todo.append(record)
+    return todo, duplicates
+
+def copy_to_duplicates(results: List[Dict], duplicates: List[Dict], member2rep: Dict[str, str], new_keys, key: str = 'url_it') -> List[Dict]:
+    """Updates each of `duplicates` in place with the `new_keys` of its representative's result."""
+    rep_results = {el[key]: el for el in results}
+    for record in duplicates:
+        rep_result = rep_results.get(member2rep[record[key]])
+        if rep_result is not None:
+            record.update({k: rep_result[k] for k in new_keys if k in rep_result})
+    return duplicates
+
+def main():
+    parser = argparse.ArgumentParser(description="Find near-duplicate recipes with MinHash/LSH")
+    parser.add_argument("--input", help="JSON list of recipes", default='./data/gz_bilingual_graph.json')
+    parser.add_argument("--output", help="Cluster file: representative url_it -> duplicate url_its", default='./data/gz_duplicates.json')
+    parser.add_argument("--threshold", type=float, help="Min estimated Jaccard similarity of word shingles", default=0.8)
+    parser.add_argument("--num_perm", type=int, help="Number of MinHash permutations", default=128)
+    parser.add_argument("--bands", type=int, help="Number of LSH bands, dividing num_perm", default=16)
+    parser.add_argument("--shingle_size", type=int, help="Words per shingle", default=3)
+    args = parser.parse_args()
+
+    with open(args.input, 'r', encoding='utf8') as f:
+        data = json.load(f)
+
+    clusters = find_clusters([record_text(el) for el in data],
+                             threshold=args.threshold,
+                             num_perm=args.num_perm,
+                             bands=args.bands,
+                             k=args.shingle_size,
+                             )
+    cluster_dict = {data[el[0]]['url_it']: [data[i]['url_it'] for i in el[1:]] for el in clusters}
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(cluster_dict, f, ensure_ascii=False, indent=4)
+    num_duplicates = sum([len(el) for el in cluster_dict.values()])
+    print(f'{len(cluster_dict)} clusters, {num_duplicates} duplicates out of {len(data)} recipes')
+
+if __name__ == "__main__":
+    main()
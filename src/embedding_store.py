@@ -0,0 +1,107 @@
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+import numpy as np
+
+META = 'meta.json'
+
+class EmbeddingWriter:
+    """Writes one `<field>.npy` matrix of `num_rows` x `dim` per field into `path`, batch by batch.
+
+    The matrices are preallocated as memory maps, so batches go straight to disk at their row offset
+    instead of being accumulated in memory. `ids` (the dataset ids of the rows) are saved as `ids.npy`,
+    and `meta.json`, written by `close`, has the model name, pooling, dimension and dtype.
+    """
+    def __init__(self,
+                 path: str,
+                 fields: List[str],
+                 num_rows: int,
+                 dim: int,
+                 ids: List[int] = None,
+                 dtype: str = 'float16',
+                 model_name: str = '',
+                 pooling: str = 'mean',
+                 ):
+        self.path = path
+        self.fields = fields
+        self.num_rows = num_rows
+        self.dim = dim
+        self.dtype = dtype
+        self.meta = {
+            'model_name': model_name,
+            'pooling': pooling,
+            'dim': dim,
+            'dtype': dtype,
+            'num_rows': num_rows,
+            'fields': fields,
+        }
+        os.makedirs(self.path, exist_ok=True)
+        # a store with a meta.json is complete, so remove it until the new one is
+        if os.path.exists(os.path.join(self.path, META)):
+            os.remove(os.path.join(self.path, META))
+        ids = np.arange(num_rows, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        np.save(os.path.join(self.path, 'ids.npy'), ids)
+        self.arrays = {field: np.lib.format.open_memmap(os.path.join(self.path, f'{field}.npy'),
+                                                        mode='w+',
+                                                        dtype=dtype,
+                                                        shape=(num_rows, dim))
+                       for field in fields}
+
+    def write(self, field: str, start: int, vectors):
+        """Writes `vectors` (a numpy array or a torch tensor) to rows `start:start + len(vectors)` of `field`."""
+        if hasattr(vectors, 'detach'):
+            vectors = vectors.detach().float().cpu().numpy()
+        self.arrays[field][start:start + len(vectors)] = vectors
+
+    def close(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+        with open(os.path.join(self.path, META), 'w', encoding='utf8') as f:
+            json.dump(self.meta, f, ensure_ascii=False, indent=4)
+
+class EmbeddingStore:
+    """Read-only view of an `EmbeddingWriter` output: fields are memory-mapped, not loaded.
+
+    `store['titl'][i:j]` only reads those rows from disk, and `store.rows('titl', ids)` looks rows up by dataset id.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        meta_path = os.path.join(self.path, META)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f'{meta_path} not found: {self.path} is not a complete embedding store')
+        with open(meta_path, 'r', encoding='utf8') as f:
+            self.meta: Dict = json.load(f)
+        self.ids = np.load(os.path.join(self.path, 'ids.npy'))
+        self.id2row = None
+        self.arrays = {}
+
+    @property
+    def fields(self) -> List[str]:
+        return self.meta['fields']
+
+    @property
+    def dim(self) -> int:
+        return self.meta['dim']
+
+    def __len__(self):
+        return self.meta['num_rows']
+
+    def __getitem__(self, field: str) -> np.ndarray:
+        if field not in self.arrays:
+            if field not in self.fields:
+                raise KeyError(f'{field} not in {self.path}, fields: {self.fields}')
+            self.arrays[field] = np.load(os.path.join(self.path, f'{field}.npy'), mmap_mode='r')
+        return self.arrays[field]
+
+    def rows(self, field: str, ids: List[int]) -> np.ndarray:
+        if self.id2row is None:
+            self.id2row = {el: i for i, el in enumerate(self.ids.tolist())}
+        return self[field][[self.id2row[el] for el in ids]]
+
+    def iter_batches(self, field: str, batch_size: int = 4096, dtype: str = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yields `(ids, vectors)` slices of `field`, optionally cast to `dtype` (e.g. 'float32')."""
+        array = self[field]
+        for i in range(0, len(self), batch_size):
+            vectors = array[i:i + batch_size]
+            yield self.ids[i:i + batch_size], np.asarray(vectors, dtype=dtype) if dtype else vectors
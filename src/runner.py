@@ -0,0 +1,213 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+import zlib
+from typing import Callable, List
+
+PLAN = 'plan.json'
+# seconds between taking over a claim and reading it back, longer than it takes a worker to replace a claim it read
+TAKEOVER_SETTLE = 1.0
+
+def get_rank_world(rank: int = -1, world_size: int = -1):
+    """This worker's rank and the number of workers, from SLURM or torchrun-style variables unless given."""
+    if rank < 0:
+        rank = int(os.environ.get('SLURM_PROCID', os.environ.get('RANK', 0)))
+    if world_size < 1:
+        world_size = int(os.environ.get('SLURM_NTASKS', os.environ.get('WORLD_SIZE', 1)))
+    return rank, world_size
+
+def make_chunks(num_items: int, chunk_size: int, assign: str = 'range', keys: List[str] = None) -> List[List[int]]:
+    """Splits positions `0..num_items-1` into chunks of about `chunk_size`.
+
+    'range' makes contiguous chunks; 'hash' puts each item in the chunk of the CRC32 of its key
+    (e.g. its URL, its position if `keys` is None), so that chunks do not depend on the corpus order.
+    """
+    num_chunks = max(1, -(-num_items // chunk_size))
+    if assign == 'range':
+        return [list(range(i, min(i + chunk_size, num_items))) for i in range(0, num_items, chunk_size)] or [[]]
+    if assign == 'hash':
+        chunks = [[] for _ in range(num_chunks)]
+        for i in range(num_items):
+            key = keys[i] if keys is not None else str(i)
+            chunks[zlib.crc32(key.encode('utf8')) % num_chunks].append(i)
+        return chunks
+    raise ValueError(f'Unknown assignment: {assign}')
+
+class ShardedRunner:
+    """Splits the items of a job into chunks that any number of workers process through a shared `work_dir`.
+
+    Each worker first takes the chunks of its own deterministic shard, then those that are still unclaimed,
+    starting from the far end, so that fast workers take over the tail of slow ones. A chunk is claimed by
+    creating `chunk-<n>.claim` exclusively, which works across processes and nodes on a shared filesystem,
+    and its results are written atomically to `chunk-<n>.pkl`. A restarted worker picks up its own claims
+    again, the claims of dead processes of the same host, and other workers' after `stale_after` seconds
+    (0 for never), so finished chunks are never redone. The worker that finds every chunk done gets to
+    `merge` the results back into corpus order, which is claimed the same way: if the merging worker dies
+    on another node, only a worker of the same rank, or `stale_after`, lets the merge be done again.
+    A claim taken over is replaced atomically and only kept if it reads back the same `TAKEOVER_SETTLE`
+    seconds later, so that two workers never take over the same claim.
+    """
+    def __init__(self,
+                 work_dir: str,
+                 num_items: int,
+                 chunk_size: int = 256,
+                 assign: str = 'range',
+                 keys: List[str] = None,
+                 rank: int = -1,
+                 world_size: int = -1,
+                 stale_after: float = 0,
+                 ):
+        self.work_dir = work_dir
+        self.num_items = num_items
+        self.rank, self.world_size = get_rank_world(rank, world_size)
+        self.stale_after = stale_after
+        self.chunks = make_chunks(num_items, chunk_size, assign, keys)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.check_plan(chunk_size, assign, keys)
+
+    def check_plan(self, chunk_size: int, assign: str, keys: List[str]):
+        # all the workers, including those of earlier runs, must split the same items the same way
+        plan = {'num_items': self.num_items, 'chunk_size': chunk_size, 'assign': assign,
+                'keys_sha1': hashlib.sha1(json.dumps(keys).encode('utf8')).hexdigest()}
+        path = os.path.join(self.work_dir, PLAN)
+        if self.create_exclusive(path, json.dumps(plan, indent=4)):
+            return
+        with open(path, 'r', encoding='utf8') as f:
+            existing = json.load(f)
+        if existing != plan:
+            raise ValueError(f'{self.work_dir} was made for a different job ({existing}), use a new --work_dir')
+
+    def create_exclusive(self, path: str, content: str) -> bool:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            f.write(content)
+        return True
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.work_dir, name)
+
+    def is_done(self, index: int) -> bool:
+        return os.path.exists(self.path(f'chunk-{index:05d}.pkl'))
+
+    def pending(self) -> List[int]:
+        return [i for i in range(len(self.chunks)) if not self.is_done(i)]
+
+    def order(self) -> List[int]:
+        num_chunks = len(self.chunks)
+        own = [i for i in range(num_chunks) if i * self.world_size // num_chunks == self.rank]
+        others = [i for i in range(num_chunks) if i * self.world_size // num_chunks != self.rank]
+        return own + others[::-1]
+
+    def claim(self, name: str) -> bool:
+        path = self.path(f'{name}.claim')
+        content = json.dumps({'rank': self.rank, 'host': os.uname().nodename, 'pid': os.getpid()})
+        if self.create_exclusive(path, content):
+            return True
+        try:
+            with open(path, 'r', encoding='utf8') as f:
+                owner = json.load(f)
+            age = time.time() - os.path.getmtime(path)
+        except (OSError, ValueError):
+            # being written by another worker
+            return False
+        if not (owner['rank'] == self.rank or self.is_dead(owner) or (self.stale_after and age > self.stale_after)):
+            return False
+        # replaced atomically and read back a bit later: of the workers taking over the same claim at once,
+        # only the last one to replace it keeps it
+        tmp_path = f'{path}.{self.rank}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        time.sleep(TAKEOVER_SETTLE)
+        try:
+            with open(path, 'r', encoding='utf8') as f:
+                return f.read() == content
+        except OSError:
+            return False
+
+    def is_dead(self, owner: dict) -> bool:
+        # only the processes of this host can be checked
+        if owner.get('host') != os.uname().nodename:
+            return False
+        try:
+            os.kill(owner['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def save(self, index: int, results: List):
+        path = self.path(f'chunk-{index:05d}.pkl')
+        tmp_path = f'{path}.{self.rank}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def run(self, process_fn: Callable[[List[int]], List]) -> bool:
+        """Calls `process_fn(positions)` on the chunks this worker gets, which must return one result
+        per position. Returns whether this worker should merge, i.e. every chunk is done and no other
+        worker is merging."""
+        num_done = 0
+        for index in self.order():
+            if self.is_done(index) or not self.claim(f'chunk-{index:05d}'):
+                continue
+            results = process_fn(self.chunks[index])
+            if len(results) != len(self.chunks[index]):
+                raise ValueError(f'Chunk {index}: {len(results)} results for {len(self.chunks[index])} items')
+            self.save(index, results)
+            num_done += 1
+        pending = self.pending()
+        print(f'Worker {self.rank}/{self.world_size}: {num_done} chunks processed, {len(pending)}/{len(self.chunks)} chunks left to other workers.', flush=True)
+        return not pending and self.claim('merge')
+
+    def merge(self) -> List:
+        """The results of all the chunks, in the order of the items."""
+        results = [None] * self.num_items
+        for index, positions in enumerate(self.chunks):
+            with open(self.path(f'chunk-{index:05d}.pkl'), 'rb') as f:
+                chunk_results = pickle.load(f)
+            for position, result in zip(positions, chunk_results):
+                results[position] = result
+        return results
+
+def add_runner_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--work_dir", help="Shared directory of the chunks of a sharded run (see src/runner.py), '' to run in a single process", default='')
+    parser.add_argument("--chunk_size", type=int, help="Items per chunk of a sharded run", default=256)
+    parser.add_argument("--assign", choices=['range', 'hash'], help="How the items are split into chunks: by position or by hash of their key", default='range')
+    parser.add_argument("--stale_after", type=float, help="Seconds after which a chunk (or the merge) claimed by a worker of another node is taken over, 0 for never; claims of dead processes of the same node are always taken over", default=0)
+
+def runner_from_args(args, num_items: int, keys: List[str] = None) -> ShardedRunner:
+    return ShardedRunner(args.work_dir, num_items, chunk_size=args.chunk_size, assign=args.assign, keys=keys, stale_after=args.stale_after)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a script with --work_dir in several local worker processes, e.g. python src/runner.py --num_workers 4 -- python src/annotate/bert_ner.py --work_dir ./data/ner_work")
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=2)
+    parser.add_argument("--gpus", help="Comma-separated GPU ids to spread the workers over, '' to leave CUDA_VISIBLE_DEVICES alone", default='')
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="The worker command, after --")
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    gpus = [el for el in args.gpus.split(',') if el]
+    processes = []
+    for rank in range(args.num_workers):
+        env = dict(os.environ, RANK=str(rank), WORLD_SIZE=str(args.num_workers))
+        if gpus:
+            env['CUDA_VISIBLE_DEVICES'] = gpus[rank % len(gpus)]
+        processes.append(subprocess.Popen(command, env=env))
+    return_codes = [el.wait() for el in processes]
+    failed = [rank for rank, code in enumerate(return_codes) if code]
+    if failed:
+        print(f'Workers {failed} failed, rerun to finish their chunks.', flush=True)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import argparse
+import time
+import sys
+sys.path.append('.')
+from src.scrape.scrape import Scraper, Recipe
+from src.scrape.extract import RecipeExtractor
+
+def parse_with(scraper, html):
+    recipe = Recipe(id=0)
+    recipe.url_it = 'example'
+    data, featured, url_en = scraper.parse_page(html, recipe=recipe, lang='it')
+    return data, featured, url_en, recipe
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the lxml extractor against BeautifulSoup on a recipe page and times both")
+    parser.add_argument("--html_path", help="Recipe page to parse", default='./misc/example.html')
+    parser.add_argument("--num_iters", type=int, help="Number of timed parses per backend", default=50)
+    args = parser.parse_args()
+
+    with open(args.html_path, 'r', encoding='utf8') as f:
+        html = f.read()
+
+    scraper_list = [
+        ('bs4 html.parser', Scraper(save_dir='', save_images=False)),
+        ('bs4 lxml', Scraper(save_dir='', save_images=False, parser='lxml')),
+        ('bs4 lxml strain', Scraper(save_dir='', save_images=False, parser='lxml', strain=True)),
+        ('lxml extractor', Scraper(save_dir='', save_images=False, backend='lxml')),
+    ]
+
+    # the extractor must return exactly what the BeautifulSoup backend does
+    *reference, ref_recipe = parse_with(scraper_list[0][1], html)
+    for name, scraper in scraper_list[1:]:
+        *result, recipe = parse_with(scraper, html)
+        if result != reference or recipe.to_dict() != ref_recipe.to_dict():
+            print(f"{name} output differs from bs4 html.parser", flush=True)
+            sys.exit(1)
+    page = RecipeExtractor().extract(html)
+    print(f"Outputs match: {len(page['ingredients'])} ingredients, {len(page['steps'])} steps, {len(page['related_urls'])} related urls")
+
+    base_time = None
+    for name, scraper in scraper_list:
+        start = time.perf_counter()
+        for _ in range(args.num_iters):
+            parse_with(scraper, html)
+        page_time = (time.perf_counter() - start) / args.num_iters
+        base_time = base_time or page_time
+        print(f"{name:>16}: {page_time * 1000:.2f} ms/page ({base_time / page_time:.1f}x)")
+
+if __name__ == "__main__":
+    main()
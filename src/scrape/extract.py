@@ -0,0 +1,189 @@
+import re
+from typing import Dict, List
+import lxml.html
+from lxml import etree
+
+# tags whose strings BeautifulSoup keeps as their own string types, which `get_text` on other tags skips
+STRING_CONTAINER_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+
+html_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+def has_class(*classes):
+    return ' and '.join([f"contains(concat(' ', normalize-space(@class), ' '), ' {el} ')" for el in classes])
+
+# CSS selectors of `Scraper._parse_recipe_page`, compiled once; ancestor:: mirrors how soupsieve
+# matches descendant combinators against the whole document
+XPATH = {
+    'presentation_block': etree.XPath(f"(//div[{has_class('gz-content-recipe', 'gz-mBottom4x')}])[1]"),
+    'presentation_img': etree.XPath(f"(//img[ancestor::picture[{has_class('gz-featured-image')}]])[1]"),
+    'ingredients_container': etree.XPath(f"(//div[{has_class('gz-ingredients', 'gz-mBottom4x', 'gz-outer')}])[1]"),
+    'ingredient_items': etree.XPath(f".//dd[{has_class('gz-ingredient')}]"),
+    'step_blocks': etree.XPath(f"//div[{has_class('gz-content-recipe-step')}][ancestor::div[{has_class('gz-content-recipe', 'gz-mBottom4x')}]]"),
+    'step_img_full': etree.XPath(f"(.//picture[{has_class('gz-content-recipe-step-img', 'gz-content-recipe-step-img-full')}][ancestor::div[{has_class('gz-content-recipe-step-img-container')}]])[1]"),
+    'step_img_single': etree.XPath(f".//picture[{has_class('gz-content-recipe-step-img', 'gz-content-recipe-step-img-single')}][ancestor::div[{has_class('gz-content-recipe-step-img-container')}]]"),
+    'related_1': etree.XPath(f"//div[{has_class('gz-related-swiper')}][ancestor::div[{has_class('gz-swiper-element-shadowed', 'gz-mBottom3x')}]]"),
+    'related_2': etree.XPath(f"//section[{has_class('gz-related', 'gz-pTop3x')}][ancestor::div[{has_class('gz-content', 'gz-elevator-ame-base')}]]"),
+    'related_2_titles': etree.XPath(f".//h2[{has_class('gz-title')}]"),
+    'featured_container': etree.XPath(f"(//div[{has_class('gz-featured-data-cnt')}])[1]"),
+    'calories': etree.XPath(f"(.//span[ancestor::*[{has_class('gz-text-calories-total')}]])[1]"),
+    'featured_items': etree.XPath(f".//li[ancestor::ul[ancestor::*[{has_class('gz-list-featured-data')} or {has_class('gz-list-featured-data-other')}]]]"),
+}
+
+def is_tag(el) -> bool:
+    # comments and processing instructions are nodes in lxml, but strings in BeautifulSoup
+    return isinstance(el.tag, str)
+
+def iter_strings(el, interesting = None, container = None):
+    """Yields the strings of `el`'s subtree that BeautifulSoup's `get_text` would, in document order."""
+    if el.tag in STRING_CONTAINER_TAGS:
+        container = el.tag
+    keep = container == interesting
+    if el.text and keep:
+        yield el.text
+    for child in el:
+        if is_tag(child):
+            yield from iter_strings(child, interesting, container)
+        if child.tail and keep:
+            yield child.tail
+
+def get_text(el, separator: str = '', strip: bool = False) -> str:
+    """`Tag.get_text` for an lxml element."""
+    interesting = el.tag if el.tag in STRING_CONTAINER_TAGS else None
+    strings = iter_strings(el, interesting)
+    if strip:
+        strings = [s.strip() for s in strings]
+        strings = [s for s in strings if s]
+    return separator.join(strings)
+
+def flatten_contents(el) -> List:
+    """`Scraper.flatten_contents(tag.contents)`: strings and the tags without child tags, in order."""
+    flattened = []
+    if el.text:
+        flattened.append(el.text)
+    for child in el:
+        if not is_tag(child):
+            flattened.append(child.text or '')
+        elif any(is_tag(grandchild) for grandchild in child):
+            flattened += flatten_contents(child)
+        else:
+            flattened.append(child)
+        if child.tail:
+            flattened.append(child.tail)
+    return flattened
+
+def get_classes(el) -> List[str]:
+    return (el.get('class') or '').split()
+
+def first(el_list):
+    return el_list[0] if el_list else None
+
+def find(el, tag):
+    # `Tag.find(tag)`: the first descendant with that tag
+    return next((child for child in el.iter(tag) if child is not el), None)
+
+class RecipeExtractor:
+    """lxml backend for `Scraper`: gets everything the scraper reads from a recipe page with precompiled XPaths.
+
+    `extract` returns the dict of `Scraper._parse_recipe_page` plus the image URLs, featured data and
+    translation link, which the scraper then handles exactly as in the BeautifulSoup backend.
+    """
+    def parse(self, html) -> etree._Element:
+        if isinstance(html, str):
+            html = html.encode('utf8')
+        return lxml.html.document_fromstring(html, parser=html_parser)
+
+    def extract(self, html) -> Dict:
+        root = self.parse(html)
+        data = {
+            "presentation": None,
+            "ingredients": [],
+            "steps": [],
+            "presentation_urls": set(),
+            "related_urls": set(),
+            "presentation_img_url": None,
+            "step_imgs": [],
+            "translation_url": None,
+            "featured": None,
+        }
+
+        # presentation
+        presentation_block = first(XPATH['presentation_block'](root))
+        if presentation_block is not None:
+            p_tags = [el for el in presentation_block if el.tag == 'p']
+            if p_tags:
+                paragraphs = [get_text(p, " ", strip=True) for p in p_tags]
+                data["presentation"] = "\n\n".join(paragraphs)
+            else:
+                data["presentation"] = get_text(presentation_block, " ", strip=True)
+
+            translation_link = None
+            for a in presentation_block.iter('a'):  # the block is a div, so iter only yields descendants
+                if 'class' not in a.attrib and 'href' in a.attrib:
+                    if 'ricette.giallozafferano' in a.attrib['href']:
+                        data["presentation_urls"].add(a.attrib['href'])
+                if translation_link is None and a.get('id') == 'gz-translation-link':
+                    translation_link = a
+            if translation_link is not None and translation_link.attrib['href']:
+                data["translation_url"] = translation_link.attrib['href']
+
+        pres_img = first(XPATH['presentation_img'](root))
+        if pres_img is not None:
+            data["presentation_img_url"] = pres_img.attrib['src']
+
+        # ingredients
+        ingredients_container = first(XPATH['ingredients_container'](root))
+        if ingredients_container is not None:
+            for dd in XPATH['ingredient_items'](ingredients_container):
+                txt = get_text(dd, " ", strip=True)
+                txt = re.sub(r'\s{2,}', ' ', txt)
+                if txt:
+                    data["ingredients"].append(txt)
+
+        # steps
+        for step_block in XPATH['step_blocks'](root):
+            step_set = set()
+            flattened_formatted = []
+            for p_tag in step_block.iter('p'):
+                for item in flatten_contents(p_tag):
+                    if isinstance(item, str):
+                        flattened_formatted.append(item)
+                    elif item.tag == 'span' and 'class' in item.attrib and 'num-step' in get_classes(item):
+                        step_tag = f'<{get_text(item)}>'
+                        flattened_formatted.append(step_tag)
+                        step_set.add(step_tag)
+                    else:
+                        flattened_formatted.append(get_text(item))
+            step_text = ' '.join(flattened_formatted)
+            step_text = re.sub(r'\s+', ' ', step_text)
+            data["steps"].append(step_text)
+            img_elem_full = first(XPATH['step_img_full'](step_block))
+            if img_elem_full is not None:
+                data["step_imgs"].append(('full', [find(img_elem_full, 'img').attrib['src']], step_set))
+            else:
+                url_list = [find(el, 'img').attrib['src'] for el in XPATH['step_img_single'](step_block)]
+                data["step_imgs"].append(('single', url_list, step_set))
+
+        # related urls
+        for related_block in XPATH['related_1'](root):
+            if related_block.attrib['data-swipername'] == 'gz-related-swiper':
+                for rel_url_elem in related_block.iter('a'):
+                    if rel_url_elem.attrib['href']:
+                        data['related_urls'].add(rel_url_elem.attrib['href'])
+
+        for related_block in XPATH['related_2'](root):
+            if related_block.attrib['data-swipername'] == 'gz-related':
+                for rel_block_elem in XPATH['related_2_titles'](related_block):
+                    rel_url = find(rel_block_elem, 'a')
+                    if rel_url is not None and rel_url.attrib['href']:
+                        data['related_urls'].add(rel_url.attrib['href'])
+
+        # featured data
+        featured_container = first(XPATH['featured_container'](root))
+        if featured_container is not None:
+            cal_span = first(XPATH['calories'](featured_container))
+            data["featured"] = {
+                "calories": get_text(cal_span, strip=True) if cal_span is not None else None,
+                "items": [get_text(li, " ", strip=True) for li in XPATH['featured_items'](featured_container)],
+            }
+
+        return data
@@ -0,0 +1,184 @@
+import requests
+from requests.adapters import HTTPAdapter
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+from typing import Dict
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, up to `burst` stored."""
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class HostRateLimiter:
+    """Keeps one `TokenBucket` per host, so that e.g. the IT and EN sites are limited separately."""
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url: str):
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets[host] = bucket
+        bucket.acquire()
+
+# statuses that are final for a URL and thus worth caching
+CACHED_STATUS = {200, 403, 404, 410}
+
+class CachedResponse:
+    """The subset of `requests.Response` used by the scrapers, rebuilt from the cache."""
+    def __init__(self, url: str, status_code: int, content: bytes, headers: Dict = None, from_cache: bool = False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.from_cache = from_cache
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf8', errors='replace')
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}")
+
+class PageCache:
+    """On-disk response cache keyed by URL.
+
+    Each entry is `<key>.json` with the URL, status and validators (ETag/Last-Modified),
+    plus `<key>.gz` (text, gzip-compressed) or `<key>.bin` (already compressed media).
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def key_path(self, url: str) -> str:
+        key = hashlib.sha1(url.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def meta(self, url: str) -> Dict:
+        path = self.key_path(url) + '.json'
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf8') as f:
+            return json.load(f)
+
+    def get(self, url: str) -> CachedResponse:
+        meta = self.meta(url)
+        if meta is None:
+            return None
+        path = self.key_path(url) + ('.gz' if meta['compressed'] else '.bin')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            content = f.read()
+        if meta['compressed']:
+            content = gzip.decompress(content)
+        return CachedResponse(url, meta['status_code'], content, meta['headers'], from_cache=True)
+
+    def put(self, url: str, status_code: int, content: bytes, headers: Dict):
+        base = self.key_path(url)
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        headers = {k: headers[k] for k in ('ETag', 'Last-Modified', 'Content-Type') if k in headers}
+        compressed = 'text' in headers.get('Content-Type', 'text')
+        meta = {
+            'url': url,
+            'status_code': status_code,
+            'headers': headers,
+            'compressed': compressed,
+            'fetched_at': time.time(),
+        }
+        # data first, metadata last, each through a temp file: a reader never sees a partial entry
+        self._atomic_write(base + ('.gz' if compressed else '.bin'), gzip.compress(content, compresslevel=6) if compressed else content)
+        self._atomic_write(base + '.json', json.dumps(meta, ensure_ascii=False).encode('utf8'))
+
+    def _atomic_write(self, path: str, data: bytes):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+class Fetcher:
+    """HTTP client shared by all workers: one pooled `requests.Session` per thread, rate limited per host.
+
+    With a `cache_dir`, `fetch` serves responses from a `PageCache` and only goes to the network on a miss
+    or, with `refresh=True`, to revalidate the cached copy with a conditional request.
+    """
+    def __init__(self,
+                 rate: float = 0,
+                 burst: int = 1,
+                 pool_size: int = 16,
+                 timeout: float = 30,
+                 headers: Dict = None,
+                 cache_dir: str = None,
+                 ):
+        self.limiter = HostRateLimiter(rate, burst)
+        self.cache = PageCache(cache_dir) if cache_dir else None
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = headers or {'User-Agent': 'Mozilla/5.0'}
+        self.local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(self.headers)
+            self.local.session = session
+        return session
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        self.limiter.acquire(url)
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def fetch(self, url: str, refresh: bool = False, offline: bool = False) -> CachedResponse:
+        cached = self.cache.get(url) if self.cache else None
+        if cached is not None and not refresh:
+            return cached
+        if offline:
+            if cached is not None:
+                return cached
+            raise FileNotFoundError(f"{url} is not in the page cache")
+        headers = {}
+        if cached is not None:
+            if 'ETag' in cached.headers:
+                headers['If-None-Match'] = cached.headers['ETag']
+            if 'Last-Modified' in cached.headers:
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+        resp = self.get(url, headers=headers)
+        if resp.status_code == 304 and cached is not None:
+            return cached
+        if self.cache and resp.status_code in CACHED_STATUS:
+            self.cache.put(url, resp.status_code, resp.content, resp.headers)
+        return CachedResponse(url, resp.status_code, resp.content, dict(resp.headers))
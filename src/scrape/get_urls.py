@@ -1,9 +1,12 @@
-import requests
 from bs4 import BeautifulSoup
-import time
 from tqdm.auto import tqdm
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import json
 import os
+import sys
+sys.path.append('.')
+from src.scrape.fetch import Fetcher
 
 region_list = [
     "Abruzzo",
@@ -28,69 +31,119 @@ region_list = [
     "Veneto"
     ]
 
-def extract_urls(base_url, min_pages = 1, region = ''):
+def get_max_pages(soup):
+    page_list_block = soup.select_one('div.gz-nums')
+    if page_list_block:
+        max_pages_block = page_list_block.select_one('span.disabled.total-pages')
+        if max_pages_block:
+            return int(max_pages_block.text)
+        page_list = page_list_block.select('div.gz-pages a.page')
+        return int(page_list[-1].text)
+    return 1
+
+def fetch_listing(fetcher, url):
+    response = fetcher.get(url)
+    if response.status_code != 200:
+        return None
+    soup = BeautifulSoup(response.text, 'html.parser')
+    return soup
+
+def extract_urls(base_url, min_pages = 1, region = '', fetcher = None, known_urls = None, num_workers = 8):
+    """Collects recipe URLs from the listing pages, fetching `num_workers` pages at a time.
+
+    With `known_urls`, stops at the first page whose recipes are all known and only returns the new URLs.
+    """
+    fetcher = fetcher or Fetcher(rate=1)
     urls = []
     url_layout = base_url + r"page{page}/"
     if region:
         url_layout += r'regionali/{region}'
     url_first = url_layout.format(page=str(1), region=region)
-    resp = requests.get(url_first)
+    resp = fetcher.get(url_first)
     resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, "html.parser")
-    page_list_block = soup.select_one('div.gz-nums')
-    if page_list_block:
-        max_pages_block = page_list_block.select_one('span.disabled.total-pages')
-        if max_pages_block:
-            max_pages = int(max_pages_block.text)
-        else:
-            page_list = page_list_block.select('div.gz-pages a.page')
-            max_pages = int(page_list[-1].text)
-    else:
-        max_pages = 1
-    pbar = tqdm(range(min_pages, max_pages + 1))
-    for page in pbar:
-        url = url_layout.format(page=page, region=region)
-        response = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'})
-        
-        if response.status_code != 200:
-            print(f"Failed to retrieve page {page}")
-            continue
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        recipe_links = soup.select("h2.gz-title a")
-
-        if len(recipe_links) == 0:
-            break
-        
-        for link in recipe_links:
-            urls.append(link['href'])
-        
-        time.sleep(1)  # To avoid overloading the server
-        pbar.set_description(f'Scraping URL: {url}')
+    soup_first = BeautifulSoup(resp.text, "html.parser")
+    max_pages = get_max_pages(soup_first)
+    pages = list(range(min_pages, max_pages + 1))
+    pbar = tqdm(total=len(pages), desc=f'Scraping URLs {region}'.strip(), leave=not region)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for w in range(0, len(pages), num_workers):
+            window = pages[w:w+num_workers]
+            soup_list = executor.map(lambda page: soup_first if page == 1 else fetch_listing(fetcher, url_layout.format(page=page, region=region)), window)
+            done = False
+            for page, soup in zip(window, soup_list):
+                pbar.update(1)
+                if soup is None:
+                    print(f"Failed to retrieve page {page}")
+                    continue
+                recipe_links = [link['href'] for link in soup.select("h2.gz-title a")]
+                if len(recipe_links) == 0:
+                    done = True
+                    break
+                if known_urls is not None:
+                    new_links = [el for el in recipe_links if el not in known_urls]
+                    urls += new_links
+                    if len(new_links) == 0:
+                        done = True
+                        break
+                else:
+                    urls += recipe_links
+            if done:
+                break
+    pbar.close()
     return urls
 
+def merge_urls(new_urls, old_urls):
+    """New URLs first, as the listings put the latest recipes first, without duplicates."""
+    return list(dict.fromkeys(new_urls + old_urls))
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect recipe URLs from the GialloZafferano listings")
+    parser.add_argument("--new_list", type=int, help="Whether to crawl the full recipe list instead of reading misc/gz_urls.txt", default=0)
+    parser.add_argument("--incremental", type=int, help="Whether to stop paginating at already known URLs", default=0)
+    parser.add_argument("--num_workers", type=int, help="Number of listing pages fetched in parallel", default=8)
+    parser.add_argument("--rate", type=float, help="Max requests per second per host, 0 for no limit", default=2)
+    args = parser.parse_args()
+
     base_url = "https://www.giallozafferano.it/ricette-cat/"
-    new_list = 0
     misc_dir = "./misc"
     gz_urls_path = os.path.join(misc_dir, 'gz_urls.txt')
-    if new_list:        
-        extracted_urls = extract_urls(base_url, min_pages=1)
+    gz_regional_urls_path = os.path.join(misc_dir, 'gz_regional_urls.json')
+    # every crawl below shares the same per-host rate limit
+    fetcher = Fetcher(rate=args.rate, burst=args.num_workers, pool_size=args.num_workers * len(region_list))
+
+    old_urls = [el.strip() for el in open(gz_urls_path, 'r').readlines()] if os.path.exists(gz_urls_path) else []
+    if args.new_list or args.incremental:
+        known_urls = set(old_urls) if args.incremental else None
+        extracted_urls = extract_urls(base_url, min_pages=1, fetcher=fetcher, known_urls=known_urls, num_workers=args.num_workers)
+        if args.incremental:
+            print(f"Found {len(extracted_urls)} new URLs.")
+            extracted_urls = merge_urls(extracted_urls, old_urls)
         # Save to file
         with open(gz_urls_path, "w") as f:
             for url in extracted_urls:
                 f.write(url + "\n")
     else:
-        extracted_urls = [el.strip() for el in open(gz_urls_path, 'r').readlines()]
+        extracted_urls = old_urls
 
-    print(f"Extracted {len(extracted_urls)} URLs. Saved to extracted_urls.txt")
+    print(f"Extracted {len(extracted_urls)} URLs. Saved to {gz_urls_path}")
 
-    url_dict = {}
-    
-    for entry in region_list:
+    old_url_dict = {}
+    if args.incremental and os.path.exists(gz_regional_urls_path):
+        old_url_dict = json.load(open(gz_regional_urls_path, 'r', encoding='utf8'))
+
+    def extract_region(entry):
         rgn = entry.replace(' ', '-').replace("'", "-")
-        extracted_urls = extract_urls(base_url, min_pages=1, region=rgn)
-        url_dict[rgn] = extracted_urls
+        known_urls = set(old_url_dict.get(rgn, [])) if args.incremental else None
+        region_urls = extract_urls(base_url, min_pages=1, region=rgn, fetcher=fetcher, known_urls=known_urls, num_workers=args.num_workers)
+        if args.incremental:
+            region_urls = merge_urls(region_urls, old_url_dict.get(rgn, []))
+        return rgn, region_urls
+
+    url_dict = {}
+    with ThreadPoolExecutor(max_workers=len(region_list)) as executor:
+        # map keeps the order of region_list
+        for rgn, region_urls in executor.map(extract_region, region_list):
+            url_dict[rgn] = region_urls
     
-    with open(os.path.join(misc_dir, 'gz_regional_urls.json'), 'w', encoding='utf8') as f:
+    with open(gz_regional_urls_path, 'w', encoding='utf8') as f:
         json.dump(url_dict, f, ensure_ascii = False, indent = 4)
@@ -0,0 +1,203 @@
+import functools
+import hashlib
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import Future
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Tuple
+import cv2
+import numpy as np
+from PIL import Image
+import sys
+sys.path.append('.')
+from src.scrape.fetch import Fetcher
+from src.scrape.journal import CrawlJournal, PENDING, DONE, FAILED
+
+class ImagePipeline:
+    """Downloads recipe images on background threads, off the page parsing path.
+
+    Images are stored once in a content-addressed blob store (`save_dir/blobs/`) and the
+    per-recipe paths (e.g. `<id>/imgs/it/...` and `<id>/imgs/en/...`) are hard links to the blobs,
+    so the same URL is downloaded once and identical bytes are stored once.
+
+    With a `journal_path`, every job is journaled when queued and when finished, keyed by its first
+    target, so that `resume` queues again the jobs an interrupted run did not finish.
+    """
+    def __init__(self, fetcher: Fetcher, save_dir: str, num_workers: int = 8, max_queue: int = 10000, journal_path: str = None):
+        self.fetcher = fetcher
+        self.blob_dir = os.path.join(save_dir, 'blobs')
+        self.journal = CrawlJournal(journal_path) if journal_path else None
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.url_futures: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.stats = {'queued': 0, 'fetched': 0, 'url_hits': 0, 'failed': 0}
+        self.errors: List[Tuple[str, str]] = []
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, url: str, targets: List[str], num_splits: int = None):
+        """Queues `url` to be saved at `targets`, or split width-wise into `len(targets)` parts if `num_splits`."""
+        with self.lock:
+            self.stats['queued'] += 1
+        self.journal_job(url, targets, num_splits, PENDING)
+        self.jobs.put((url, targets, num_splits))
+
+    def journal_job(self, url: str, targets: List[str], num_splits: int, status: str):
+        if self.journal is not None:
+            self.journal.write({'url': targets[0], 'image_url': url, 'targets': targets, 'num_splits': num_splits, 'status': status})
+
+    def resume(self) -> int:
+        """Queues the journaled jobs that were not finished, or failed, and returns how many."""
+        if self.journal is None:
+            return 0
+        unfinished = [el for el in self.journal.entries.values() if el['status'] != DONE]
+        for el in unfinished:
+            self.submit(el['image_url'], el['targets'], el['num_splits'])
+        return len(unfinished)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            url, targets, num_splits = job
+            try:
+                blob = self.blob_for(url)
+                if num_splits:
+                    blob_list = self.split_blob(blob, num_splits)
+                else:
+                    blob_list = [blob]
+                for blob, target in zip(blob_list, targets):
+                    self.link(blob, target)
+                self.journal_job(url, targets, num_splits, DONE)
+            except Exception as exc:
+                with self.lock:
+                    self.stats['failed'] += 1
+                    self.errors.append((url, str(exc)))
+                self.journal_job(url, targets, num_splits, FAILED)
+                print(f"Error downloading image {url}: {exc}", flush=True)
+            finally:
+                self.jobs.task_done()
+
+    def blob_for(self, url: str) -> str:
+        with self.lock:
+            future = self.url_futures.get(url)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.url_futures[url] = future
+            else:
+                self.stats['url_hits'] += 1
+        if owner:
+            try:
+                future.set_result(self.download(url))
+            except Exception as exc:
+                future.set_exception(exc)
+                # the workers already waiting get the error, later jobs of the same URL try again
+                with self.lock:
+                    del self.url_futures[url]
+        # a duplicate URL waits for the worker that is already downloading it
+        return future.result()
+
+    def download(self, url: str) -> str:
+        # not through the page cache, the blob store is the only copy of an image
+        response = self.fetcher.get(url)
+        if response.status_code == 403:
+            img_white = np.ones((50, 50, 3), dtype=np.uint8) * 255
+            success, encoded_image = cv2.imencode('.png', img_white)
+            content = encoded_image.tobytes()
+        else:
+            response.raise_for_status()
+            content = response.content
+        with self.lock:
+            self.stats['fetched'] += 1
+        suffix = Path(url.split('?')[0]).suffix or '.jpg'
+        return self.write_blob(hashlib.sha1(content).hexdigest() + suffix, content)
+
+    def write_blob(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.blob_dir, name[:2], name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return path
+
+    def split_blob(self, blob: str, num_splits: int) -> List[str]:
+        stem, suffix = os.path.splitext(os.path.basename(blob))
+        split_names = [f'{stem}_{i}of{num_splits}{suffix}' for i in range(num_splits)]
+        split_paths = [os.path.join(self.blob_dir, el[:2], el) for el in split_names]
+        if all(os.path.exists(el) for el in split_paths):
+            return split_paths
+        img = Image.open(blob)
+        img_array = np.asarray(img, dtype=np.uint8)
+        if len(img_array.shape) < 3:
+            img_array = img_array[..., np.newaxis]
+        w_split = img_array.shape[1] // num_splits
+        for i, split_name in enumerate(split_names):
+            img_array_split = img_array[:,i*w_split:(i+1)*w_split:,:]
+            buffer = BytesIO()
+            Image.fromarray(img_array_split).save(buffer, format=img.format or 'JPEG')
+            self.write_blob(split_name, buffer.getvalue())
+        return split_paths
+
+    def link(self, blob: str, target: str):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(blob, target)
+        except OSError:
+            # e.g. blobs and recipes on different filesystems
+            shutil.copyfile(blob, target)
+
+    def close(self):
+        """Waits for the queued images and stops the workers."""
+        self.jobs.join()
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.journal is not None:
+            self.journal.close()
+
+def crop_box(size: Tuple[int, int], split: int, num_splits: int) -> Tuple[int, int, int, int]:
+    """Pixel box of a width-wise split, the same slice `Scraper.download_full_step` cuts in 'files' mode."""
+    w, h = size
+    w_split = w // num_splits
+    return (split * w_split, 0, (split + 1) * w_split, h)
+
+class StepImageReader:
+    """Reads recipe step images, cropping virtual splits (`steps_<lang>_img_crop`) on demand.
+
+    With `cache_size > 0`, the most recently used decoded images are kept in an LRU cache.
+    """
+    def __init__(self, cache_size: int = 0):
+        self.cache_size = cache_size
+        self.load = functools.lru_cache(maxsize=cache_size)(self._load) if cache_size else self._load
+
+    def _load(self, path: str, split: int = None, num_splits: int = None) -> Image.Image:
+        img = Image.open(path)
+        if split is None:
+            img.load()
+            return img
+        # `crop` only decodes the image now; the split itself is never written to disk
+        return img.crop(crop_box(img.size, split, num_splits))
+
+    def step_image(self, recipe: Dict, lang: str, index: int) -> Image.Image:
+        path = recipe[f'steps_{lang}_img_path'][index]
+        crop_list = recipe.get(f'steps_{lang}_img_crop') or []
+        crop = crop_list[index] if index < len(crop_list) else None
+        if crop is None:
+            return self.load(path)
+        return self.load(path, crop[0], crop[1])
+
+    def step_images(self, recipe: Dict, lang: str):
+        for i in range(len(recipe[f'steps_{lang}_img_path'])):
+            yield self.step_image(recipe, lang, i)
@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+from typing import Dict, List, Tuple
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+class CrawlJournal:
+    """Append-only JSONL log of the crawl state of each URL.
+
+    Every line is `{"url", "id", "status", ...}` and the last line for a URL wins,
+    so a crash can at most lose the line that was being written.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            self.load()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.f = open(self.path, 'a', encoding='utf8')
+        if self.f.tell():
+            # start on a fresh line in case the last write was cut short
+            self.f.write('\n')
+            self.f.flush()
+
+    def load(self):
+        with open(self.path, 'r', encoding='utf8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # truncated last line from an interrupted write
+                    continue
+                self.entries[entry['url']] = entry
+
+    def bootstrap(self, save_dir: str):
+        """Marks as done the recipes already saved by `Scraper.save_recipe` in `save_dir/<id>/recipe/`."""
+        if not os.path.isdir(save_dir):
+            return
+        for name in os.listdir(save_dir):
+            recipe_dir = os.path.join(save_dir, name, 'recipe')
+            if not name.isdigit() or not os.path.isdir(recipe_dir):
+                continue
+            for filename in os.listdir(recipe_dir):
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(recipe_dir, filename)
+                with open(path, 'r', encoding='utf8') as f:
+                    recipe = json.load(f)
+                if recipe.get('url_it') and recipe['url_it'] not in self.entries:
+                    self.mark(recipe['url_it'], int(name), DONE, path=path)
+
+    def write(self, entry: Dict):
+        with self.lock:
+            self.entries[entry['url']] = entry
+            self.f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.f.flush()
+
+    def mark(self, url: str, id: int, status: str, **fields):
+        self.write({'url': url, 'id': id, 'status': status, **fields})
+
+    def assign_ids(self, urls: List[str]) -> List[Tuple[int, str]]:
+        """Returns `(id, url)` pairs, reusing journaled ids and appending new URLs after the largest one."""
+        next_id = max([el['id'] for el in self.entries.values()], default=-1) + 1
+        id_url_list = []
+        for url in urls:
+            if url not in self.entries:
+                self.mark(url, next_id, PENDING)
+                next_id += 1
+            id_url_list.append((self.entries[url]['id'], url))
+        return id_url_list
+
+    def unfinished(self, urls: List[str]) -> List[Tuple[int, str]]:
+        return [(i, url) for i, url in self.assign_ids(urls) if self.entries[url]['status'] != DONE]
+
+    def done(self) -> List[Dict]:
+        return sorted([el for el in self.entries.values() if el['status'] == DONE], key=lambda x: x['id'])
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,224 @@
+import argparse
+import functools
+import json
+import sys
+import time
+import tracemalloc
+from typing import Dict, Iterator, List
+import msgpack
+
+# fixed schema of a scraped recipe, in the order of its JSON keys; featured data goes to `extras`,
+# whose keys come before `title_en`, as the scraper sets them before parsing the English page
+FIELDS = (
+    'presentation_it',
+    'presentation_it_img_path',
+    'ingredients_it',
+    'steps_it',
+    'steps_it_img_path',
+    'steps_it_img_crop',
+    'presentation_urls_it',
+    'related_urls_it',
+    'img_count_it',
+    'url_en',
+    'presentation_en',
+    'presentation_en_img_path',
+    'ingredients_en',
+    'steps_en',
+    'steps_en_img_path',
+    'steps_en_img_crop',
+    'presentation_urls_en',
+    'related_urls_en',
+    'img_count_en',
+    'other',
+    'id',
+    'num_splits',
+    'url_it',
+    'title_it',
+    'title_en',
+)
+# the URLs of related recipes and the ingredient lines ("Sale fino q.b.") repeat across many recipes,
+# so the strings of these fields are interned, as are the featured data values (difficulty, cost, ...)
+SET_FIELDS = {'presentation_urls_it', 'related_urls_it', 'presentation_urls_en', 'related_urls_en'}
+INTERNED_LIST_FIELDS = {'ingredients_it', 'ingredients_en', 'other'}
+# bumped whenever FIELDS changes, since packed recipes only store the values
+CODEC_VERSION = 1
+
+def intern_value(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def intern_all(values: List) -> List:
+    # `map` keeps the loop in C for the usual all-string lists
+    try:
+        return list(map(sys.intern, values))
+    except TypeError:
+        return [intern_value(el) for el in values]
+
+@functools.lru_cache(maxsize=None)
+def fields_of_mask(mask: int) -> tuple:
+    return tuple([field for i, field in enumerate(FIELDS) if mask & (1 << i)])
+
+class Recipe:
+    """A scraped recipe: one slot per field of `FIELDS`, plus `extras` for the featured data
+    (calories, difficulty, cost, ...), whose keys depend on the page.
+
+    A field that was never set (e.g. `title_en` for a recipe without translation, or `steps_<lang>_img_crop`
+    outside the 'virtual' split mode) is left out of `to_dict`.
+    """
+    __slots__ = FIELDS + ('extras',)
+
+    def __init__(self, id):
+        self.presentation_it = None
+        self.presentation_it_img_path = ''
+        self.ingredients_it = []
+        self.steps_it = []
+        self.steps_it_img_path = []
+        self.presentation_urls_it = set()
+        self.related_urls_it = set()
+        self.img_count_it = 0
+        self.url_en = ''
+        self.presentation_en = None
+        self.presentation_en_img_path = ''
+        self.ingredients_en = []
+        self.steps_en = []
+        self.steps_en_img_path = []
+        self.presentation_urls_en = set()
+        self.related_urls_en = set()
+        self.img_count_en = 0
+        self.other = []
+        self.id = id
+        self.num_splits = 3
+        self.extras = {}
+
+    def set_extra(self, key: str, value):
+        self.extras[sys.intern(key)] = intern_value(value)
+
+    def to_dict(self) -> Dict:
+        """The JSON-serializable dict of the recipe, with sets as lists."""
+        recipe_dict = {}
+        for field in FIELDS:
+            if field == 'title_en':
+                recipe_dict.update(self.extras)
+            try:
+                value = getattr(self, field)
+            except AttributeError:
+                continue
+            recipe_dict[field] = list(value) if isinstance(value, set) else value
+        return recipe_dict
+
+    @classmethod
+    def from_dict(cls, recipe_dict: Dict) -> 'Recipe':
+        recipe = cls.__new__(cls)
+        recipe.extras = {}
+        for key, value in recipe_dict.items():
+            if key in SET_FIELDS:
+                value = set(intern_all(value))
+            elif key in INTERNED_LIST_FIELDS:
+                value = intern_all(value)
+            if key in FIELDS:
+                setattr(recipe, key, value)
+            else:
+                recipe.set_extra(key, value)
+        return recipe
+
+    def pack(self) -> bytes:
+        """Binary encoding: the values of the set fields by position, plus the extras."""
+        mask, values = 0, []
+        for i, field in enumerate(FIELDS):
+            try:
+                value = getattr(self, field)
+            except AttributeError:
+                continue
+            mask |= 1 << i
+            values.append(list(value) if isinstance(value, set) else value)
+        return msgpack.packb([CODEC_VERSION, mask, values, self.extras], use_bin_type=True)
+
+    @classmethod
+    def unpack(cls, data: bytes) -> 'Recipe':
+        return cls.from_packed(msgpack.unpackb(data, raw=False))
+
+    @classmethod
+    def from_packed(cls, packed: List) -> 'Recipe':
+        version, mask, values, extras = packed
+        if version != CODEC_VERSION:
+            raise ValueError(f'Recipe packed with codec version {version}, expected {CODEC_VERSION}')
+        recipe = cls.__new__(cls)
+        for field, value in zip(fields_of_mask(mask), values):
+            if field in SET_FIELDS:
+                value = set(intern_all(value))
+            elif field in INTERNED_LIST_FIELDS:
+                value = intern_all(value)
+            setattr(recipe, field, value)
+        recipe.extras = {sys.intern(key): intern_value(value) for key, value in extras.items()}
+        return recipe
+
+def write_recipes(path: str, recipes: Iterator[Recipe]):
+    """Writes `recipes` as a stream of packed recipes."""
+    with open(path, 'wb') as f:
+        for recipe in recipes:
+            f.write(recipe.pack())
+
+def read_recipes(path: str) -> Iterator[Recipe]:
+    with open(path, 'rb') as f:
+        for packed in msgpack.Unpacker(f, raw=False):
+            yield Recipe.from_packed(packed)
+
+def normalize(recipe_dict: Dict) -> Dict:
+    # sets come back as lists in arbitrary order
+    return {k: sorted(v) if k in SET_FIELDS else v for k, v in recipe_dict.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that recipes round-trip through Recipe and its binary codec, and compare them with JSON")
+    parser.add_argument("--input", help="JSON list of scraped recipes", default='./data/gz_raw.json')
+    parser.add_argument("--output", help="Where to write the packed recipes, '' to skip", default='')
+    args = parser.parse_args()
+
+    with open(args.input, 'r', encoding='utf8') as f:
+        text = f.read()
+
+    tracemalloc.start()
+    data = json.loads(text)
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    packed_list = [Recipe.from_dict(el).pack() for el in data]
+    # decoded from bytes, so that the recipes do not share strings with `data`
+    tracemalloc.start()
+    recipes = [Recipe.unpack(el) for el in packed_list]
+    recipe_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    for recipe_dict, recipe in zip(data, recipes):
+        if normalize(Recipe.from_dict(recipe_dict).to_dict()) != normalize(recipe_dict):
+            print(f"Recipe {recipe_dict.get('id')} changed through Recipe.from_dict/to_dict", flush=True)
+            sys.exit(1)
+        if normalize(recipe.to_dict()) != normalize(recipe_dict):
+            print(f"Recipe {recipe_dict.get('id')} changed through pack/unpack", flush=True)
+            sys.exit(1)
+    # files written by the scraper keep their key order, other files (e.g. with sorted keys) do not
+    num_ordered = sum([list(recipe.to_dict()) == list(recipe_dict) for recipe_dict, recipe in zip(data, recipes)])
+    print(f"{len(recipes)} recipes round-trip through to_dict and pack/unpack, {num_ordered} with the same key order")
+    print(f"In memory: {dict_bytes / 2**20:.1f} MB as dicts, {recipe_bytes / 2**20:.1f} MB as Recipe ({1 - recipe_bytes / dict_bytes:.0%} less)")
+
+    start = time.perf_counter()
+    json_data = json.dumps([el.to_dict() for el in recipes], ensure_ascii=False).encode('utf8')
+    json_dump_time = time.perf_counter() - start
+    start = time.perf_counter()
+    packed_list = [el.pack() for el in recipes]
+    pack_time = time.perf_counter() - start
+    start = time.perf_counter()
+    [Recipe.from_dict(el) for el in json.loads(json_data)]
+    json_load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    [Recipe.unpack(el) for el in packed_list]
+    unpack_time = time.perf_counter() - start
+    print(f"JSON: {len(json_data) / 2**20:.1f} MB, dump {json_dump_time:.2f} s, load {json_load_time:.2f} s")
+    print(f"msgpack: {sum([len(el) for el in packed_list]) / 2**20:.1f} MB, dump {pack_time:.2f} s, load {unpack_time:.2f} s")
+
+    if args.output:
+        write_recipes(args.output, recipes)
+        if [normalize(el.to_dict()) for el in read_recipes(args.output)] != [normalize(el) for el in data]:
+            print(f"{args.output} does not read back the same recipes", flush=True)
+            sys.exit(1)
+        print(f"Wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
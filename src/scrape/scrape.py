@@ -1,12 +1,13 @@
-import requests
 import json
-from bs4 import BeautifulSoup
+import hashlib
+import functools
+from bs4 import BeautifulSoup, SoupStrainer
 import bs4
 import pandas as pd
 from tqdm.auto import tqdm
 import re
 import argparse
-import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import os
 from PIL import Image
 import numpy as np
@@ -14,33 +15,59 @@ from io import BytesIO
 from typing import List, Dict
 import cv2
 from pathlib import Path
-
-class Recipe:
-    def __init__(self, id):
-        self.presentation_it = None
-        self.presentation_it_img_path = ''
-        self.ingredients_it = []
-        self.steps_it = []
-        self.steps_it_img_path = []
-        self.presentation_urls_it = set()
-        self.related_urls_it = set()
-        self.img_count_it = 0
-        self.url_en = ''
-        self.presentation_en = None
-        self.presentation_en_img_path = ''
-        self.ingredients_en = []
-        self.steps_en = []
-        self.steps_en_img_path = []
-        self.presentation_urls_en = set()
-        self.related_urls_en = set()
-        self.img_count_en = 0
-        self.other = []
-        self.id = id
-        self.num_splits = 3
+import sys
+sys.path.append('.')
+from src.scrape.fetch import Fetcher
+from src.scrape.journal import CrawlJournal, DONE, FAILED
+from src.scrape.images import ImagePipeline
+from src.scrape.extract import RecipeExtractor
+from src.scrape.recipe import Recipe
+from src.shards import ShardWriter, iter_latest, dump_json_stream
+
+# top-level containers of everything `Scraper` reads from a recipe page
+RECIPE_CONTAINER_CLASSES = {
+    'gz-content-recipe',
+    'gz-featured-image',
+    'gz-ingredients',
+    'gz-featured-data-cnt',
+    'gz-swiper-element-shadowed',
+    'gz-elevator-ame-base',
+}
+
+def is_recipe_container(class_string):
+    # depending on the bs4 version this gets single classes or the whole class attribute
+    return class_string is not None and not RECIPE_CONTAINER_CLASSES.isdisjoint(class_string.split())
 
 class Scraper:
-    def __init__(self, save_dir: str):
+    def __init__(self,
+                 save_dir: str,
+                 fetcher: Fetcher = None,
+                 offline: bool = False,
+                 refresh: bool = False,
+                 save_images: bool = True,
+                 parser: str = 'html.parser',
+                 strain: bool = False,
+                 images: ImagePipeline = None,
+                 split_mode: str = 'files',
+                 per_recipe_json: bool = True,
+                 backend: str = 'bs4',
+                 ):
         self.save_dir = save_dir
+        self.fetcher = fetcher or Fetcher()
+        # offline: recipe pages must come from the page cache; refresh: revalidate cached pages
+        self.offline = offline
+        self.refresh = refresh
+        self.save_images = save_images
+        # with an image pipeline, parsing only queues the image downloads
+        self.images = images
+        # 'files': one image file per split, 'virtual': one file plus `[split, num_splits]` crops
+        self.split_mode = split_mode
+        self.per_recipe_json = per_recipe_json
+        # 'bs4': BeautifulSoup with `parser`, 'lxml': single-pass `RecipeExtractor` returning the same data
+        self.extractor = RecipeExtractor() if backend == 'lxml' else None
+        self.parser = parser
+        # only build the subtrees read by `_parse_recipe_page` and the featured data
+        self.parse_only = SoupStrainer(attrs={'class': is_recipe_container}) if strain else None
         self.key_dict = {
             "difficoltà": "difficulty",
             "preparazione": "prep_time",
@@ -60,7 +87,10 @@ class Scraper:
         #     return None
 
     def download_file(self, url):
-        response = requests.get(url)
+        if not self.save_images or self.images is not None:
+            # only the image paths are wanted, e.g. when re-parsing cached pages
+            return None, 0
+        response = self.fetcher.fetch(url)
         if response.status_code == 403:
             img_white = np.ones((50, 50, 3), dtype=np.uint8) * 255
             success, encoded_image = cv2.imencode('.png', img_white)
@@ -100,17 +130,7 @@ class Scraper:
 
         pres_img_container = soup.select_one('picture.gz-featured-image img')
         if pres_img_container:
-            pres_img_url = pres_img_container.attrs['src']
-            content, dl_failed = self.download_file(pres_img_url)
-            title = pres_img_url.split('/')[-1]
-            title = f'failed_{title}' if dl_failed else title
-            filename = os.path.join(str(recipe.id), 'imgs', lang, 'presentation', title)
-            filename = self.ensure_extension(filename)
-            savename = os.path.join(self.save_dir, filename)
-            setattr(recipe, f'presentation_{lang}_img_path', savename)
-            os.makedirs(os.path.dirname(savename), exist_ok=True)
-            with open(savename, 'wb') as f:
-                f.write(content)
+            self.download_presentation_img(pres_img_container.attrs['src'], recipe, lang)
 
         # ingredients
         ingredients_container = soup.select_one("div.gz-ingredients.gz-mBottom4x.gz-outer")
@@ -152,16 +172,11 @@ class Scraper:
             img_elem_full = step_block.select_one('div.gz-content-recipe-step-img-container picture.gz-content-recipe-step-img.gz-content-recipe-step-img-full')
             if img_elem_full:
                 img_elem = img_elem_full.select_one('img')
-                step_img_url_full = img_elem.attrs['src']
-                if len(step_set) != recipe.num_splits:
-                    print(f"Check recipe {recipe.id}: {getattr(recipe, f'url_{lang}')} (num_splits != 3), set: {step_set}", flush=True)
-                self.download_full_step(step_img_url_full, recipe, lang, recipe.num_splits)
+                self.download_step_imgs('full', [img_elem.attrs['src']], step_set, recipe, lang)
             else:
                 img_elem_single_list = step_block.select('div.gz-content-recipe-step-img-container picture.gz-content-recipe-step-img.gz-content-recipe-step-img-single')
-                for img_elem_single in img_elem_single_list:
-                    img_elem = img_elem_single.select_one('img')
-                    step_img_url_single = img_elem.attrs['src']
-                    self.download_single_steps(step_img_url_single, recipe, lang)
+                url_list = [img_elem_single.select_one('img').attrs['src'] for img_elem_single in img_elem_single_list]
+                self.download_step_imgs('single', url_list, step_set, recipe, lang)
 
         # related urls
         related_container_1 = soup.select("div.gz-swiper-element-shadowed.gz-mBottom3x div.gz-related-swiper")
@@ -185,6 +200,29 @@ class Scraper:
 
         return data
 
+    def download_presentation_img(self, pres_img_url, recipe, lang):
+        content, dl_failed = self.download_file(pres_img_url)
+        title = pres_img_url.split('/')[-1]
+        title = f'failed_{title}' if dl_failed else title
+        filename = os.path.join(str(recipe.id), 'imgs', lang, 'presentation', title)
+        filename = self.ensure_extension(filename)
+        savename = os.path.join(self.save_dir, filename)
+        setattr(recipe, f'presentation_{lang}_img_path', savename)
+        if content is not None:
+            os.makedirs(os.path.dirname(savename), exist_ok=True)
+            with open(savename, 'wb') as f:
+                f.write(content)
+        self.queue_image(pres_img_url, [savename])
+
+    def download_step_imgs(self, kind, url_list, step_set, recipe, lang):
+        if kind == 'full':
+            if len(step_set) != recipe.num_splits:
+                print(f"Check recipe {recipe.id}: {getattr(recipe, f'url_{lang}')} (num_splits != 3), set: {step_set}", flush=True)
+            self.download_full_step(url_list[0], recipe, lang, recipe.num_splits)
+        else:
+            for step_img_url_single in url_list:
+                self.download_single_steps(step_img_url_single, recipe, lang)
+
     def flatten_contents(self, content_list: List):
         flattened = []
         for cont in content_list:
@@ -210,10 +248,11 @@ class Scraper:
         filename = os.path.join(str(recipe.id), 'imgs', lang, 'steps', f'{img_count}_{title}')    
         filename = self.ensure_extension(filename)
         savename = os.path.join(self.save_dir, filename)
-        os.makedirs(os.path.dirname(savename), exist_ok=True)
-        
-        with open(savename, 'wb') as f:
-            f.write(content)
+        if content is not None:
+            os.makedirs(os.path.dirname(savename), exist_ok=True)
+            with open(savename, 'wb') as f:
+                f.write(content)
+        self.queue_image(url, [savename])
 
         setattr(recipe, img_count_field, img_count + 1)
         
@@ -221,6 +260,11 @@ class Scraper:
         current = getattr(recipe, attr_name, [])
         current += [savename]
         setattr(recipe, attr_name, current)
+        self.add_crops(recipe, lang, [None])
+
+    def queue_image(self, url, savenames, num_splits = None):
+        if self.images is not None and self.save_images:
+            self.images.submit(url, savenames, num_splits)
 
     def ensure_extension(self, filename: str, extension = 'jpg'):
         if not Path(filename).suffix:
@@ -236,42 +280,125 @@ class Scraper:
         title = url.split('/')[-1]
         title = f'failed_{title}' if dl_failed else title
 
-        img = Image.open(BytesIO(content))
-        img_array = np.asarray(img, dtype=np.uint8)
-        if len(img_array.shape) < 3:
-            img_array = img_array[..., np.newaxis]
-        w_split = img_array.shape[1] // num_splits
-        img_path_list = []
-
         img_count_field = f'img_count_{lang}'
         img_count = getattr(recipe, img_count_field)
-        counter = 0
-        for i in range(num_splits):
-            img_array_split = img_array[:,i*w_split:(i+1)*w_split:,:]
-            # title = re.sub(img_range, str(i), title)
-            filename = os.path.join(str(recipe.id), 'imgs', lang, 'steps', f'{img_count + counter}_{title}')    
+
+        if self.split_mode == 'virtual':
+            # the original is stored once and every split is a crop of it, see `images.StepImageReader`
+            filename = os.path.join(str(recipe.id), 'imgs', lang, 'steps', f'{img_count}_{title}')
             filename = self.ensure_extension(filename)
             savename = os.path.join(self.save_dir, filename)
-            img_path_list.append(savename)
-            os.makedirs(os.path.dirname(savename), exist_ok=True)
-            Image.fromarray(img_array_split).save(savename)
-            counter += 1
+            if content is not None:
+                os.makedirs(os.path.dirname(savename), exist_ok=True)
+                with open(savename, 'wb') as f:
+                    f.write(content)
+            self.queue_image(url, [savename])
+            img_path_list = [savename] * num_splits
+            crop_list = [[i, num_splits] for i in range(num_splits)]
+            counter = num_splits
+        else:
+            if content is not None:
+                img = Image.open(BytesIO(content))
+                img_array = np.asarray(img, dtype=np.uint8)
+                if len(img_array.shape) < 3:
+                    img_array = img_array[..., np.newaxis]
+                w_split = img_array.shape[1] // num_splits
+            img_path_list = []
+            counter = 0
+            for i in range(num_splits):
+                # title = re.sub(img_range, str(i), title)
+                filename = os.path.join(str(recipe.id), 'imgs', lang, 'steps', f'{img_count + counter}_{title}')    
+                filename = self.ensure_extension(filename)
+                savename = os.path.join(self.save_dir, filename)
+                img_path_list.append(savename)
+                if content is not None:
+                    img_array_split = img_array[:,i*w_split:(i+1)*w_split:,:]
+                    os.makedirs(os.path.dirname(savename), exist_ok=True)
+                    Image.fromarray(img_array_split).save(savename)
+                counter += 1
+            self.queue_image(url, img_path_list, num_splits)
+            crop_list = [None] * num_splits
         setattr(recipe, img_count_field, img_count + counter)
         attr_name = f'steps_{lang}_img_path'
         current = getattr(recipe, attr_name, [])
         current += img_path_list
         setattr(recipe, attr_name, current)
+        self.add_crops(recipe, lang, crop_list)
+
+    def add_crops(self, recipe, lang, crop_list):
+        # only the 'virtual' split mode records crops, so that 'files' records keep their fields
+        if self.split_mode != 'virtual':
+            return
+        attr_name = f'steps_{lang}_img_crop'
+        setattr(recipe, attr_name, getattr(recipe, attr_name, []) + crop_list)
+
+    def fetch_page(self, url, refresh = None):
+        return self.fetch_page_response(url, refresh).text
+
+    def fetch_page_response(self, url, refresh = None):
+        refresh = self.refresh if refresh is None else refresh
+        resp = self.fetcher.fetch(url, refresh=refresh, offline=self.offline)
+        resp.raise_for_status()
+        return resp
+
+    def parse_page(self, html, recipe, lang):
+        """Parses a recipe page with the selected backend.
+
+        Returns the `_parse_recipe_page` dict and, for the IT page, the featured data as
+        `(calories, info_texts)` and the URL of the EN translation.
+        """
+        featured, url_en = None, None
+        if self.extractor is not None:
+            page = self.extractor.extract(html)
+            if page["presentation_img_url"] is not None:
+                self.download_presentation_img(page["presentation_img_url"], recipe, lang)
+            for kind, url_list, step_set in page["step_imgs"]:
+                self.download_step_imgs(kind, url_list, step_set, recipe, lang)
+            data = {k: page[k] for k in ("presentation", "ingredients", "steps", "presentation_urls", "related_urls")}
+            if lang == 'it':
+                if page["featured"] is not None:
+                    featured = (page["featured"]["calories"], page["featured"]["items"])
+                url_en = page["translation_url"]
+            return data, featured, url_en
+
+        soup = self.make_soup(html)
+        data = self._parse_recipe_page(soup, recipe=recipe, lang=lang)
+        if lang == 'it':
+            featured_container = soup.select_one("div.gz-featured-data-cnt")
+            if featured_container:
+                cal_span = featured_container.select_one(".gz-text-calories-total span")
+                info_items = featured_container.select(".gz-list-featured-data ul li, .gz-list-featured-data-other ul li")
+                featured = (cal_span.get_text(strip=True) if cal_span else None, [li.get_text(" ", strip=True) for li in info_items])
+            presentation_block = soup.select_one("div.gz-content-recipe.gz-mBottom4x")
+            translation_link = presentation_block.find('a', attrs={'id': 'gz-translation-link'})
+            if translation_link and translation_link.attrs['href']:
+                url_en = translation_link.attrs['href']
+        return data, featured, url_en
+
+    def make_soup(self, html):
+        return BeautifulSoup(html, self.parser, parse_only=self.parse_only)
+
+    def fetch_pages(self, url, refresh = None):
+        """Fetch stage: stores the IT page and its EN translation in the page cache without parsing them.
+
+        Returns whether any of the two pages was downloaded rather than served or revalidated from the cache.
+        """
+        resp = self.fetch_page_response(url, refresh)
+        downloaded = not resp.from_cache
+        link_strainer = SoupStrainer('a', attrs={'id': 'gz-translation-link'})
+        translation_link = BeautifulSoup(resp.text, "html.parser", parse_only=link_strainer).find('a')
+        if translation_link and translation_link.attrs.get('href'):
+            downloaded = not self.fetch_page_response(translation_link.attrs['href'], refresh).from_cache or downloaded
+        return downloaded
 
     def parse_giallozafferano_recipe(self, url, i):
         recipe = Recipe(id=i)
 
-        resp = requests.get(url)
-        resp.raise_for_status()
-        soup = BeautifulSoup(resp.text, "html.parser")
+        resp_text = self.fetch_page(url)
 
         recipe.url_it = url
         recipe.title_it = recipe.url_it[recipe.url_it.rfind('/') + 1:recipe.url_it.rfind('.')].replace('-', ' ')
-        it_data = self._parse_recipe_page(soup, recipe=recipe, lang='it')
+        it_data, featured, url_en = self.parse_page(resp_text, recipe=recipe, lang='it')
         recipe.presentation_it = it_data["presentation"]
         recipe.ingredients_it = it_data["ingredients"]
         recipe.steps_it = it_data["steps"]
@@ -279,15 +406,11 @@ class Scraper:
         recipe.related_urls_it = recipe.related_urls_it | it_data["related_urls"]
 
         # Featured data (unique to IT page) ---
-        featured_container = soup.select_one("div.gz-featured-data-cnt")
-        if featured_container:
-            cal_span = featured_container.select_one(".gz-text-calories-total span")
-            if cal_span:
-                recipe.calories = cal_span.get_text(strip=True)
-
-            info_items = featured_container.select(".gz-list-featured-data ul li, .gz-list-featured-data-other ul li")
-            for li in info_items:
-                text = li.get_text(" ", strip=True)
+        if featured is not None:
+            calories, info_texts = featured
+            if calories is not None:
+                recipe.set_extra('calories', calories)
+            for text in info_texts:
                 if ":" in text:
                     key, val = text.split(":", 1)
                     if len(key.split()) > 5:
@@ -295,69 +418,221 @@ class Scraper:
                     else:
                         key_stripped = re.sub(' ', '_', key.strip().lower())
                         key_translated = self.key_dict.get(key_stripped, key_stripped)
-                        setattr(recipe, key_translated, re.sub(' ', '_', val.strip().lower()))
+                        recipe.set_extra(key_translated, re.sub(' ', '_', val.strip().lower()))
                 else:
                     recipe.other.append(text)
 
         # Translate page ---
-        presentation_block_en = soup.select_one("div.gz-content-recipe.gz-mBottom4x")
-        translation_link = presentation_block_en.find('a', attrs={'id': 'gz-translation-link'})
-        if translation_link and translation_link.attrs['href']:
-            url_en = translation_link.attrs['href']
-            resp = requests.get(url_en)
-            resp.raise_for_status()
-            soup_translated = BeautifulSoup(resp.text, "html.parser")
+        if url_en:
             recipe.url_en = url_en
             recipe.title_en = recipe.url_en[recipe.url_en.rfind('/') + 1:recipe.url_en.rfind('.')].replace('-', ' ')
-            en_data = self._parse_recipe_page(soup_translated, recipe=recipe, lang='en')
+            en_data, _, _ = self.parse_page(self.fetch_page(url_en), recipe=recipe, lang='en')
             recipe.presentation_en = en_data["presentation"]
             recipe.ingredients_en = en_data["ingredients"]
             recipe.steps_en = en_data["steps"]
             recipe.presentation_urls_en = recipe.presentation_urls_en | en_data["presentation_urls"]
             recipe.related_urls_en = recipe.related_urls_en | en_data["related_urls"]
         
-        self.save_recipe(self.make_recipe_dict(recipe))
+        if self.per_recipe_json:
+            self.save_recipe(self.make_recipe_dict(recipe))
         return recipe
 
-    def make_recipe_dict(self, recipe):
-        serializable_dict = {}
-        for k, v in recipe.__dict__.items():
-            if isinstance(v, set):
-                serializable_dict[k] = list(v)
-            else:
-                serializable_dict[k] = v
-        return serializable_dict
+    def make_recipe_dict(self, recipe: Recipe):
+        return recipe.to_dict()
 
-    def save_recipe(self, recipe: Dict):
+    def recipe_hash(self, recipe: Dict):
+        # sets are saved as lists in arbitrary order
+        recipe = {k: sorted(v) if k.startswith(('presentation_urls', 'related_urls')) else v for k, v in recipe.items()}
+        return hashlib.sha1(json.dumps(recipe, sort_keys=True, ensure_ascii=False).encode('utf8')).hexdigest()
+
+    def recipe_path(self, recipe: Dict):
         filename = os.path.join(str(recipe['id']), 'recipe', f"{str(recipe['id'])}_{recipe['title_it']}.json")
-        savename = os.path.join(self.save_dir, filename)
+        return os.path.join(self.save_dir, filename)
+
+    def save_recipe(self, recipe: Dict):
+        savename = self.recipe_path(recipe)
         os.makedirs(os.path.dirname(savename), exist_ok=True)
         with open(savename, 'w', encoding='utf8') as f:
             json.dump(recipe, f, ensure_ascii = False, indent = 4)
 
+# one Scraper per re-parse process, built by `init_reparse_worker`
+reparse_scraper = None
+
+def init_reparse_worker(save_dir, cache_dir, parser, strain, split_mode, per_recipe_json, backend):
+    global reparse_scraper
+    reparse_scraper = Scraper(save_dir=save_dir,
+                              fetcher=Fetcher(cache_dir=cache_dir),
+                              offline=True,
+                              save_images=False,
+                              parser=parser,
+                              strain=strain,
+                              split_mode=split_mode,
+                              per_recipe_json=per_recipe_json,
+                              backend=backend,
+                              )
+
+def reparse_one(url, i):
+    return reparse_scraper.scrape_one(url, i)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="A program to scrape recipes from GialloZafferano.it")
     parser.add_argument("--num_recipes", type=int, help="The number of recipes to scrape, used for quick testing", default=0)
     parser.add_argument("--num_workers", type=int, help="Number of parallel threads to use", default=4)
+    parser.add_argument("--rate", type=float, help="Max requests per second per host, 0 for no limit", default=5)
+    parser.add_argument("--burst", type=int, help="Max burst of requests per host", default=5)
+    parser.add_argument("--stage", help="'fetch' only downloads pages to the cache, 'parse' only reads from it, 'all' does both", default='all', choices=['all', 'fetch', 'parse'])
+    parser.add_argument("--cache_dir", help="Directory of the compressed page cache", default='./data/html_cache')
+    parser.add_argument("--refresh", type=int, help="Whether to revalidate cached pages with conditional requests", default=0)
+    parser.add_argument("--reparse", action='store_true', help="Re-parse every cached page in a process pool, without fetching pages or images")
+    parser.add_argument("--num_procs", type=int, help="Number of re-parse processes, 0 for all cores", default=0)
+    parser.add_argument("--parser", help="BeautifulSoup parser backend", default='html.parser', choices=['html.parser', 'lxml'])
+    parser.add_argument("--backend", help="Page parsing backend: BeautifulSoup or the single-pass lxml extractor", default='bs4', choices=['bs4', 'lxml'])
+    parser.add_argument("--strain", type=int, help="Whether to only parse the recipe containers of each page", default=0)
+    parser.add_argument("--delta", action='store_true', help="Only scrape new URLs and recipes whose pages changed, and write a change manifest")
+    parser.add_argument("--split_mode", help="Store full-width step images as one file per split or as one file plus crop boxes", default='files', choices=['files', 'virtual'])
+    parser.add_argument("--shard_dir", help="Directory of the JSONL shards the recipes are streamed to", default='./data/gz_raw')
+    parser.add_argument("--shard_mb", type=int, help="Max uncompressed size of a shard in MB", default=256)
+    parser.add_argument("--compression", help="Shard compression", default='gzip', choices=['none', 'gzip', 'zstd'])
+    parser.add_argument("--per_recipe_json", type=int, help="Whether to also save each recipe as a JSON file in its id directory", default=1)
+    parser.add_argument("--raw_json", type=int, help="Whether to write gz_raw.json from the shards at the end", default=1)
+    parser.add_argument("--num_img_workers", type=int, help="Number of background image download threads", default=8)
     args = parser.parse_args()
 
     urls = [el.strip() for el in open('./misc/gz_urls.txt', 'r', encoding='utf8').readlines() if el]
+    # recipes are only removed from the site, not from a --num_recipes test run
+    all_urls = urls
     if args.num_recipes:
         urls = urls[:args.num_recipes]
     
     save_dir = './data/gz_dataset'
-    scraper = Scraper(save_dir=save_dir)
-
-    # all_data = []
-    # with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_workers) as executor:
-    #     futures = list(tqdm(executor.map(scrape_one, urls), total=len(urls)))
-    #     all_data = [dict(res) for res in futures if res is not None]
-    all_data = []
-    for i, url in tqdm(enumerate(urls), total=len(urls)):
-        scraped_recipe = scraper.scrape_one(url, i)
-        scraped_recipe_dict = scraper.make_recipe_dict(scraped_recipe)
-        if scraped_recipe_dict:
-            all_data.append(scraped_recipe_dict)
-
-    with open("./data/gz_raw.json", "w", encoding="utf-8") as f:
-        json.dump(all_data, f, indent=2, ensure_ascii=False)
+    fetcher = Fetcher(rate=args.rate, burst=args.burst, pool_size=args.num_workers + args.num_img_workers, cache_dir=args.cache_dir)
+    images = None
+    if args.stage != 'fetch' and not args.reparse:
+        images = ImagePipeline(fetcher, save_dir, num_workers=args.num_img_workers, journal_path=os.path.join(save_dir, 'images.jsonl'))
+        # images queued by an interrupted run, whose recipes are already journaled as done
+        print(f"{images.resume()} unfinished image downloads queued again.")
+    scraper = Scraper(save_dir=save_dir,
+                      fetcher=fetcher,
+                      offline=args.stage == 'parse',
+                      refresh=bool(args.refresh),
+                      parser=args.parser,
+                      strain=bool(args.strain),
+                      images=images,
+                      split_mode=args.split_mode,
+                      per_recipe_json=bool(args.per_recipe_json),
+                      backend=args.backend,
+                      )
+
+    if args.stage == 'fetch':
+        with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = {executor.submit(scraper.fetch_pages, url): url for url in urls}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    future.result()
+                except Exception as exc:
+                    print(f"Error fetching {futures[future]}: {exc}", flush=True)
+        sys.exit()
+
+    journal_path = os.path.join(save_dir, 'journal.jsonl')
+    new_journal = not os.path.exists(journal_path)
+    journal = CrawlJournal(journal_path)
+    if new_journal:
+        journal.bootstrap(save_dir)
+    # parsing from the cache is cheap, so the parse stage redoes every recipe
+    todo = journal.assign_ids(urls) if args.stage == 'parse' or args.reparse else journal.unfinished(urls)
+    print(f"{len(urls) - len(todo)} recipes already scraped, {len(todo)} to go.")
+
+    changes = None
+    if args.delta:
+        url_set = set(all_urls)
+        changes = {'added': [], 'modified': [], 'removed': []}
+        for el in journal.done():
+            if el['url'] not in url_set:
+                changes['removed'].append({'id': el['id'], 'url': el['url']})
+        # revalidate the pages of the recipes we already have, only the changed ones are parsed again
+        done_urls = [url for url in urls if journal.entries[url]['status'] == DONE]
+        changed_urls = []
+        with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = {executor.submit(scraper.fetch_pages, url, True): url for url in done_urls}
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Revalidating'):
+                try:
+                    if future.result():
+                        changed_urls.append(futures[future])
+                except Exception as exc:
+                    print(f"Error revalidating {futures[future]}: {exc}", flush=True)
+        old_hashes = {}
+        for url in changed_urls:
+            entry = journal.entries[url]
+            if entry.get('hash') is None and entry.get('path'):
+                entry['hash'] = scraper.recipe_hash(json.load(open(entry['path'], 'r', encoding='utf8')))
+            old_hashes[url] = entry.get('hash')
+        # with --reparse, every URL is already in todo
+        todo = list(dict.fromkeys(todo + [(journal.entries[url]['id'], url) for url in changed_urls]))
+        print(f"{len(changed_urls)} scraped recipes have changed pages.")
+
+    if args.reparse:
+        # parsing is CPU-bound, so it needs processes rather than threads
+        executor = ProcessPoolExecutor(max_workers=args.num_procs or os.cpu_count(),
+                                       initializer=init_reparse_worker,
+                                       initargs=(save_dir, args.cache_dir, args.parser, bool(args.strain), args.split_mode, bool(args.per_recipe_json), args.backend),
+                                       )
+        submit = lambda url, i: executor.submit(reparse_one, url, i)
+    else:
+        # each worker builds its own Recipe, so the only shared state is the fetcher and the journal
+        executor = ThreadPoolExecutor(max_workers=args.num_workers)
+        submit = lambda url, i: executor.submit(scraper.scrape_one, url, i)
+    writer = ShardWriter(args.shard_dir,
+                         max_bytes=args.shard_mb * 2**20,
+                         compression=None if args.compression == 'none' else args.compression,
+                         )
+    with executor:
+        futures = {submit(url, i): (i, url) for i, url in todo}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            # drop the future so that its result can be freed once written out
+            i, url = futures.pop(future)
+            try:
+                scraped_recipe = future.result()
+            except Exception as exc:
+                print(f"Error parsing {url}: {exc}", flush=True)
+                # a re-parse failure (e.g. a page missing from the cache) keeps the previous result
+                if journal.entries[url]['status'] != DONE:
+                    journal.mark(url, i, FAILED, error=str(exc))
+                continue
+            recipe_dict = scraper.make_recipe_dict(scraped_recipe)
+            recipe_hash = scraper.recipe_hash(recipe_dict)
+            if changes is not None:
+                if journal.entries[url]['status'] != DONE:
+                    changes['added'].append({'id': i, 'url': url})
+                elif old_hashes.get(url) != recipe_hash:
+                    changes['modified'].append({'id': i, 'url': url})
+            # journaled as done only once the record is flushed to its shard, so a crash cannot lose it
+            path = scraper.recipe_path(recipe_dict) if args.per_recipe_json else None
+            writer.write(recipe_dict, on_flushed=functools.partial(journal.mark, url, i, DONE, path=path, hash=recipe_hash))
+    writer.close()
+    journal.close()
+    if images is not None:
+        print(f"Waiting for {images.jobs.qsize()} queued images...")
+        images.close()
+        print(f"Images: {images.stats}")
+
+    def raw_records():
+        done_urls = set([el['url'] for el in journal.done()]) & set(urls)
+        seen_urls = set()
+        for record in iter_latest(args.shard_dir):
+            if record['url_it'] in done_urls:
+                seen_urls.add(record['url_it'])
+                yield record
+        # recipes scraped before the shards existed
+        for el in journal.done():
+            if el['url'] in done_urls and el['url'] not in seen_urls and el.get('path'):
+                yield json.load(open(el['path'], 'r', encoding='utf8'))
+
+    if args.raw_json:
+        dump_json_stream(raw_records(), "./data/gz_raw.json")
+
+    if changes is not None:
+        for key in changes:
+            changes[key].sort(key=lambda x: x['id'])
+        print(f"Added: {len(changes['added'])}, modified: {len(changes['modified'])}, removed: {len(changes['removed'])}")
+        with open("./data/gz_changes.json", "w", encoding="utf-8") as f:
+            json.dump(changes, f, indent=4, ensure_ascii=False)
\ No newline at end of file
@@ -0,0 +1,161 @@
+import gzip
+import io
+import json
+import os
+import re
+import threading
+from typing import Callable, Dict, Iterator, List
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TRUNCATED_ERRORS = (EOFError,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+SHARD_SUFFIX = {None: '.jsonl', 'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+def list_shards(shard_dir: str, prefix: str = 'part') -> List[str]:
+    if not os.path.isdir(shard_dir):
+        return []
+    pattern = re.compile(rf'^{re.escape(prefix)}-(\d+)\.jsonl(\.gz|\.zst)?$')
+    shards = [el for el in os.listdir(shard_dir) if pattern.match(el)]
+    shards.sort(key=lambda x: int(pattern.match(x).group(1)))
+    return [os.path.join(shard_dir, el) for el in shards]
+
+def open_shard(path: str, mode: str = 'rb'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('zstandard is required for .zst shards: pip install zstandard')
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, mode), closefd=True)
+    return open(path, mode)
+
+class ShardWriter:
+    """Appends records as JSON lines to size-capped shards `<prefix>-<n>.jsonl[.gz|.zst]`.
+
+    Records are buffered and written every `flush_every` records; a new shard is started
+    once the current one has `max_bytes` of uncompressed data. Shard numbers continue
+    after the shards already in `shard_dir`, so an interrupted run never overwrites them.
+    The `on_flushed` callback of a record is called once its line has been flushed to the shard,
+    e.g. to journal it as done only when it can no longer be lost.
+    """
+    def __init__(self,
+                 shard_dir: str,
+                 prefix: str = 'part',
+                 max_bytes: int = 256 * 2**20,
+                 compression: str = None,
+                 flush_every: int = 100,
+                 ):
+        if compression not in SHARD_SUFFIX:
+            raise ValueError(f'Unknown compression: {compression}')
+        self.shard_dir = shard_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.flush_every = flush_every
+        os.makedirs(self.shard_dir, exist_ok=True)
+        existing = list_shards(self.shard_dir, self.prefix)
+        self.shard_index = int(re.search(r'-(\d+)\.jsonl', os.path.basename(existing[-1])).group(1)) + 1 if existing else 0
+        self.buffer: List[bytes] = []
+        self.callbacks: List[Callable] = []
+        self.f = None
+        self.path = None
+        self.shard_bytes = 0
+        self.lock = threading.Lock()
+
+    def open_next(self):
+        self.path = os.path.join(self.shard_dir, f'{self.prefix}-{self.shard_index:05d}{SHARD_SUFFIX[self.compression]}')
+        self.f = open_shard(self.path, 'wb')
+        self.shard_index += 1
+        self.shard_bytes = 0
+
+    def write(self, record: Dict, on_flushed: Callable = None):
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf8')
+        with self.lock:
+            self.buffer.append(line)
+            if on_flushed is not None:
+                self.callbacks.append(on_flushed)
+            if len(self.buffer) >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        for line in self.buffer:
+            if self.f is None or self.shard_bytes >= self.max_bytes:
+                self.close_shard()
+                self.open_next()
+            self.f.write(line)
+            self.shard_bytes += len(line)
+        self.buffer = []
+        if self.f is not None:
+            self.f.flush()
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close_shard(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def iter_shards(shard_dir: str, prefix: str = 'part') -> Iterator[Dict]:
+    """Lazily yields the records of all the shards in `shard_dir`, in write order."""
+    for path in list_shards(shard_dir, prefix):
+        with open_shard(path, 'rb') as f:
+            lines = io.TextIOWrapper(f, encoding='utf8')
+            while True:
+                try:
+                    line = next(lines)
+                except StopIteration:
+                    break
+                except TRUNCATED_ERRORS:
+                    # a compressed shard still being written, or cut short by a crash
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # truncated last line of a shard from an interrupted run
+                    continue
+
+def iter_latest(shard_dir: str, key: str = 'id', prefix: str = 'part') -> Iterator[Dict]:
+    """Like `iter_shards`, but only yields the last record written for each `key`.
+
+    Reads the shards twice so that only the positions, not the records, are kept in memory.
+    """
+    latest = {}
+    for position, record in enumerate(iter_shards(shard_dir, prefix)):
+        latest[record[key]] = position
+    for position, record in enumerate(iter_shards(shard_dir, prefix)):
+        if latest[record[key]] == position:
+            yield record
+
+def dump_json_stream(records: Iterator[Dict], path: str, indent: int = 2):
+    """Writes `records` as a JSON list one record at a time."""
+    with open(path, 'w', encoding='utf8') as f:
+        f.write('[')
+        i = -1
+        for i, record in enumerate(records):
+            f.write(',\n' if i else '\n')
+            f.write(json.dumps(record, ensure_ascii=False, indent=indent))
+        f.write('\n]' if i >= 0 else ']')
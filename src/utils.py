@@ -1,6 +1,10 @@
 import os
 import json
 import re
+import gc
+import hashlib
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 from random import Random
 import torch
 from torch.utils.data import Dataset
@@ -121,18 +125,83 @@ def get_edge_index(data: List):
     edge_index = torch.Tensor(edge_index).to(torch.long)    
     return edge_index
 
-def compile_single_jsons(path: str):
-    dataset = []
-    for root, dirs, files in os.walk(path):
-        for F in files:
-            filename = os.path.join(root, F)
-            if filename.endswith('.json'):
-                dataset.append(load_json(filename))
-    return dataset
+def scan_jsons(path: str, stat_dict: Dict):
+    # os.walk, but with the stats that scandir already has and without building the file lists
+    with os.scandir(path) as entries:
+        for entry in sorted(entries, key=lambda x: x.name):
+            if entry.is_dir(follow_symlinks=False):
+                scan_jsons(entry.path, stat_dict)
+            elif entry.name.endswith('.json'):
+                stat = entry.stat()
+                stat_dict[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return stat_dict
+
+def read_single_json(filename: str):
+    with open(filename, 'rb') as f:
+        content = f.read()
+    return hashlib.sha1(content).hexdigest(), json.loads(content)
+
+def snapshot_bucket(name: str, num_buckets: int = 256) -> str:
+    return f'{int(hashlib.sha1(name.encode("utf8")).hexdigest(), 16) % num_buckets:02x}'
+
+def compile_single_jsons(path: str, num_workers: int = 16, snapshot: bool = True):
+    """Loads all the JSON files under `path`, reading them with `num_workers` threads.
+
+    With `snapshot`, the records are also stored in `path/snapshot/` with the mtime, size and content hash
+    of their file, and later calls only read the files that changed since. The snapshot is split into
+    buckets by file name, so only the buckets with changed files are rewritten.
+    """
+    snapshot_dir = os.path.join(path, 'snapshot')
+    # {bucket: {name: (mtime_ns, size, sha1, record)}}, with names relative to `path`
+    buckets = {}
+    if snapshot and os.path.isdir(snapshot_dir):
+        # the collector would otherwise keep rescanning the records while they are being unpickled
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for filename in os.listdir(snapshot_dir):
+                if filename.endswith('.pkl'):
+                    with open(os.path.join(snapshot_dir, filename), 'rb') as f:
+                        buckets[filename[:-len('.pkl')]] = pickle.load(f)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    entries = {name: entry for bucket in buckets.values() for name, entry in bucket.items()}
+
+    stat_dict = {os.path.relpath(k, path): v for k, v in scan_jsons(path, {}).items()}
+    changed = [el for el in stat_dict if el not in entries or entries[el][:2] != stat_dict[el]]
+    dirty = set([snapshot_bucket(el) for el in changed] + [snapshot_bucket(el) for el in entries if el not in stat_dict])
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(read_single_json, [os.path.join(path, el) for el in changed])
+        for name, (digest, record) in zip(changed, results):
+            # a touched but unchanged file keeps its record
+            if name in entries and entries[name][2] == digest:
+                record = entries[name][3]
+            entries[name] = (*stat_dict[name], digest, record)
+
+    if snapshot and dirty:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        bucket_entries = {el: {} for el in dirty}
+        for name in stat_dict:
+            bucket = snapshot_bucket(name)
+            if bucket in bucket_entries:
+                bucket_entries[bucket][name] = entries[name]
+        for bucket in dirty:
+            bucket_path = os.path.join(snapshot_dir, f'{bucket}.pkl')
+            tmp_path = f'{bucket_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(bucket_entries[bucket], f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, bucket_path)
+    return [entries[el][3] for el in stat_dict]
 
 def load_json(path: str):
     return json.load(open(path, 'r', encoding='utf8'))
 
 def dump_json(obj, path):    
     with open(path, 'w', encoding='utf8') as f:
-        json.dump(obj, f, ensure_ascii = False, indent = 4)
\ No newline at end of file
+        json.dump(obj, f, ensure_ascii = False, indent = 4)
+
+def load_changed_urls(path: str, keys = ('added', 'modified')):
+    """URLs listed under `keys` in a change manifest written by `scrape.py --delta`."""
+    changes = load_json(path)
+    return set([el['url'] for key in keys for el in changes[key]])